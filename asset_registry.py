@@ -0,0 +1,136 @@
+"""
+已上传图片登记
+按图片内容哈希记录各服务商返回的资源标识（RunningHub fileName、拍我AI img_id），
+同一张图片在有效期内再次使用时直接复用，不重复上传。
+服务商拒绝已登记的资源（有效期内被提前清理）时，调用方删除登记、重新上传一次后重试。
+"""
+
+import logging
+import os
+import time
+import threading
+
+from image_utils import file_content_hash
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 各服务商上传资源的默认有效期（秒），可用 ASSET_TTL_<PROVIDER> 覆盖
+DEFAULT_TTLS = {
+    'runninghub': 6 * 3600,
+    'pai': 6 * 3600,
+}
+
+# 服务商拒绝已上传资源时错误信息中的关键字（不区分大小写）
+INVALID_ASSET_MARKERS = (
+    'PARAMS_INVALID', 'INVALID PARAMETER', 'FILE_NOT_FOUND', 'FILE_NOT_EXIST',
+    'NOT EXIST', 'NOT FOUND', 'EXPIRED',
+)
+
+
+class InvalidAssetError(Exception):
+    """服务商拒绝了提交中引用的已上传资源（fileName / img_id）"""
+
+
+def is_invalid_asset_error(message):
+    """提交任务的错误信息是否表示引用的已上传资源无效"""
+    if not message:
+        return False
+    message = str(message).upper()
+    return any(marker in message for marker in INVALID_ASSET_MARKERS)
+
+
+class AssetRegistry:
+    """线程安全的 (服务商, 内容哈希) -> 资源标识 登记表"""
+
+    def __init__(self, ttls=None, default_ttl=3600):
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+
+        self._assets = {}       # (provider, hash) -> (asset_id, expires_at)
+        self._key_locks = {}    # (provider, hash) -> [锁, 等待/持有者数]，同一张图片同时上传时只上传一次
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        ttls = {}
+        for provider in DEFAULT_TTLS:
+            value = os.environ.get(f'ASSET_TTL_{provider.upper()}')
+            if value:
+                ttls[provider] = float(value)
+        return cls(ttls=ttls)
+
+    def _key(self, provider, path):
+        return provider, file_content_hash(path)
+
+    def get(self, provider, path):
+        """返回未过期的资源标识，没有时返回None"""
+        key = self._key(provider, path)
+        now = time.time()
+        with self._lock:
+            cached = self._assets.get(key)
+            if cached is not None and cached[1] > now:
+                self.hits += 1
+                metrics.count_cache(f'asset_{provider}', True)
+                return cached[0]
+            if cached is not None:
+                del self._assets[key]
+            self.misses += 1
+        metrics.count_cache(f'asset_{provider}', False)
+        return None
+
+    def put(self, provider, path, asset_id, ttl=None):
+        """登记上传结果"""
+        if not asset_id:
+            return
+        key = self._key(provider, path)
+        expires_at = time.time() + (ttl if ttl is not None else self.ttls.get(provider, self.default_ttl))
+        with self._lock:
+            self._assets[key] = (asset_id, expires_at)
+
+    def forget(self, provider, path):
+        """资源被服务商拒绝（如已过期）时删除登记"""
+        with self._lock:
+            self._assets.pop(self._key(provider, path), None)
+
+    def get_or_upload(self, provider, path, upload_func):
+        """已登记时直接返回，否则调用upload_func(path)上传并登记；同一张图片并发时只上传一次"""
+        key = self._key(provider, path)
+        with self._lock:
+            slot = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            slot[1] += 1
+        key_lock = slot[0]
+
+        try:
+            with key_lock:
+                asset_id = self.get(provider, path)
+                if asset_id is not None:
+                    logger.debug(f"复用已上传图片 ({provider}): {os.path.basename(path)} -> {asset_id}")
+                    return asset_id
+                asset_id = upload_func(path)
+                self.put(provider, path, asset_id)
+                return asset_id
+        finally:
+            with self._lock:
+                # 最后一个使用者退出时才删除，避免其他线程拿到已删除的锁而重复上传
+                slot[1] -= 1
+                if slot[1] == 0:
+                    self._key_locks.pop(key, None)
+
+    def prune(self):
+        """删除过期登记，返回删除数量"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._assets.items() if expires_at <= now]
+            for key in expired:
+                del self._assets[key]
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._assets), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,163 @@
+"""
+共享异步运行时
+在独立线程中运行一个长期存活的asyncio事件循环，并持有共享的OpenRouter客户端，
+避免每张图片都创建事件循环和建立新的TLS连接。
+"""
+
+import logging
+import os
+import asyncio
+import atexit
+import threading
+import importlib.util
+
+import httpx
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+def _env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on"}
+
+
+class AsyncLoopThread:
+    """在后台线程中运行的长期事件循环，提供线程安全的提交接口"""
+
+    def __init__(self, name="async-runtime"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+        self._openrouter_clients = {}
+
+    @property
+    def loop(self):
+        self._ensure_started()
+        return self._loop
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._started.clear()
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run_loop, name=self.name, daemon=True)
+            self._thread.start()
+            self._started.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(self._started.set)
+        self._loop.run_forever()
+
+    def in_loop_thread(self):
+        """当前线程是否就是事件循环线程"""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """从任意线程提交协程，返回concurrent.futures.Future"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """提交协程并阻塞等待结果（不能在事件循环线程内调用）"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("AsyncLoopThread.run() cannot be called from the event loop thread")
+        return self.submit(coro).result(timeout=timeout)
+
+    async def get_openrouter_client(self, api_key):
+        """获取共享的AsyncOpenAI客户端（必须在事件循环线程内调用）"""
+        client = self._openrouter_clients.get(api_key)
+        if client is None:
+            client = AsyncOpenAI(
+                base_url=os.environ.get('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1'),
+                api_key=api_key,
+                http_client=self._build_http_client(),
+                max_retries=int(os.environ.get('OPENROUTER_MAX_RETRIES', '2')),
+            )
+            self._openrouter_clients[api_key] = client
+        return client
+
+    def _build_http_client(self):
+        """构建带连接池的httpx客户端，安装了h2时启用HTTP/2"""
+        http2 = _env_bool('OPENROUTER_HTTP2', True) and importlib.util.find_spec('h2') is not None
+        limits = httpx.Limits(
+            max_connections=int(os.environ.get('OPENROUTER_MAX_CONNECTIONS', '100')),
+            max_keepalive_connections=int(os.environ.get('OPENROUTER_MAX_KEEPALIVE', '20')),
+            keepalive_expiry=float(os.environ.get('OPENROUTER_KEEPALIVE_EXPIRY', '60')),
+        )
+        timeout = httpx.Timeout(
+            float(os.environ.get('OPENROUTER_TIMEOUT', '180')),
+            connect=float(os.environ.get('OPENROUTER_CONNECT_TIMEOUT', '10')),
+        )
+        return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+
+    async def _close_clients(self):
+        clients = list(self._openrouter_clients.values())
+        self._openrouter_clients.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.error(f"关闭OpenRouter客户端失败: {e}")
+
+    def shutdown(self, timeout=5):
+        """关闭共享客户端并停止事件循环"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_clients(), self._loop).result(timeout=timeout)
+        except Exception as e:
+            logger.error(f"关闭异步运行时失败: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=timeout)
+
+
+class SingleFlight:
+    """合并相同key的并发调用：同一时刻只执行一次，其余调用者等待同一结果（需在同一事件循环中使用）"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key, coro_factory):
+        """执行或加入key对应的调用，返回 (结果, 是否复用了进行中的调用)"""
+        task = self._inflight.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(coro_factory())
+        self._inflight[key] = task
+
+        def _forget(done_task):
+            if self._inflight.get(key) is done_task:
+                del self._inflight[key]
+
+        task.add_done_callback(_forget)
+        # shield: 某个调用者被取消时不影响其他等待者
+        return await asyncio.shield(task), False
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_async_runtime():
+    """返回进程内共享的异步运行时"""
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = AsyncLoopThread(name="async-runtime")
+                atexit.register(_runtime.shutdown)
+    return _runtime
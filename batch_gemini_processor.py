@@ -16,16 +16,25 @@ import hashlib
 import base64
 import json
 import io
+import random
 from PIL import Image, ImageOps, ExifTags
-from openai import AsyncOpenAI
+from openai import RateLimitError
 from dotenv import load_dotenv
+from async_runtime import get_async_runtime, SingleFlight
+from image_utils import UploadImageTransformer
+from rolling_stats import RollingStats
+from job_ledger import JobLedger, STATUS_COMPLETED, STATUS_FAILED
 
 # 加载环境变量
 load_dotenv()
 
+# asyncio模式下的默认最大并发请求数，各入口统一从这里读取
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('GEMINI_BATCH_MAX_CONCURRENCY', '50'))
+
 
 class BatchGeminiProcessor:
-    def __init__(self, max_workers=5, output_base_dir="outputs"):
+    def __init__(self, max_workers=5, output_base_dir="outputs", use_async=False, max_concurrency=None,
+                 rate_limit_max_retries=5, progress_interval=10, progress_callback=None):
         # 从环境变量获取OpenRouter API密钥
         self.openrouter_api_key = os.environ.get('OPENROUTER_API_KEY')
         if not self.openrouter_api_key:
@@ -34,18 +43,45 @@ class BatchGeminiProcessor:
         self.max_workers = max_workers
         self.output_base_dir = output_base_dir
         
+        # 原生asyncio模式：单事件循环 + 信号量限制并发
+        self.use_async = use_async
+        self.max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+        self.progress_interval = progress_interval
+        self.progress_callback = progress_callback
+        
+        # 进行中的Gemini请求合并（单飞），提示词变更时需同步修改版本号
+        self.gemini_prompt_version = os.environ.get('GEMINI_PROMPT_VERSION', 'v1')
+        self.gemini_flights = SingleFlight()
+        
+        # OpenRouter 429限流：所有并发请求共享同一个退避截止时间
+        self.rate_limit_max_retries = rate_limit_max_retries
+        self.rate_limited_count = 0
+        self._rate_limited_until = 0.0
+        
         # 统计信息
         self.processed_count = 0
         self.success_count = 0
         self.fail_count = 0
         self.cached_count = 0
-        self.processing_times = []
+        self.coalesced_count = 0
+        self.processing_times = RollingStats()  # 处理耗时（内存固定）
         self.results_lock = threading.Lock()
         
         # 确保输出目录存在
         os.makedirs(output_base_dir, exist_ok=True)
         
-        print(f"BatchGeminiProcessor initialized with {max_workers} workers")
+        # 上传前图片缩放/重编码，按内容哈希缓存
+        self.upload_transformer = UploadImageTransformer.from_env(os.path.join(output_base_dir, "upload_cache"))
+        
+        # 任务账本：记录每张图片的处理结果，中断后重新运行时跳过已完成的图片（无需重新计算哈希）
+        self.ledger = None
+        if os.environ.get('JOB_LEDGER_ENABLED', 'true').strip().lower() in {'1', 'true', 'yes', 'on'}:
+            self.ledger = JobLedger(os.environ.get('JOB_LEDGER_PATH') or os.path.join(output_base_dir, "job_ledger.db"))
+        
+        if use_async:
+            print(f"BatchGeminiProcessor initialized in async mode (max concurrency: {self.max_concurrency})")
+        else:
+            print(f"BatchGeminiProcessor initialized with {max_workers} workers")
         print(f"Output directory: {output_base_dir}")
 
     def get_file_hash(self, file_path):
@@ -62,6 +98,10 @@ class BatchGeminiProcessor:
 
     def encode_image(self, image_path):
         """将图像编码为base64字符串，自动处理EXIF方向"""
+        if self.upload_transformer.enabled:
+            # 上传前变换已处理EXIF方向和尺寸，直接读取缓存结果
+            return self.upload_transformer.encode_base64(image_path)
+        
         try:
             with Image.open(image_path) as img:
                 # 自动根据EXIF方向信息旋转图像
@@ -85,6 +125,12 @@ class BatchGeminiProcessor:
             with open(image_path, "rb") as image_file:
                 return base64.b64encode(image_file.read()).decode('utf-8')
 
+    def encode_data_url(self, image_path):
+        """将图像编码为data URL，MIME类型与实际发送的编码一致"""
+        if self.upload_transformer.enabled:
+            return self.upload_transformer.encode_data_url(image_path)
+        return f"data:image/jpeg;base64,{self.encode_image(image_path)}"
+
     def determine_image_type(self, image_path):
         """根据路径确定图片类型"""
         path_lower = image_path.lower()
@@ -207,49 +253,52 @@ class BatchGeminiProcessor:
             print(f"检查缓存失败: {e}")
             return None
 
-    async def preprocess_image_with_gemini(self, image_path, image_type=None):
-        """使用Gemini对图像进行预处理"""
-        thread_name = threading.current_thread().name
-        start_time = time.time()
-        
+    def _ledger_lookup(self, image_path):
+        """返回 (账本键, 源文件指纹, 已完成的处理结果路径或None)"""
+        if self.ledger is None:
+            return None, None, None
+        job_key = JobLedger.make_key('gemini', image_path)
+        stat = os.stat(image_path)
+        fingerprint = f"{stat.st_size}:{stat.st_mtime_ns}:{self.gemini_prompt_version}"
+        entry = self.ledger.get(job_key)
+        if (entry and entry['status'] == STATUS_COMPLETED and entry.get('fingerprint') == fingerprint
+                and os.path.exists(entry.get('processed_path', ''))):
+            return job_key, fingerprint, entry['processed_path']
+        return job_key, fingerprint, None
+
+    def _ledger_record(self, job_key, fingerprint, processed_path):
+        """记录处理结果（processed_path为None表示失败，下次运行会重试）"""
+        if self.ledger is None or job_key is None:
+            return
         try:
-            if image_type is None:
-                image_type = self.determine_image_type(image_path)
-            
-            print(f"[{thread_name}] 开始Gemini预处理{image_type}图像: {os.path.basename(image_path)}")
-            
-            # 检查缓存
-            cached_path = self.get_cached_processed_path(image_path, image_type)
-            if cached_path:
-                print(f"[{thread_name}] ✓ 找到缓存的{image_type}图像: {os.path.basename(cached_path)}")
-                with self.results_lock:
-                    self.cached_count += 1
-                return cached_path
-            
-            # 计算文件哈希
-            file_hash = self.get_file_hash(image_path)
-            if not file_hash:
-                print(f"[{thread_name}] 无法计算文件哈希，跳过预处理")
-                with self.results_lock:
-                    self.fail_count += 1
-                return image_path
-            
-            base64_image = self.encode_image(image_path)
+            if processed_path:
+                self.ledger.update(job_key, 'gemini', STATUS_COMPLETED,
+                                   fingerprint=fingerprint, processed_path=processed_path)
+            else:
+                self.ledger.update(job_key, 'gemini', STATUS_FAILED, fingerprint=fingerprint)
+        except Exception as e:
+            print(f"写入任务账本失败 {job_key}: {e}")
+
+    def _get_retry_after(self, error):
+        """从429响应中读取Retry-After秒数"""
+        try:
+            retry_after = error.response.headers.get('retry-after')
+            if retry_after is not None:
+                return max(0.0, float(retry_after))
+        except Exception:
+            pass
+        return None
+
+    async def _create_completion(self, client, prompt_text, image_data_url):
+        """调用Gemini接口，遇到OpenRouter 429时所有并发请求统一退避后重试"""
+        for attempt in range(self.rate_limit_max_retries + 1):
+            # 等待全局限流窗口结束
+            delay = self._rate_limited_until - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
             
-            async with AsyncOpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=self.openrouter_api_key,
-            ) as client:
-                
-                # 根据图片类型设置不同的提示语
-                if image_type == "user":
-                    prompt_text = "保持人物一致性，保持服饰和发型不变，身材不要太胖，改为半身证件照，光线充足，露出黑色腰带。"
-                elif image_type == "hairstyle":
-                    prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
-                else:
-                    prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
-                
-                completion = await client.chat.completions.create(
+            try:
+                return await client.chat.completions.create(
                     model="google/gemini-2.5-flash-image-preview",
                     messages=[
                         {
@@ -262,26 +311,122 @@ class BatchGeminiProcessor:
                                 {
                                     "type": "image_url",
                                     "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
+                                        "url": image_data_url
                                     }
                                 }
                             ]
                         }
                     ]
                 )
+            except RateLimitError as e:
+                if attempt >= self.rate_limit_max_retries:
+                    raise
                 
-                end_time = time.time()
-                elapsed = end_time - start_time
+                retry_after = self._get_retry_after(e)
+                if retry_after is None:
+                    # 指数退避 + 抖动，避免所有请求同时恢复
+                    retry_after = min(60, 2 ** attempt) + random.uniform(0, 1)
                 
                 with self.results_lock:
-                    self.processing_times.append(elapsed)
+                    self.rate_limited_count += 1
+                    self._rate_limited_until = max(self._rate_limited_until, time.time() + retry_after)
                 
-                print(f"[{thread_name}] Gemini预处理{image_type}耗时: {elapsed:.2f}秒")
+                print(f"OpenRouter限流(429)，{retry_after:.1f}秒后重试 (第{attempt + 1}/{self.rate_limit_max_retries}次)")
+
+    async def preprocess_image_with_gemini(self, image_path, image_type=None):
+        """使用Gemini对图像进行预处理"""
+        # asyncio模式下所有协程都在同一个事件循环线程上，日志按文件名区分而不是线程名
+        log_tag = os.path.basename(image_path)
+        
+        try:
+            if image_type is None:
+                image_type = self.determine_image_type(image_path)
+            
+            print(f"[{log_tag}] 开始Gemini预处理{image_type}图像")
+            
+            # 账本中已完成且源文件未变化时直接跳过
+            job_key, fingerprint, ledger_path = await asyncio.to_thread(self._ledger_lookup, image_path)
+            if ledger_path:
+                print(f"[{log_tag}] ✓ 账本记录已完成，跳过")
+                with self.results_lock:
+                    self.cached_count += 1
+                return ledger_path
+            
+            # 检查缓存（文件读取放到线程池，避免阻塞共享事件循环）
+            cached_path = await asyncio.to_thread(self.get_cached_processed_path, image_path, image_type)
+            if cached_path:
+                print(f"[{log_tag}] ✓ 找到缓存的{image_type}图像: {os.path.basename(cached_path)}")
+                with self.results_lock:
+                    self.cached_count += 1
+                await asyncio.to_thread(self._ledger_record, job_key, fingerprint, cached_path)
+                return cached_path
+            
+            # 计算文件哈希
+            file_hash = await asyncio.to_thread(self.get_file_hash, image_path)
+            if not file_hash:
+                print(f"[{log_tag}] 无法计算文件哈希，跳过预处理")
+                with self.results_lock:
+                    self.fail_count += 1
+                return image_path
+            
+            # 相同内容的图片（如热门发型参考图）并发时只调用一次Gemini
+            flight_key = (file_hash, image_type, self.gemini_prompt_version)
+            processed_path, coalesced = await self.gemini_flights.do(
+                flight_key,
+                lambda: self._run_gemini_preprocess(image_path, image_type, file_hash, log_tag)
+            )
+            if coalesced:
+                with self.results_lock:
+                    self.coalesced_count += 1
+                print(f"[{log_tag}] 复用进行中的Gemini预处理请求")
+            
+            await asyncio.to_thread(self._ledger_record, job_key, fingerprint, processed_path)
+            return processed_path or image_path
                 
-                return await self.process_gemini_response(
-                    completion, image_path, image_type, file_hash, 
-                    thread_name, client, prompt_text, base64_image, attempt=1
-                )
+        except Exception as e:
+            with self.results_lock:
+                self.fail_count += 1
+            print(f"[{log_tag}] Gemini预处理出错: {e}")
+            print(f"[{log_tag}] 使用原图...")
+            return image_path
+
+    async def _run_gemini_preprocess(self, image_path, image_type, file_hash, log_tag):
+        """实际调用Gemini完成预处理，成功返回处理后的路径，失败返回None"""
+        start_time = time.time()
+        
+        try:
+            # 等待期间可能已有其他请求写入了缓存
+            cached_path = await asyncio.to_thread(self.get_cached_processed_path, image_path, image_type)
+            if cached_path:
+                return cached_path
+            
+            image_data_url = await asyncio.to_thread(self.encode_data_url, image_path)
+            
+            # 复用共享的AsyncOpenAI客户端
+            client = await get_async_runtime().get_openrouter_client(self.openrouter_api_key)
+            
+            # 根据图片类型设置不同的提示语
+            if image_type == "user":
+                prompt_text = "保持人物一致性，保持服饰和发型不变，身材不要太胖，改为半身证件照，光线充足，露出黑色腰带。"
+            elif image_type == "hairstyle":
+                prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
+            else:
+                prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
+            
+            completion = await self._create_completion(client, prompt_text, image_data_url)
+            
+            end_time = time.time()
+            elapsed = end_time - start_time
+            
+            self.processing_times.append(elapsed)
+            
+            print(f"[{log_tag}] Gemini预处理{image_type}耗时: {elapsed:.2f}秒")
+            
+            result_path = await self.process_gemini_response(
+                completion, image_path, image_type, file_hash, 
+                log_tag, client, prompt_text, image_data_url, attempt=1
+            )
+            return None if result_path == image_path else result_path
                 
         except Exception as e:
             end_time = time.time()
@@ -289,12 +434,11 @@ class BatchGeminiProcessor:
             with self.results_lock:
                 self.processing_times.append(elapsed)
                 self.fail_count += 1
-            print(f"[{thread_name}] Gemini预处理出错: {e}")
-            print(f"[{thread_name}] 使用原图...")
-            return image_path
+            print(f"[{log_tag}] Gemini预处理出错: {e}")
+            return None
 
     async def process_gemini_response(self, completion, image_path, image_type, file_hash, 
-                                    thread_name, client, prompt_text, base64_image, attempt=1):
+                                    log_tag, client, prompt_text, image_data_url, attempt=1):
         """处理Gemini API响应"""
         max_retries = 2
         
@@ -304,87 +448,61 @@ class BatchGeminiProcessor:
             
             if image_url.startswith("data:image/"):
                 base64_data = image_url.split(",")[1]
-                processed_image_path = self.save_image_from_base64(
-                    base64_data, image_path, image_type, file_hash
+                processed_image_path = await asyncio.to_thread(
+                    self.save_image_from_base64, base64_data, image_path, image_type, file_hash
                 )
                 
                 if processed_image_path:
-                    print(f"[{thread_name}] ✓ Gemini{image_type}预处理成功: {os.path.basename(processed_image_path)}")
+                    print(f"[{log_tag}] ✓ Gemini{image_type}预处理成功: {os.path.basename(processed_image_path)}")
                     with self.results_lock:
                         self.success_count += 1
                     return processed_image_path
                 else:
-                    print(f"[{thread_name}] 保存失败，使用原图")
+                    print(f"[{log_tag}] 保存失败，使用原图")
                     with self.results_lock:
                         self.fail_count += 1
                     return image_path
             else:
-                print(f"[{thread_name}] 非base64格式URL，使用原图")
+                print(f"[{log_tag}] 非base64格式URL，使用原图")
                 with self.results_lock:
                     self.fail_count += 1
                 return image_path
         else:
             # 响应中无图片数据，尝试重试
             if attempt < max_retries:
-                print(f"[{thread_name}] 响应中无图片数据，进行第{attempt + 1}次尝试...")
+                print(f"[{log_tag}] 响应中无图片数据，进行第{attempt + 1}次尝试...")
                 try:
                     await asyncio.sleep(1)
                     
-                    retry_completion = await client.chat.completions.create(
-                        model="google/gemini-2.5-flash-image-preview",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": prompt_text
-                                    },
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64_image}"
-                                        }
-                                    }
-                                ]
-                            }
-                        ]
-                    )
+                    retry_completion = await self._create_completion(client, prompt_text, image_data_url)
                     
                     return await self.process_gemini_response(
                         retry_completion, image_path, image_type, file_hash,
-                        thread_name, client, prompt_text, base64_image, attempt + 1
+                        log_tag, client, prompt_text, image_data_url, attempt + 1
                     )
                     
                 except Exception as retry_error:
-                    print(f"[{thread_name}] 重试请求失败: {retry_error}")
+                    print(f"[{log_tag}] 重试请求失败: {retry_error}")
                     with self.results_lock:
                         self.fail_count += 1
                     return image_path
             else:
-                print(f"[{thread_name}] 达到最大重试次数，使用原图")
+                print(f"[{log_tag}] 达到最大重试次数，使用原图")
                 with self.results_lock:
                     self.fail_count += 1
                 return image_path
 
     def process_single_image_sync(self, image_path):
-        """同步处理单个图片（用于线程池）"""
+        """同步处理单个图片（用于线程池，实际请求在共享事件循环中执行）"""
         try:
-            # 创建新的事件循环
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            result = get_async_runtime().run(
+                self.preprocess_image_with_gemini(image_path)
+            )
             
-            try:
-                result = loop.run_until_complete(
-                    self.preprocess_image_with_gemini(image_path)
-                )
-                
-                with self.results_lock:
-                    self.processed_count += 1
-                
-                return result
-            finally:
-                loop.close()
+            with self.results_lock:
+                self.processed_count += 1
+            
+            return result
                 
         except Exception as e:
             print(f"处理图片失败 {image_path}: {e}")
@@ -392,17 +510,82 @@ class BatchGeminiProcessor:
                 self.fail_count += 1
             return image_path
 
-    def find_image_files(self, directory):
-        """递归查找目录下的所有图片文件"""
+    def iter_image_files(self, directory):
+        """递归遍历目录，逐个产出图片文件路径（惰性）"""
         image_extensions = {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'}
-        image_files = []
         
         for root, dirs, files in os.walk(directory):
             for file in files:
                 if any(file.endswith(ext) for ext in image_extensions):
-                    image_files.append(os.path.join(root, file))
+                    yield os.path.join(root, file)
+
+    def find_image_files(self, directory):
+        """递归查找目录下的所有图片文件"""
+        return list(self.iter_image_files(directory))
+
+    async def process_directory_async(self, directory):
+        """原生asyncio模式处理目录：惰性扫描文件，信号量限制并发，增量汇报进度"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        pending = set()
+        type_counts = {'user': 0, 'hairstyle': 0}
+        progress = {'completed': 0}
+        start_time = time.time()
         
-        return image_files
+        async def _process(image_file):
+            try:
+                return await self.preprocess_image_with_gemini(image_file)
+            finally:
+                semaphore.release()
+        
+        def _on_done(task, image_file):
+            pending.discard(task)
+            with self.results_lock:
+                self.processed_count += 1
+            progress['completed'] += 1
+            completed = progress['completed']
+            
+            try:
+                result = task.result()
+            except Exception as exc:
+                print(f'处理图片 {image_file} 时发生异常: {exc}')
+                result = image_file
+            
+            if completed % self.progress_interval == 0:
+                elapsed = time.time() - start_time
+                print(f"进度: 已完成 {completed} "
+                      f"(成功 {self.success_count}, 缓存 {self.cached_count}, 失败 {self.fail_count}, "
+                      f"进行中 {len(pending)}) - {completed / elapsed:.2f}张/秒 - "
+                      f"最新处理: {os.path.basename(image_file)}")
+            
+            if self.progress_callback:
+                try:
+                    self.progress_callback(completed, image_file, result)
+                except Exception as e:
+                    print(f"进度回调失败: {e}")
+        
+        # os.walk是阻塞调用，放到线程池中逐个取文件
+        file_iter = self.iter_image_files(directory)
+        while True:
+            await semaphore.acquire()
+            image_file = await asyncio.to_thread(next, file_iter, None)
+            if image_file is None:
+                semaphore.release()
+                break
+            
+            type_counts[self.determine_image_type(image_file)] += 1
+            task = asyncio.create_task(_process(image_file))
+            pending.add(task)
+            task.add_done_callback(lambda t, f=image_file: _on_done(t, f))
+        
+        if pending:
+            await asyncio.gather(*list(pending), return_exceptions=True)
+        
+        if progress['completed'] == 0:
+            print(f"在目录 {directory} 中未找到图片文件")
+        else:
+            print(f"图片类型分布: user={type_counts['user']}, hairstyle={type_counts['hairstyle']}")
+        
+        return time.time() - start_time
 
     def process_directory(self, directory):
         """处理目录下的所有图片"""
@@ -410,6 +593,12 @@ class BatchGeminiProcessor:
             print(f"目录不存在: {directory}")
             return
         
+        if self.use_async:
+            print(f"开始扫描目录: {directory} (asyncio模式, 最大并发 {self.max_concurrency})")
+            total_time = get_async_runtime().run(self.process_directory_async(directory))
+            self.print_statistics(total_time)
+            return
+        
         print(f"开始扫描目录: {directory}")
         image_files = self.find_image_files(directory)
         
@@ -468,21 +657,24 @@ class BatchGeminiProcessor:
         print(f"处理的图片总数: {self.processed_count}")
         print(f"成功预处理: {self.success_count}")
         print(f"使用缓存: {self.cached_count}")
+        if self.coalesced_count:
+            print(f"合并重复请求: {self.coalesced_count}")
         print(f"失败/跳过: {self.fail_count}")
+        if self.rate_limited_count:
+            print(f"触发限流(429)次数: {self.rate_limited_count}")
         
         if self.success_count > 0:
             success_rate = (self.success_count / self.processed_count) * 100
             print(f"预处理成功率: {success_rate:.1f}%")
         
         if self.processing_times:
-            avg_time = sum(self.processing_times) / len(self.processing_times)
-            min_time = min(self.processing_times)
-            max_time = max(self.processing_times)
-            print(f"平均处理时间: {avg_time:.2f}秒")
-            print(f"最快处理时间: {min_time:.2f}秒")
-            print(f"最慢处理时间: {max_time:.2f}秒")
-        
-        if self.processed_count > 0:
+            times = self.processing_times.snapshot()
+            print(f"平均处理时间: {times['mean']:.2f}秒")
+            print(f"P50/P95处理时间: {times['p50']:.2f}秒 / {times['p95']:.2f}秒")
+            print(f"最快处理时间: {times['min']:.2f}秒")
+            print(f"最慢处理时间: {times['max']:.2f}秒")
+        
+        if self.processed_count > 0 and total_time > 0:
             avg_throughput = self.processed_count / total_time
             print(f"平均吞吐量: {avg_throughput:.2f}张/秒")
         
@@ -498,14 +690,18 @@ def main():
         # "/Users/alex_wu/work/hair/woman"
     ]
     
-    max_workers = 3  # 并发线程数，可以根据API限制调整
+    max_workers = 3  # 并发线程数，可以根据API限制调整（线程模式）
+    use_async = True  # 使用原生asyncio模式
+    max_concurrency = DEFAULT_MAX_CONCURRENCY  # asyncio模式下的最大并发请求数（GEMINI_BATCH_MAX_CONCURRENCY）
     output_dir = "outputs"  # 输出目录
     
     try:
         # 创建处理器
         processor = BatchGeminiProcessor(
             max_workers=max_workers, 
-            output_base_dir=output_dir
+            output_base_dir=output_dir,
+            use_async=use_async,
+            max_concurrency=max_concurrency
         )
         
         # 处理每个目录
@@ -0,0 +1,153 @@
+"""
+拼接图合成
+把参考图、用户图和结果图按同一高度横向拼接。解码时按目标高度draft/reduce缩放，
+同一批次中重复出现的参考图/用户图只解码一次，合成在进程池中执行，避免与网络线程争用GIL。
+"""
+
+import logging
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from image_utils import DecodedImageCache, image_size
+
+logger = logging.getLogger(__name__)
+
+MIN_TARGET_HEIGHT = 512
+
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'jpg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+    'png': ('PNG', '.png'),
+}
+
+# 每个工作进程内的已解码图片缓存，批次中重复出现的参考图/用户图只解码一次；
+# 进程池中的预算由 _init_worker 按进程数平分后设置
+_decoded_cache = DecodedImageCache(int(os.environ.get('COMPOSITE_DECODE_CACHE_MB', '256')) * 1024 * 1024)
+
+
+def _init_worker(decode_cache_bytes):
+    """工作进程初始化：设置本进程的已解码缓存预算"""
+    _decoded_cache.max_bytes = decode_cache_bytes
+
+
+def _decode_at_height(image_path, target_height):
+    """按目标高度解码并缩放图片"""
+    with Image.open(image_path) as img:
+        target_width = max(1, int(target_height * img.width / img.height))
+        if img.format == 'JPEG' and img.height > target_height:
+            # JPEG在DCT阶段直接按1/2、1/4、1/8缩小解码
+            img.draft('RGB', (target_width, target_height))
+        resized = img.convert('RGB') if img.mode != 'RGB' else img
+        if resized.size != (target_width, target_height):
+            # reducing_gap: 先用reduce()整数倍缩小，再做LANCZOS精确缩放
+            resized = resized.resize((target_width, target_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        elif resized is img:
+            resized = img.copy()
+    return resized
+
+
+def _load_at_height(image_path, target_height):
+    """按目标高度获取图片（优先使用已解码缓存）"""
+    return _decoded_cache.get_or_load(image_path, target_height, _decode_at_height)
+
+
+def compose_side_by_side(image_paths, output_path, image_format='jpeg', quality=90):
+    """按相同高度横向拼接图片并保存，返回输出路径"""
+    pil_format = FORMATS[image_format][0]
+
+    # 只读取文件头获取尺寸，确定目标高度（所有图片的最小高度，但至少512px）
+    target_height = max(MIN_TARGET_HEIGHT, min(image_size(image_path)[1] for image_path in image_paths))
+
+    imgs = [_load_at_height(image_path, target_height) for image_path in image_paths]
+
+    total_width = sum(img.width for img in imgs)
+    combined_img = Image.new('RGB', (total_width, target_height), (255, 255, 255))
+    x_offset = 0
+    for img in imgs:
+        combined_img.paste(img, (x_offset, 0))
+        x_offset += img.width
+
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    if pil_format == 'JPEG':
+        combined_img.save(temp_path, 'JPEG', quality=quality, optimize=True)
+    elif pil_format == 'WEBP':
+        combined_img.save(temp_path, 'WEBP', quality=quality, method=4)
+    else:
+        combined_img.save(temp_path, 'PNG', compress_level=6)
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+class Compositor:
+    """拼接图合成器，默认在进程池中执行"""
+
+    def __init__(self, max_workers=2, image_format='jpeg', quality=90, decode_cache_mb=256):
+        image_format = (image_format or 'jpeg').strip().lower()
+        if image_format not in FORMATS:
+            logger.warning(f"Unknown composite format '{image_format}', falling back to jpeg")
+            image_format = 'jpeg'
+        self.image_format = image_format
+        self.extension = FORMATS[image_format][1]
+        self.quality = quality
+        self.max_workers = max_workers
+        # decode_cache_mb 是所有工作进程合计的已解码缓存预算
+        self.worker_decode_cache_bytes = decode_cache_mb * 1024 * 1024 // max(1, max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """从环境变量读取拼接图配置（COMPOSITE_WORKERS=0 时在当前线程合成）"""
+        return cls(
+            max_workers=int(os.environ.get('COMPOSITE_WORKERS', '2')),
+            image_format=os.environ.get('COMPOSITE_FORMAT', 'jpeg'),
+            quality=int(os.environ.get('COMPOSITE_QUALITY', '90')),
+            decode_cache_mb=int(os.environ.get('COMPOSITE_DECODE_CACHE_MB', '256')),
+        )
+
+    def output_path(self, path):
+        """把输出路径的扩展名替换为当前格式"""
+        return os.path.splitext(path)[0] + self.extension
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: 调用方进程中有大量线程，fork不安全
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.worker_decode_cache_bytes,)
+                )
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def compose(self, image_paths, output_path):
+        """合成拼接图，返回实际输出路径"""
+        output_path = self.output_path(output_path)
+        if self.max_workers <= 0:
+            return compose_side_by_side(image_paths, output_path, self.image_format, self.quality)
+
+        try:
+            future = self._get_executor().submit(
+                compose_side_by_side, image_paths, output_path, self.image_format, self.quality
+            )
+            return future.result()
+        except BrokenProcessPool:
+            # 工作进程异常退出时重建进程池，本次在当前线程完成
+            self._reset_executor()
+            return compose_side_by_side(image_paths, output_path, self.image_format, self.quality)
+
+    def shutdown(self):
+        self._reset_executor()
@@ -0,0 +1,208 @@
+"""
+下载管理器
+共享连接池的流式下载：分块写入临时文件后原子重命名，失败后按Range/If-Range断点续传，
+下载完成后校验长度/校验和，并支持同一任务的多个结果并行下载。
+"""
+
+import logging
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadTooLarge(IOError):
+    """文件超过大小上限，不再重试"""
+
+
+class DownloadManager:
+    """带连接池、断点续传和校验的下载器"""
+
+    def __init__(self, max_workers=8, pool_size=16, timeout=(10, 120), max_retries=3,
+                 chunk_size=256 * 1024, retry_delay=1.0, max_bytes=200 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.chunk_size = chunk_size
+        self.retry_delay = retry_delay
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+
+        # 统计信息
+        self.downloaded_files = 0
+        self.downloaded_bytes = 0
+        self.resumed_count = 0
+        self.failed_count = 0
+
+    @classmethod
+    def from_env(cls):
+        """从环境变量读取下载配置"""
+        return cls(
+            max_workers=int(os.environ.get('DOWNLOAD_WORKERS', '8')),
+            pool_size=int(os.environ.get('DOWNLOAD_POOL_SIZE', '16')),
+            timeout=(float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT', '10')),
+                     float(os.environ.get('DOWNLOAD_READ_TIMEOUT', '120'))),
+            max_retries=int(os.environ.get('DOWNLOAD_MAX_RETRIES', '3')),
+            max_bytes=int(os.environ.get('DOWNLOAD_MAX_BYTES', str(200 * 1024 * 1024))),
+        )
+
+    def _hash_existing(self, part_path):
+        sha256 = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return sha256
+
+    @staticmethod
+    def _validator(response):
+        """可用于If-Range的校验值：强ETag优先，其次Last-Modified"""
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return response.headers.get('Last-Modified')
+
+    @staticmethod
+    def _range_start(response):
+        """解析 Content-Range: bytes start-end/total 的起点"""
+        try:
+            return int(response.headers.get('Content-Range', '').split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            return None
+
+    def _restart(self, url, part_path, validator):
+        os.remove(part_path)
+        validator.clear()
+        return self._fetch(url, part_path, validator)
+
+    def _fetch(self, url, part_path, validator):
+        """下载一次（已有部分文件时尝试续传），返回 (sha256, 总大小, Content-Type)
+
+        validator 记录首次响应的ETag/Last-Modified，续传时作为If-Range发送，资源已变化时服务器返回完整内容。
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset and not validator.get('value'):
+            # 无法确认部分文件与服务器上的版本一致，不续传
+            os.remove(part_path)
+            offset = 0
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator['value']} if offset else {}
+
+        with self.http.get(url, stream=True, timeout=self.timeout, headers=headers) as response:
+            if response.status_code == 416 and offset:
+                # 部分文件已不可用，重新下载
+                return self._restart(url, part_path, validator)
+            response.raise_for_status()
+
+            if offset and response.status_code == 206 and self._range_start(response) != offset:
+                # 返回的片段与已有部分接不上，重新下载
+                return self._restart(url, part_path, validator)
+
+            if offset and response.status_code == 206:
+                self.resumed_count += 1
+                sha256 = self._hash_existing(part_path)
+                mode = 'ab'
+            else:
+                # 服务器不支持Range或资源已变化时从头下载
+                offset = 0
+                sha256 = hashlib.sha256()
+                mode = 'wb'
+                validator['value'] = self._validator(response)
+
+            content_length = response.headers.get('Content-Length')
+            expected_size = offset + int(content_length) if content_length and 'Content-Encoding' not in response.headers else None
+            if self.max_bytes and expected_size is not None and expected_size > self.max_bytes:
+                raise DownloadTooLarge(f"文件过大: {expected_size}字节，上限{self.max_bytes}字节")
+
+            size = offset
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+                        if self.max_bytes and size > self.max_bytes:
+                            raise DownloadTooLarge(f"文件过大: 超过上限{self.max_bytes}字节")
+
+            if expected_size is not None and size != expected_size:
+                raise IOError(f"下载不完整: 期望{expected_size}字节，实际{size}字节")
+
+            return sha256.hexdigest(), size, response.headers.get('Content-Type')
+
+    def download(self, url, save_path, expected_sha256=None, expected_size=None):
+        """流式下载url到save_path，成功返回文件信息字典，失败返回None"""
+        part_path = f"{save_path}.part"
+        save_dir = os.path.dirname(save_path)
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+
+        last_error = None
+        validator = {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                digest, size, content_type = self._fetch(url, part_path, validator)
+
+                if expected_size is not None and size != expected_size:
+                    raise IOError(f"文件大小不匹配: 期望{expected_size}字节，实际{size}字节")
+                if expected_sha256 and digest != expected_sha256.lower():
+                    # 校验失败的数据不能用于续传
+                    os.remove(part_path)
+                    raise IOError(f"校验和不匹配: {digest}")
+
+                os.replace(part_path, save_path)
+                self.downloaded_files += 1
+                self.downloaded_bytes += size
+                return {'path': save_path, 'sha256': digest, 'size': size, 'content_type': content_type}
+
+            except DownloadTooLarge as e:
+                last_error = e
+                break
+            except Exception as e:
+                last_error = e
+                status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status_code and 400 <= status_code < 500 and status_code not in (408, 429):
+                    # 客户端错误（如链接失效）重试无意义
+                    break
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_delay * (2 ** attempt))
+
+        self.failed_count += 1
+        logger.error(f"Error downloading {url}: {last_error}")
+        try:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        except OSError:
+            pass
+        return None
+
+    def submit(self, url, save_path, **kwargs):
+        """在下载线程池中下载，返回Future"""
+        return self.executor.submit(self.download, url, save_path, **kwargs)
+
+    def download_all(self, items):
+        """并行下载 [(url, save_path), ...]，按输入顺序返回结果（失败项为None）"""
+        futures = [self.submit(url, save_path) for url, save_path in items]
+        return [future.result() for future in futures]
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_download_manager():
+    """返回进程内共享的下载管理器"""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = DownloadManager.from_env()
+    return _manager
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+上游服务模拟器（配合 loadtest.py 压测用）
+在本地模拟 RunningHub / 火山引擎 / 拍我AI 的接口，不消耗真实API额度。
+请求延迟、任务排队和运行时长按配置的分布随机生成，同时未完成的任务数超过上限时返回TASK_QUEUE_MAXED，
+并可按概率注入HTTP 500、请求挂起（超时）和任务失败。任务状态按提交时间推算，不需要后台线程。
+
+用法:
+    python fake_upstream_server.py
+    RUNNINGHUB_BASE_URL=http://127.0.0.1:9100 \\
+    VOLCENGINE_3D_BASE_URL=http://127.0.0.1:9100/api/v3/contents/generations/tasks \\
+    PAI_VIDEO_BASE_URL=http://127.0.0.1:9100 \\
+    RUNNINGHUB_API_KEY=fake RUNNINGHUB_WEBAPP_ID=1 RUNNINGHUB_COLOR_WEBAPP_ID=2 RUNNINGHUB_3D_WEBAPP_ID=3 \\
+    python hairstyle_proxy_server.py
+
+环境变量:
+    FAKE_UPSTREAM_PORT        监听端口，默认9100
+    FAKE_LATENCY              请求延迟分布，默认 lognormal:0.15,0.5
+    FAKE_LATENCY_<OP>         按请求类型覆盖（UPLOAD/RUN/STATUS/OUTPUTS/CANCEL/DOWNLOAD）
+    FAKE_QUEUE_SECONDS        任务排队时长分布，默认 uniform:0,5
+    FAKE_RUN_SECONDS          任务运行时长分布，默认 lognormal:20,0.3；可用 FAKE_RUN_SECONDS_<PROVIDER> 覆盖
+    FAKE_QUEUE_LIMIT          每个服务商同时未完成的任务数上限，0表示不限，默认20
+    FAKE_ERROR_RATE           请求直接返回HTTP 500的概率，可用 FAKE_ERROR_RATE_<OP> 覆盖
+    FAKE_HANG_RATE            请求挂起 FAKE_HANG_SECONDS（默认130秒）后才返回的概率
+    FAKE_FAILURE_RATE         任务最终失败的概率
+    FAKE_OUTPUT_COUNT         RunningHub图片任务的输出文件数，默认1
+    RUNNINGHUB_3D_WEBAPP_ID   该应用的RunningHub任务输出mp4，其余输出png
+
+分布写法: fixed:<秒> / uniform:<最小>,<最大> / lognormal:<中位数>,<sigma> / exponential:<均值>
+"""
+
+import io
+import os
+import math
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+
+from flask import Flask, request, jsonify, Response
+from PIL import Image
+
+OPERATIONS = ('upload', 'run', 'status', 'outputs', 'cancel', 'download')
+PROVIDERS = ('runninghub', 'volcengine', 'pai')
+
+
+def parse_distribution(spec):
+    """把分布写法解析成无参采样函数"""
+    kind, _, args = spec.strip().partition(':')
+    values = [float(value) for value in args.split(',') if value.strip()]
+    kind = kind.strip().lower()
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        mu = math.log(values[0]) if values[0] > 0 else 0.0
+        return lambda: random.lognormvariate(mu, values[1]) if values[0] > 0 else 0.0
+    if kind == 'exponential':
+        return lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"不支持的分布: {spec}")
+
+
+def _env_rate(name, default='0'):
+    return max(0.0, min(1.0, float(os.environ.get(name, default))))
+
+
+class FakeTask:
+    """模拟任务：状态由提交后经过的时间决定"""
+
+    def __init__(self, provider, queue_seconds, run_seconds, will_fail, output_count=1, output_ext='mp4'):
+        self.task_id = uuid.uuid4().hex
+        self.provider = provider
+        self.output_ext = output_ext
+        self.created_at = time.monotonic()
+        self.queue_seconds = queue_seconds
+        self.run_seconds = run_seconds
+        self.will_fail = will_fail
+        self.output_count = output_count
+        self.cancelled = False
+
+    def status(self, now=None):
+        if self.cancelled:
+            return 'CANCELLED'
+        elapsed = (now or time.monotonic()) - self.created_at
+        if elapsed < self.queue_seconds:
+            return 'QUEUED'
+        if elapsed < self.queue_seconds + self.run_seconds:
+            return 'RUNNING'
+        return 'FAILED' if self.will_fail else 'SUCCESS'
+
+    def remaining_seconds(self, now=None):
+        elapsed = (now or time.monotonic()) - self.created_at
+        return max(0.0, self.queue_seconds + self.run_seconds - elapsed)
+
+    @property
+    def active(self):
+        return self.status() in ('QUEUED', 'RUNNING')
+
+
+class FakeUpstream:
+    """模拟器状态：任务表、队列上限、注入规则和请求统计"""
+
+    def __init__(self, latency, queue_seconds, run_seconds, queue_limit=20, error_rates=None,
+                 hang_rate=0.0, hang_seconds=130.0, failure_rate=0.0, output_count=1):
+        self.latency = latency              # op -> 采样函数
+        self.queue_seconds = queue_seconds
+        self.run_seconds = run_seconds      # provider -> 采样函数
+        self.queue_limit = queue_limit
+        self.error_rates = error_rates or {}
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.failure_rate = failure_rate
+        self.output_count = output_count
+        self.tasks = {}
+        self.uploads = 0
+        self.requests = Counter()
+        self.injected = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        default_latency = os.environ.get('FAKE_LATENCY', 'lognormal:0.15,0.5')
+        default_run = os.environ.get('FAKE_RUN_SECONDS', 'lognormal:20,0.3')
+        default_error_rate = os.environ.get('FAKE_ERROR_RATE', '0')
+        return cls(
+            latency={
+                op: parse_distribution(os.environ.get(f'FAKE_LATENCY_{op.upper()}', default_latency))
+                for op in OPERATIONS
+            },
+            queue_seconds=parse_distribution(os.environ.get('FAKE_QUEUE_SECONDS', 'uniform:0,5')),
+            run_seconds={
+                provider: parse_distribution(os.environ.get(f'FAKE_RUN_SECONDS_{provider.upper()}', default_run))
+                for provider in PROVIDERS
+            },
+            queue_limit=int(os.environ.get('FAKE_QUEUE_LIMIT', '20')),
+            error_rates={
+                op: _env_rate(f'FAKE_ERROR_RATE_{op.upper()}', default_error_rate) for op in OPERATIONS
+            },
+            hang_rate=_env_rate('FAKE_HANG_RATE'),
+            hang_seconds=float(os.environ.get('FAKE_HANG_SECONDS', '130')),
+            failure_rate=_env_rate('FAKE_FAILURE_RATE'),
+            output_count=int(os.environ.get('FAKE_OUTPUT_COUNT', '1')),
+        )
+
+    def delay(self, provider, op):
+        """模拟请求耗时和注入的故障；返回需要直接回复的错误响应，正常时返回None"""
+        with self._lock:
+            self.requests[(provider, op)] += 1
+        if random.random() < self.hang_rate:
+            with self._lock:
+                self.injected['hang'] += 1
+            time.sleep(self.hang_seconds)
+        time.sleep(self.latency[op]())
+        if random.random() < self.error_rates.get(op, 0.0):
+            with self._lock:
+                self.injected['http_500'] += 1
+            return jsonify({'error': 'injected failure'}), 500
+        return None
+
+    def submit(self, provider, output_ext='mp4'):
+        """新建任务；未完成任务数已达上限时返回None"""
+        with self._lock:
+            if self.queue_limit > 0:
+                active = sum(1 for task in self.tasks.values() if task.provider == provider and task.active)
+                if active >= self.queue_limit:
+                    self.injected['queue_maxed'] += 1
+                    return None
+            task = FakeTask(
+                provider,
+                self.queue_seconds(),
+                self.run_seconds[provider](),
+                random.random() < self.failure_rate,
+                self.output_count if output_ext == 'png' else 1,
+                output_ext,
+            )
+            self.tasks[task.task_id] = task
+            return task
+
+    def get(self, task_id):
+        with self._lock:
+            return self.tasks.get(str(task_id))
+
+    def next_upload_id(self):
+        with self._lock:
+            self.uploads += 1
+            return self.uploads
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            task_statuses = Counter((task.provider, task.status(now)) for task in self.tasks.values())
+            return {
+                'requests': {f'{provider}.{op}': count for (provider, op), count in sorted(self.requests.items())},
+                'injected': dict(self.injected),
+                'tasks': {f'{provider}.{status}': count for (provider, status), count in sorted(task_statuses.items())},
+                'uploads': self.uploads,
+            }
+
+
+def _render_image_bytes():
+    image = Image.new('RGB', (512, 768), (180, 140, 110))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# 结果文件内容固定，只模拟传输
+OUTPUT_IMAGE = _render_image_bytes()
+OUTPUT_VIDEO = b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom' + b'\x00' * (512 * 1024)
+
+# 与代理服务使用同一个环境变量，该应用的任务输出视频
+RUNNINGHUB_3D_WEBAPP_ID = str(os.environ.get('RUNNINGHUB_3D_WEBAPP_ID'))
+
+app = Flask(__name__)
+upstream = FakeUpstream.from_env()
+
+
+def _file_url(task, index):
+    return f"{request.host_url.rstrip('/')}/files/{task.task_id}_{index}.{task.output_ext}"
+
+
+def _runninghub_reply(data=None, code=0, msg='success'):
+    return jsonify({'code': code, 'msg': msg, 'data': data})
+
+
+# ---------------- RunningHub ----------------
+
+@app.route('/task/openapi/upload', methods=['POST'])
+def runninghub_upload():
+    injected = upstream.delay('runninghub', 'upload')
+    if injected:
+        return injected
+    if 'file' not in request.files:
+        return _runninghub_reply(code=400, msg='PARAMS_INVALID')
+    request.files['file'].read()
+    return _runninghub_reply({'fileName': f'api/{uuid.uuid4().hex}.png', 'fileType': 'image'})
+
+
+@app.route('/task/openapi/ai-app/run', methods=['POST'])
+def runninghub_run():
+    injected = upstream.delay('runninghub', 'run')
+    if injected:
+        return injected
+    webapp_id = str((request.get_json(silent=True) or {}).get('webappId'))
+    task = upstream.submit('runninghub', 'mp4' if webapp_id == RUNNINGHUB_3D_WEBAPP_ID else 'png')
+    if task is None:
+        return _runninghub_reply(code=421, msg='TASK_QUEUE_MAXED')
+    return _runninghub_reply({'taskId': task.task_id, 'taskStatus': 'QUEUED', 'clientId': 'fake'})
+
+
+@app.route('/task/openapi/status', methods=['POST'])
+def runninghub_status():
+    injected = upstream.delay('runninghub', 'status')
+    if injected:
+        return injected
+    task = upstream.get((request.get_json(silent=True) or {}).get('taskId'))
+    if task is None:
+        return _runninghub_reply(code=807, msg='APIKEY_TASK_NOT_FOUND')
+    return _runninghub_reply(task.status())
+
+
+@app.route('/task/openapi/outputs', methods=['POST'])
+def runninghub_outputs():
+    injected = upstream.delay('runninghub', 'outputs')
+    if injected:
+        return injected
+    task = upstream.get((request.get_json(silent=True) or {}).get('taskId'))
+    if task is None:
+        return _runninghub_reply(code=807, msg='APIKEY_TASK_NOT_FOUND')
+    status = task.status()
+    if status in ('QUEUED', 'RUNNING'):
+        return _runninghub_reply(code=804, msg='APIKEY_TASK_IS_RUNNING')
+    if status != 'SUCCESS':
+        return _runninghub_reply({'failedReason': {'exception_message': 'injected failure'}},
+                                 code=805, msg='APIKEY_TASK_STATUS_ERROR')
+    return _runninghub_reply([
+        {'fileUrl': _file_url(task, index), 'fileType': task.output_ext, 'taskCostTime': str(int(task.run_seconds))}
+        for index in range(task.output_count)
+    ])
+
+
+@app.route('/task/openapi/cancel', methods=['POST'])
+def runninghub_cancel():
+    injected = upstream.delay('runninghub', 'cancel')
+    if injected:
+        return injected
+    task = upstream.get((request.get_json(silent=True) or {}).get('taskId'))
+    if task is None:
+        return _runninghub_reply(code=807, msg='APIKEY_TASK_NOT_FOUND')
+    task.cancelled = True
+    return _runninghub_reply()
+
+
+# ---------------- 火山引擎 ----------------
+
+_VOLCENGINE_STATUS = {'QUEUED': 'queued', 'RUNNING': 'running', 'SUCCESS': 'succeeded',
+                      'FAILED': 'failed', 'CANCELLED': 'cancelled'}
+
+
+@app.route('/api/v3/contents/generations/tasks', methods=['POST'])
+def volcengine_submit():
+    injected = upstream.delay('volcengine', 'run')
+    if injected:
+        return injected
+    task = upstream.submit('volcengine')
+    if task is None:
+        return jsonify({'error': {'code': 'RateLimitExceeded.EndpointRPM', 'message': 'queue limit reached'}}), 429
+    return jsonify({'id': f'cgt-{task.task_id}'})
+
+
+@app.route('/api/v3/contents/generations/tasks/<task_id>', methods=['GET'])
+def volcengine_task(task_id):
+    injected = upstream.delay('volcengine', 'status')
+    if injected:
+        return injected
+    task = upstream.get(task_id.removeprefix('cgt-'))
+    if task is None:
+        return jsonify({'error': {'code': 'NotFound', 'message': 'task not found'}}), 404
+    status = task.status()
+    payload = {'id': task_id, 'status': _VOLCENGINE_STATUS[status]}
+    if status in ('QUEUED', 'RUNNING'):
+        payload['estimated_time'] = round(task.remaining_seconds(), 1)
+    elif status == 'SUCCESS':
+        payload['content'] = {'video_url': _file_url(task, 0)}
+    elif status == 'FAILED':
+        payload['error'] = {'code': 'InternalServiceError', 'message': 'injected failure'}
+    return jsonify(payload)
+
+
+# ---------------- 拍我AI ----------------
+
+_PAI_STATUS = {'QUEUED': 5, 'RUNNING': 5, 'SUCCESS': 1, 'FAILED': 8, 'CANCELLED': 8}
+
+
+def _pai_reply(resp=None, err_code=0, err_msg='success'):
+    return jsonify({'ErrCode': err_code, 'ErrMsg': err_msg, 'Resp': resp})
+
+
+@app.route('/openapi/v2/image/upload', methods=['POST'])
+def pai_upload():
+    injected = upstream.delay('pai', 'upload')
+    if injected:
+        return injected
+    if 'image' not in request.files:
+        return _pai_reply(err_code=400017, err_msg='invalid parameter')
+    request.files['image'].read()
+    upload_id = upstream.next_upload_id()
+    return _pai_reply({'img_id': upload_id, 'img_url': f"{request.host_url.rstrip('/')}/files/upload_{upload_id}.png"})
+
+
+@app.route('/openapi/v2/video/img/generate', methods=['POST'])
+def pai_generate():
+    injected = upstream.delay('pai', 'run')
+    if injected:
+        return injected
+    task = upstream.submit('pai')
+    if task is None:
+        return _pai_reply(err_code=500044, err_msg='reached the limit for concurrent generations')
+    return _pai_reply({'video_id': task.task_id})
+
+
+@app.route('/openapi/v2/video/result/<task_id>', methods=['GET'])
+def pai_result(task_id):
+    injected = upstream.delay('pai', 'status')
+    if injected:
+        return injected
+    task = upstream.get(task_id)
+    if task is None:
+        return _pai_reply(err_code=400018, err_msg='video not found')
+    status = task.status()
+    resp = {'id': task_id, 'status': _PAI_STATUS[status]}
+    if status in ('QUEUED', 'RUNNING'):
+        resp['estimated_time'] = round(task.remaining_seconds(), 1)
+    elif status == 'SUCCESS':
+        resp['url'] = _file_url(task, 0)
+    return _pai_reply(resp)
+
+
+# ---------------- 结果文件和统计 ----------------
+
+@app.route('/files/<name>')
+def output_file(name):
+    injected = upstream.delay('files', 'download')
+    if injected:
+        return injected
+    if name.endswith('.mp4'):
+        return Response(OUTPUT_VIDEO, mimetype='video/mp4')
+    return Response(OUTPUT_IMAGE, mimetype='image/png')
+
+
+@app.route('/stats')
+def stats():
+    """请求数、注入的故障数和各状态任务数"""
+    return jsonify(upstream.stats())
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('FAKE_UPSTREAM_PORT', '9100'))
+    print(f"上游服务模拟器监听 http://127.0.0.1:{port}")
+    app.run(host='0.0.0.0', port=port, threaded=True)
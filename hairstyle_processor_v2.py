@@ -1,13 +1,11 @@
-import http.client
+import logging
 import json
 import os
+import glob
 import mimetypes
 from codecs import encode
 import time
-import requests
 from datetime import datetime
-from docx import Document
-from docx.shared import Inches
 from PIL import Image, ExifTags
 import io
 import random
@@ -18,8 +16,22 @@ import base64
 import asyncio
 import hashlib
 import uuid
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from async_runtime import get_async_runtime, SingleFlight
+from image_utils import UploadImageTransformer
+from download_manager import get_download_manager
+from compositor import Compositor
+from report_builder import ReportBuilder
+from job_ledger import JobLedger, STATUS_UPLOADED, STATUS_SUBMITTED, STATUS_COMPLETED, STATUS_FAILED
+from video_providers import VideoTaskEngine
+from asset_registry import AssetRegistry, InvalidAssetError, is_invalid_asset_error
+from runninghub_client import RunningHubClient, DeadlineExceeded, current_deadline, remaining_time, request_not_sent
+from rolling_stats import RollingStats
+import metrics
+import tracing
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
 load_dotenv()
 
 
@@ -29,21 +41,21 @@ def ensure_data_directory():
     try:
         if not os.path.exists(data_dir):
             os.makedirs(data_dir, exist_ok=True)
-            print(f"创建数据目录: {data_dir}")
+            logger.info(f"创建数据目录: {data_dir}")
         
         # 检查目录权限
         if not os.access(data_dir, os.W_OK):
-            print(f"警告: 数据目录 {data_dir} 没有写权限")
+            logger.warning(f"警告: 数据目录 {data_dir} 没有写权限")
         else:
-            print(f"数据目录就绪: {data_dir}")
+            logger.debug(f"数据目录就绪: {data_dir}")
             
         return data_dir
     except Exception as e:
-        print(f"初始化数据目录失败: {e}")
+        logger.error(f"初始化数据目录失败: {e}")
         # 回退到当前目录
         fallback_dir = os.path.join(os.getcwd(), 'data')
         os.makedirs(fallback_dir, exist_ok=True)
-        print(f"使用回退数据目录: {fallback_dir}")
+        logger.info(f"使用回退数据目录: {fallback_dir}")
         return fallback_dir
 
 def env_bool(name, default=False):
@@ -115,24 +127,46 @@ class HairstyleProcessor:
         # 从环境变量获取OpenRouter API密钥（用于Gemini预处理）
         self.openrouter_api_key = os.environ.get('OPENROUTER_API_KEY')
 
-        self.host = "www.runninghub.cn"
+        # RunningHub请求（连接池、时间预算、幂等请求对冲），地址可用RUNNINGHUB_BASE_URL修改
+        self.runninghub = RunningHubClient.from_env()
+        self.host = self.runninghub.host
         self.results = []
         self.results_lock = threading.Lock()
         self.max_workers = max_workers
         self.task_timeout = task_timeout  # 每个任务的超时时间（秒），默认600秒
 
         # 添加时间统计变量
-        self.task_times = []  # 存储每次run_hairstyle_task的运行时间
+        self.task_times = RollingStats()  # 任务提交耗时（最近样本 + 均值/方差/分位数，内存固定）
         self.task_count = 0   # 任务总数统计
 
         # Gemini预处理统计
-        self.gemini_times = []  # 存储Gemini预处理时间
+        self.gemini_times = RollingStats()  # Gemini预处理耗时
         self.gemini_success_count = 0  # 成功预处理数量
         self.gemini_fail_count = 0     # 失败预处理数量
+        self.gemini_coalesced_count = 0  # 合并到进行中请求的数量
+
+        # 进行中的Gemini请求合并（单飞），提示词变更时需同步修改版本号
+        self.gemini_prompt_version = os.environ.get('GEMINI_PROMPT_VERSION', 'v1')
+        self.gemini_flights = SingleFlight()
 
         # 超时统计
         self.timeout_count = 0  # 超时任务数量
 
+        # 上传前图片缩放/重编码（Gemini和RunningHub/拍我AI上传共用，按内容哈希缓存）
+        self.upload_transformer = UploadImageTransformer.from_env(os.path.join(self.data_dir, "upload_cache"))
+
+        # 拼接图合成（进程池，输出格式/质量由COMPOSITE_*环境变量配置）
+        self.compositor = Compositor.from_env()
+
+        # 批处理任务账本，在批处理入口中按需打开
+        self.ledger = None
+
+        # 3D视频服务商（异步客户端 + 按预计耗时调度的轮询）
+        self.video_engine = VideoTaskEngine.from_env(self)
+
+        # 已上传图片登记（按内容哈希复用各服务商的上传结果）
+        self.asset_registry = AssetRegistry.from_env()
+
     def is_volcengine_3d_enabled(self):
         """Whether Volcengine 3D generation is configured."""
         return bool(self.volcengine_ark_api_key)
@@ -172,7 +206,7 @@ class HairstyleProcessor:
                 return 'volcengine' if self.is_volcengine_3d_enabled() else None
             if selected == 'runninghub':
                 return 'runninghub' if self.is_runninghub_3d_enabled() else None
-            print(f"Unknown VIDEO_3D_PROVIDER '{self.video_3d_provider}', falling back to auto selection")
+            logger.warning(f"Unknown VIDEO_3D_PROVIDER '{self.video_3d_provider}', falling back to auto selection")
 
         if self.is_pai_3d_enabled():
             return 'pai'
@@ -182,6 +216,21 @@ class HairstyleProcessor:
             return 'runninghub'
         return None
 
+    def enabled_3d_providers(self):
+        """All configured 3D providers."""
+        enabled = (
+            ('pai', self.is_pai_3d_enabled()),
+            ('volcengine', self.is_volcengine_3d_enabled()),
+            ('runninghub', self.is_runninghub_3d_enabled()),
+        )
+        return [name for name, is_enabled in enabled if is_enabled]
+
+    def rank_3d_providers(self):
+        """Healthy 3D providers in routing order (circuit-open providers are skipped)."""
+        configured = (self.video_3d_provider or 'auto').strip().lower()
+        preferred = None if configured == 'auto' else self.get_3d_provider()
+        return self.video_engine.rank_providers(self.enabled_3d_providers(), preferred=preferred)
+
     def should_use_volcengine_for_3d(self):
         """Prefer Volcengine for 3D when configured, keep RunningHub as fallback."""
         return self.get_3d_provider() == 'volcengine'
@@ -203,14 +252,14 @@ class HairstyleProcessor:
     def _extract_pai_response(self, payload, operation_name):
         """Return the Resp object from a successful Pai AI response."""
         if not isinstance(payload, dict):
-            print(f"Pai AI {operation_name} returned non-object response: {payload}")
+            logger.warning(f"Pai AI {operation_name} returned non-object response: {payload}")
             return None
 
         err_code = payload.get("ErrCode")
         if str(err_code) == "0":
             return payload.get("Resp") or {}
 
-        print(f"Pai AI {operation_name} failed: {payload}")
+        logger.error(f"Pai AI {operation_name} failed: {payload}")
         return None
 
     def _normalize_pai_task_status(self, status):
@@ -231,148 +280,31 @@ class HairstyleProcessor:
             return "PENDING"
         return normalized
 
+    def get_video_provider(self, provider_name=None):
+        """Return the async video provider client, defaulting to the active 3D provider."""
+        return self.video_engine.provider(provider_name or self.get_3d_provider() or 'runninghub')
+
     def upload_image_to_pai(self, image_path):
         """Upload a local image to Pai AI and return its img_id."""
         if not self.pai_video_api_key:
             raise ValueError("Pai AI API key is required. Set PAI_VIDEO_API_KEY.")
         if not image_path:
             raise ValueError("image_path is required for Pai AI image upload.")
+        return self.video_engine.run(self.get_video_provider('pai').upload_image(image_path))
 
-        upload_url = f"{self.pai_video_base_url}/openapi/v2/image/upload"
-        file_type = mimetypes.guess_type(image_path)[0] or "image/jpeg"
-
-        try:
-            with open(image_path, "rb") as image_file:
-                files = {
-                    "image": (os.path.basename(image_path), image_file, file_type)
-                }
-                response = requests.post(
-                    upload_url,
-                    headers=self._pai_headers(),
-                    files=files,
-                    timeout=self.pai_video_upload_timeout
-                )
-            response.raise_for_status()
-            result = response.json()
-            resp = self._extract_pai_response(result, "image upload")
-            if not resp:
-                return None
-
-            img_id = resp.get("img_id")
-            if img_id is None:
-                print(f"Pai AI image upload response missing img_id: {result}")
-                return None
-
-            print(f"Pai AI image upload successful for {image_path}: img_id={img_id}")
-            return img_id
-        except Exception as e:
-            print(f"Error uploading image to Pai AI: {e}")
-            return None
-
-    def run_3d_task_with_pai(self, image_path, cancel_check_func=None):
+    def run_3d_task_with_pai(self, image_path, cancel_check_func=None, callback_url=None):
         """Create a Pai AI image-to-video task and return its video ID."""
-        if not self.pai_video_api_key:
-            raise ValueError("Pai AI API key is required. Set PAI_VIDEO_API_KEY.")
-        if not image_path:
-            raise ValueError("image_path is required for Pai AI image-to-video generation.")
-
-        if cancel_check_func and cancel_check_func():
-            print("3D任务在拍我AI图片上传前被取消")
-            return None
-
-        img_id = self.upload_image_to_pai(image_path)
-        if img_id is None:
-            return None
-
-        if cancel_check_func and cancel_check_func():
-            print("3D任务在拍我AI生成提交前被取消")
-            return None
-
-        payload = {
-            "duration": self.pai_video_duration,
-            "img_id": img_id,
-            "model": self.pai_video_model,
-            "template_id": self.pai_video_template_id,
-            "motion_mode": self.pai_video_motion_mode,
-            "negative_prompt": self.pai_video_negative_prompt,
-            "prompt": self.pai_video_prompt,
-            "quality": self.pai_video_quality,
-            "seed": self.pai_video_seed,
-            "generate_audio_switch": self.pai_video_generate_audio,
-            "generate_multi_clip_switch": self.pai_video_generate_multi_clip,
-        }
-        if self.pai_video_style:
-            payload["style"] = self.pai_video_style
-        if self.pai_video_camera_movement:
-            payload["camera_movement"] = self.pai_video_camera_movement
-
-        try:
-            response = requests.post(
-                f"{self.pai_video_base_url}/openapi/v2/video/img/generate",
-                json=payload,
-                headers=self._pai_headers(include_json_content_type=True),
-                timeout=120
-            )
-            response.raise_for_status()
-            result = response.json()
-            resp = self._extract_pai_response(result, "image-to-video generation")
-            if not resp:
-                return None
-
-            video_id = resp.get("video_id")
-            if video_id is None:
-                print(f"Pai AI video generation response missing video_id: {result}")
-                return None
-
-            print(f"Pai AI 3D task started successfully: {video_id}")
-            return str(video_id)
-        except Exception as e:
-            print(f"Error running Pai AI 3D task: {e}")
-            return None
+        return self.video_engine.run(
+            self.video_engine.submit('pai', image_path, cancel_check_func, callback_url)
+        )
 
     def check_3d_task_status_with_pai(self, task_id):
         """Check Pai AI image-to-video task status."""
-        headers = self._pai_headers()
-        try:
-            response = requests.get(
-                f"{self.pai_video_base_url}/openapi/v2/video/result/{task_id}",
-                headers=headers,
-                timeout=120
-            )
-            response.raise_for_status()
-            result = response.json()
-            resp = self._extract_pai_response(result, "video status")
-            if resp is None:
-                return None
-            return self._normalize_pai_task_status(resp.get("status"))
-        except Exception as e:
-            print(f"Error checking Pai AI 3D task status for {task_id}: {e}")
-            return None
+        return self.check_3d_task_status(task_id, provider_name='pai')
 
     def get_3d_task_results_with_pai(self, task_id):
         """Get Pai AI image-to-video task outputs."""
-        headers = self._pai_headers()
-        try:
-            response = requests.get(
-                f"{self.pai_video_base_url}/openapi/v2/video/result/{task_id}",
-                headers=headers,
-                timeout=120
-            )
-            response.raise_for_status()
-            result = response.json()
-            resp = self._extract_pai_response(result, "video result")
-            if resp is None:
-                return None
-
-            video_url = resp.get("url")
-            if not video_url:
-                print(f"Pai AI 3D task has no video URL yet: {result}")
-                return []
-
-            return [{"fileUrl": video_url, "fileType": "video"}]
-        except Exception as e:
-            print(f"Error getting Pai AI 3D task results for {task_id}: {e}")
-            return None
+        return self.get_3d_task_results(task_id, provider_name='pai')
 
     def _normalize_volcengine_task_status(self, status):
         """Map Volcengine task statuses to the values used by the existing flow."""
@@ -454,131 +386,46 @@ class HairstyleProcessor:
 
         return deduped_results
 
-    def run_3d_task_with_volcengine(self, image_url, cancel_check_func=None):
+    def run_3d_task_with_volcengine(self, image_url, cancel_check_func=None, callback_url=None):
         """Create a Volcengine image-to-video task and return its task ID."""
-        if not self.volcengine_ark_api_key:
-            raise ValueError("ARK API key is required. Set ARK_API_KEY or VOLCENGINE_ARK_API_KEY.")
-        if not image_url:
-            raise ValueError("image_url is required for Volcengine 3D generation.")
-
-        if cancel_check_func and cancel_check_func():
-            print("3D任务在火山引擎提交前被取消")
-            return None
-
-        payload = {
-            "model": self.volcengine_3d_model,
-            "content": [
-                {
-                    "type": "text",
-                    "text": self.volcengine_3d_prompt
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_url
-                    }
-                }
-            ],
-            "ratio": self.volcengine_3d_ratio,
-            "duration": self.volcengine_3d_duration,
-            "resolution": self.volcengine_3d_resolution
-        }
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.volcengine_ark_api_key}"
-        }
-
-        try:
-            response = requests.post(
-                self.volcengine_3d_base_url,
-                json=payload,
-                headers=headers,
-                timeout=120
-            )
-            response.raise_for_status()
-            result = response.json()
-            task_id = result.get("id")
-            if not task_id and isinstance(result.get("data"), dict):
-                task_id = result["data"].get("id")
-
-            if task_id:
-                print(f"Volcengine 3D task started successfully: {task_id}")
-                return task_id
-
-            print(f"Volcengine 3D task start response missing id: {result}")
-            return None
-        except Exception as e:
-            print(f"Error running Volcengine 3D task: {e}")
-            return None
-
-    def check_3d_task_status(self, task_id):
-        """Check 3D task status for the active provider."""
-        if self.should_use_pai_for_3d():
-            return self.check_3d_task_status_with_pai(task_id)
-
-        if self.should_use_volcengine_for_3d():
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.volcengine_ark_api_key}"
-            }
-            try:
-                response = requests.get(
-                    f"{self.volcengine_3d_base_url}/{task_id}",
-                    headers=headers,
-                    timeout=120
-                )
-                response.raise_for_status()
-                result = response.json()
-                return self._normalize_volcengine_task_status(self._extract_volcengine_task_status(result))
-            except Exception as e:
-                print(f"Error checking Volcengine 3D task status for {task_id}: {e}")
-                return None
-
-        return self.check_task_status(task_id)
-
-    def get_3d_task_results(self, task_id):
-        """Get 3D task outputs for the active provider."""
-        if self.should_use_pai_for_3d():
-            return self.get_3d_task_results_with_pai(task_id)
-
-        if self.should_use_volcengine_for_3d():
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.volcengine_ark_api_key}"
-            }
-            try:
-                response = requests.get(
-                    f"{self.volcengine_3d_base_url}/{task_id}",
-                    headers=headers,
-                    timeout=120
-                )
-                response.raise_for_status()
-                result = response.json()
-                outputs = self._extract_volcengine_video_results(result)
-                if not outputs:
-                    print(f"Volcengine 3D task has no video outputs yet: {result}")
-                return outputs
-            except Exception as e:
-                print(f"Error getting Volcengine 3D task results for {task_id}: {e}")
-                return None
-
-        return self.get_task_results(task_id)
-
-    def cancel_3d_task(self, task_id):
-        """Cancel 3D task for the active provider."""
-        if self.should_use_pai_for_3d():
-            print(f"Pai AI 3D task cancellation is not implemented for task: {task_id}")
-            return False
-
-        if self.should_use_volcengine_for_3d():
-            print(f"Volcengine 3D task cancellation is not implemented for task: {task_id}")
-            return False
+        return self.video_engine.run(
+            self.video_engine.submit('volcengine', image_url, cancel_check_func, callback_url)
+        )
 
-        return self.cancel_task(task_id)
+    def check_3d_task_status(self, task_id, provider_name=None):
+        """Check 3D task status for the active provider (or the provider the task was submitted to)."""
+        return self.video_engine.run(self.get_video_provider(provider_name).poll(task_id)).status
+
+    def get_3d_task_results(self, task_id, provider_name=None):
+        """Get 3D task outputs for the active provider (or the provider the task was submitted to)."""
+        return self.video_engine.run(self.get_video_provider(provider_name).get_results(task_id))
+
+    def cancel_3d_task(self, task_id, provider_name=None):
+        """Cancel 3D task for the active provider (or the provider the task was submitted to)."""
+        return self.video_engine.run(self.get_video_provider(provider_name).cancel(task_id))
+
+    def wait_for_3d_task(self, task_id, provider_name=None, timeout=600, cancel_check_func=None,
+                         has_callback=False, on_status=None, deadline_bound=False):
+        """Wait for a 3D task to finish.
+
+        Polls on a schedule driven by the provider's ETA hints / observed durations instead of a
+        fixed interval; a provider callback (see VideoTaskEngine.notify) triggers an immediate poll.
+        Returns SUCCESS / FAILED / CANCELLED, or TIMEOUT / CANCEL_REQUESTED. Pass
+        deadline_bound=True when the timeout was cut short by the session deadline, so a
+        TIMEOUT does not count against the provider's latency estimate or circuit breaker.
+        """
+        provider_name = provider_name or self.get_3d_provider() or 'runninghub'
+        return self.video_engine.run(self.video_engine.wait(
+            provider_name, task_id, timeout=timeout, cancel_check_func=cancel_check_func,
+            has_callback=has_callback, on_status=on_status, deadline_bound=deadline_bound
+        ))
 
     def encode_image(self, image_path):
         """将图像编码为base64字符串，自动处理EXIF方向"""
+        if self.upload_transformer.enabled:
+            # 上传前变换已处理EXIF方向和尺寸，直接读取缓存结果
+            return self.upload_transformer.encode_base64(image_path)
+
         try:
             # 使用PIL打开图像并自动处理EXIF方向
             with Image.open(image_path) as img:
@@ -598,11 +445,17 @@ class HairstyleProcessor:
                 return base64.b64encode(buffer.getvalue()).decode('utf-8')
 
         except Exception as e:
-            print(f"处理图像EXIF方向失败，使用原始方法: {e}")
+            logger.warning(f"处理图像EXIF方向失败，使用原始方法: {e}")
             # 回退到原始方法
             with open(image_path, "rb") as image_file:
                 return base64.b64encode(image_file.read()).decode('utf-8')
 
+    def encode_data_url(self, image_path):
+        """将图像编码为data URL，MIME类型与实际发送的编码一致"""
+        if self.upload_transformer.enabled:
+            return self.upload_transformer.encode_data_url(image_path)
+        return f"data:image/jpeg;base64,{self.encode_image(image_path)}"
+
     def fix_image_orientation(self, img):
         """根据EXIF信息修正图像方向"""
         try:
@@ -635,7 +488,7 @@ class HairstyleProcessor:
                                 img = img.rotate(90, expand=True)
                             break
             except Exception as e:
-                print(f"修正图像方向失败: {e}")
+                logger.error(f"修正图像方向失败: {e}")
 
         return img
 
@@ -648,7 +501,7 @@ class HairstyleProcessor:
                     hash_md5.update(chunk)
             return hash_md5.hexdigest()
         except Exception as e:
-            print(f"计算文件哈希失败: {e}")
+            logger.error(f"计算文件哈希失败: {e}")
             return None
 
     def save_image_from_base64(self, base64_str, original_path, image_type, file_hash):
@@ -675,7 +528,7 @@ class HairstyleProcessor:
 
             return filepath
         except Exception as e:
-            print(f"保存图片时出错: {e}")
+            logger.error(f"保存图片时出错: {e}")
             return None
 
     def update_cache_index(self, original_path, processed_path, file_hash, image_type):
@@ -706,7 +559,7 @@ class HairstyleProcessor:
                 json.dump(cache_index, f, ensure_ascii=False, indent=2)
 
         except Exception as e:
-            print(f"更新缓存索引失败: {e}")
+            logger.error(f"更新缓存索引失败: {e}")
 
     def get_cached_processed_path(self, original_path, image_type):
         """基于文件哈希检查是否已有缓存的预处理图片"""
@@ -747,88 +600,113 @@ class HairstyleProcessor:
             return None
 
         except Exception as e:
-            print(f"检查缓存失败: {e}")
+            logger.error(f"检查缓存失败: {e}")
             return None
 
     async def preprocess_image_with_gemini(self, image_path, image_type="user"):
-        """使用Gemini对图像进行预处理（异步版本）"""
-        thread_name = threading.current_thread().name
-        start_time = time.time()
-
+        """使用Gemini对图像进行预处理（异步版本，需在共享事件循环中运行）"""
         try:
-            print(f"[{thread_name}] 开始Gemini预处理{image_type}图像: {os.path.basename(image_path)}")
+            logger.info(f"开始Gemini预处理{image_type}图像: {os.path.basename(image_path)}")
 
-            # 检查缓存（基于文件哈希）
-            cached_path = self.get_cached_processed_path(image_path, image_type)
+            # 检查缓存（基于文件哈希），文件读取放到线程池避免阻塞共享事件循环
+            cached_path = await asyncio.to_thread(self.get_cached_processed_path, image_path, image_type)
+            metrics.count_cache('gemini', cached_path is not None)
             if cached_path:
-                print(f"[{thread_name}] ✓ 找到缓存的{image_type}图像: {os.path.basename(cached_path)}")
+                logger.info(f"✓ 找到缓存的{image_type}图像: {os.path.basename(cached_path)}")
                 return cached_path
 
             if not self.openrouter_api_key:
-                print(f"[{thread_name}] 未设置OPENROUTER_API_KEY，跳过Gemini预处理")
+                logger.warning("未设置OPENROUTER_API_KEY，跳过Gemini预处理")
                 self.gemini_fail_count += 1
                 return image_path
 
             # 计算文件哈希（用于保存时的文件命名）
-            file_hash = self.get_file_hash(image_path)
+            file_hash = await asyncio.to_thread(self.get_file_hash, image_path)
             if not file_hash:
-                print(f"[{thread_name}] 无法计算文件哈希，跳过预处理")
+                logger.warning("无法计算文件哈希，跳过预处理")
                 self.gemini_fail_count += 1
                 return image_path
 
-            base64_image = self.encode_image(image_path)
+            # 相同内容、相同类型、相同提示词版本的并发请求只调用一次Gemini
+            flight_key = (file_hash, image_type, self.gemini_prompt_version)
+            processed_path, coalesced = await self.gemini_flights.do(
+                flight_key,
+                lambda: self._run_gemini_preprocess(image_path, image_type, file_hash)
+            )
+            if coalesced:
+                self.gemini_coalesced_count += 1
+                logger.info(f"复用进行中的Gemini预处理请求: {os.path.basename(image_path)}")
 
-            async with AsyncOpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=self.openrouter_api_key,
-            ) as client:
+            return processed_path or image_path
 
-                # 根据图片类型设置不同的提示语
-                if image_type == "user":
-                    prompt_text = "保持人物一致性，保持服饰和发型不变，身材不要太胖，改为半身证件照，光线充足，露出黑色腰带。"
-                elif image_type == "hairstyle":
-                    prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
-                else:
-                    prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
-
-                completion = await client.chat.completions.create(
-                    model="google/gemini-2.5-flash-image-preview",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": prompt_text
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
-                                    }
+        except Exception as e:
+            logger.error(f"Gemini预处理出错: {e}")
+            logger.info("使用原图继续处理...")
+            self.gemini_fail_count += 1
+            return image_path
+
+    async def _run_gemini_preprocess(self, image_path, image_type, file_hash):
+        """实际调用Gemini完成预处理，成功返回处理后的路径，失败返回None"""
+        start_time = time.time()
+
+        try:
+            # 等待期间可能已有其他请求写入了缓存
+            cached_path = await asyncio.to_thread(self.get_cached_processed_path, image_path, image_type)
+            if cached_path:
+                return cached_path
+
+            image_data_url = await asyncio.to_thread(self.encode_data_url, image_path)
+
+            # 复用共享的AsyncOpenAI客户端（长连接池），不再每张图片新建客户端
+            client = await get_async_runtime().get_openrouter_client(self.openrouter_api_key)
+
+            # 根据图片类型设置不同的提示语
+            if image_type == "user":
+                prompt_text = "保持人物一致性，保持服饰和发型不变，身材不要太胖，改为半身证件照，光线充足，露出黑色腰带。"
+            elif image_type == "hairstyle":
+                prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
+            else:
+                prompt_text = "保持人物一致性，保持服饰和发型发色不变，保持发型纹理清晰，光照条件与原图一致，改为半身证件照，露出黑色腰带。"
+
+            completion = await client.chat.completions.create(
+                model="google/gemini-2.5-flash-image-preview",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": prompt_text
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": image_data_url
                                 }
-                            ]
-                        }
-                    ]
-                )
+                            }
+                        ]
+                    }
+                ]
+            )
 
-                end_time = time.time()
-                elapsed = end_time - start_time
-                self.gemini_times.append(elapsed)
-                print(f"[{thread_name}] Gemini预处理{image_type}耗时: {elapsed:.2f}秒")
+            end_time = time.time()
+            elapsed = end_time - start_time
+            self.gemini_times.append(elapsed)
+            logger.info(f"Gemini预处理{image_type}耗时: {elapsed:.2f}秒")
 
-                return await self.process_gemini_response(completion, image_path, image_type, file_hash, thread_name, client, prompt_text, base64_image, attempt=1)
+            result_path = await self.process_gemini_response(completion, image_path, image_type, file_hash, client, prompt_text, image_data_url, attempt=1)
+            return None if result_path == image_path else result_path
 
         except Exception as e:
             end_time = time.time()
             elapsed = end_time - start_time
             self.gemini_times.append(elapsed)
-            print(f"[{thread_name}] Gemini预处理出错: {e}")
-            print(f"[{thread_name}] 使用原图继续处理...")
+            logger.error(f"Gemini预处理出错: {e}")
+            logger.info("使用原图继续处理...")
             self.gemini_fail_count += 1
-            return image_path
+            return None
 
-    async def process_gemini_response(self, completion, image_path, image_type, file_hash, thread_name, client, prompt_text, base64_image, attempt=1):
+    async def process_gemini_response(self, completion, image_path, image_type, file_hash, client, prompt_text, image_data_url, attempt=1):
         """处理Gemini API响应，包含重试机制"""
         max_retries = 2  # 最多重试1次，总共2次尝试
 
@@ -838,7 +716,8 @@ class HairstyleProcessor:
 
             if image_url.startswith("data:image/"):
                 base64_data = image_url.split(",")[1]
-                processed_image_path = self.save_image_from_base64(
+                processed_image_path = await asyncio.to_thread(
+                    self.save_image_from_base64,
                     base64_data,
                     image_path,    # 原始路径
                     image_type,    # 图像类型
@@ -846,21 +725,21 @@ class HairstyleProcessor:
                 )
 
                 if processed_image_path:
-                    print(f"[{thread_name}] ✓ Gemini{image_type}预处理成功: {os.path.basename(processed_image_path)}")
+                    logger.info(f"✓ Gemini{image_type}预处理成功: {os.path.basename(processed_image_path)}")
                     self.gemini_success_count += 1
                     return processed_image_path
                 else:
-                    print(f"[{thread_name}] 保存失败，使用原图")
+                    logger.warning("保存失败，使用原图")
                     self.gemini_fail_count += 1
                     return image_path
             else:
-                print(f"[{thread_name}] 非base64格式URL，使用原图")
+                logger.info("非base64格式URL，使用原图")
                 self.gemini_fail_count += 1
                 return image_path
         else:
             # 响应中无图片数据，尝试重试
             if attempt < max_retries:
-                print(f"[{thread_name}] 响应中无图片数据，进行第{attempt + 1}次尝试...")
+                logger.info(f"响应中无图片数据，进行第{attempt + 1}次尝试...")
                 try:
                     # 等待一小段时间再重试
                     await asyncio.sleep(1)
@@ -879,7 +758,7 @@ class HairstyleProcessor:
                                     {
                                         "type": "image_url",
                                         "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64_image}"
+                                            "url": image_data_url
                                         }
                                     }
                                 ]
@@ -887,67 +766,72 @@ class HairstyleProcessor:
                         ]
                     )
 
-                    print(f"[{thread_name}] 重试请求完成，处理响应...")
+                    logger.info("重试请求完成，处理响应...")
                     # 递归调用处理重试的响应
                     return await self.process_gemini_response(
                         retry_completion, image_path, image_type, file_hash,
-                        thread_name, client, prompt_text, base64_image, attempt + 1
+                        client, prompt_text, image_data_url, attempt + 1
                     )
 
                 except Exception as retry_error:
-                    print(f"[{thread_name}] 重试请求失败: {retry_error}")
-                    print(f"[{thread_name}] 使用原图")
+                    logger.warning(f"重试请求失败: {retry_error}")
+                    logger.info("使用原图")
                     self.gemini_fail_count += 1
                     return image_path
             else:
-                print(f"[{thread_name}] 达到最大重试次数，响应中仍无图片数据，使用原图")
+                logger.info("达到最大重试次数，响应中仍无图片数据，使用原图")
                 self.gemini_fail_count += 1
                 return image_path
 
     def preprocess_images_concurrently(self, user_image_path, hairstyle_image_path):
-        """并发预处理用户图片和发型图片（同步接口）"""
-        thread_name = threading.current_thread().name
+        """并发预处理用户图片和发型图片（同步接口，提交到共享事件循环）"""
         try:
-            print(f"[{thread_name}] 开始并发预处理图像...")
-
-            # 创建新的事件循环来运行异步代码
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            logger.info("开始并发预处理图像...")
 
-            try:
-                # 并发执行两个预处理任务
-                processed_user_image, processed_hairstyle_image = loop.run_until_complete(
-                    asyncio.gather(
-                        self.preprocess_image_with_gemini(user_image_path, "user"),
-                        self.preprocess_image_with_gemini(hairstyle_image_path, "hairstyle"),
-                        return_exceptions=True
-                    )
+            async def _preprocess_both():
+                return await asyncio.gather(
+                    self.preprocess_image_with_gemini(user_image_path, "user"),
+                    self.preprocess_image_with_gemini(hairstyle_image_path, "hairstyle"),
+                    return_exceptions=True
                 )
 
-                # 处理可能的异常结果
-                if isinstance(processed_user_image, Exception):
-                    print(f"[{thread_name}] 用户图像预处理失败: {processed_user_image}")
-                    processed_user_image = user_image_path
+            # 并发执行两个预处理任务
+            processed_user_image, processed_hairstyle_image = get_async_runtime().run(_preprocess_both())
 
-                if isinstance(processed_hairstyle_image, Exception):
-                    print(f"[{thread_name}] 发型图像预处理失败: {processed_hairstyle_image}")
-                    processed_hairstyle_image = hairstyle_image_path
+            # 处理可能的异常结果
+            if isinstance(processed_user_image, Exception):
+                logger.error(f"用户图像预处理失败: {processed_user_image}")
+                processed_user_image = user_image_path
 
-                print(f"[{thread_name}] 图像预处理完成")
-                return processed_user_image, processed_hairstyle_image
+            if isinstance(processed_hairstyle_image, Exception):
+                logger.error(f"发型图像预处理失败: {processed_hairstyle_image}")
+                processed_hairstyle_image = hairstyle_image_path
 
-            finally:
-                loop.close()
+            logger.info("图像预处理完成")
+            return processed_user_image, processed_hairstyle_image
 
         except Exception as e:
-            print(f"[{thread_name}] 并发预处理失败: {e}")
-            print(f"[{thread_name}] 使用原图继续...")
+            logger.error(f"并发预处理失败: {e}")
+            logger.info("使用原图继续...")
             return user_image_path, hairstyle_image_path
 
+    def _wait_before_retry(self, retry_delay, cancel_check_func=None, cancel_message="任务在等待重试期间被取消"):
+        """重试前等待，期间每秒检查取消；等待会超过会话截止时间时不再等待，返回False表示不应重试"""
+        remaining = remaining_time()
+        if remaining is not None and remaining <= retry_delay:
+            logger.warning(f"会话剩余时间 {max(remaining, 0):.0f}秒，不足以等待 {retry_delay} 秒后重试")
+            return False
+        for _ in range(retry_delay):
+            if cancel_check_func and cancel_check_func():
+                logger.info(cancel_message)
+                return False
+            time.sleep(1)
+        return not (cancel_check_func and cancel_check_func())
+
     def run_color_preprocess_task(self, image_filename, max_retries=10, retry_delay=20, cancel_check_func=None):
         """运行发色预处理任务，返回taskId"""
         if not self.color_pre_webapp_id:
-            print("RUNNINGHUB_COLOR_PRE_WEBAPP_ID未设置，跳过发色预处理")
+            logger.warning("RUNNINGHUB_COLOR_PRE_WEBAPP_ID未设置，跳过发色预处理")
             return None
 
         start_time = time.time()
@@ -972,74 +856,68 @@ class HairstyleProcessor:
         })
 
         headers = {
-            'Host': self.host,
             'Content-Type': 'application/json'
         }
 
         for attempt in range(max_retries):
             # 检查是否需要取消
             if cancel_check_func and cancel_check_func():
-                print(f"发色预处理任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
+                logger.info(f"发色预处理任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
                 return None
 
-            conn = http.client.HTTPSConnection(self.host)
             try:
-                conn.request("POST", "/task/openapi/ai-app/run", payload, headers)
-                res = conn.getresponse()
-                data = res.read()
-                result = json.loads(data.decode("utf-8"))
+                result = self.runninghub.post("/task/openapi/ai-app/run", payload, headers, operation="run")
 
                 if result.get("code") == 0:
                     end_time = time.time()
                     elapsed_time = end_time - start_time
-                    print(f"Color preprocess task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
+                    logger.info(f"Color preprocess task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
                     return result["data"]["taskId"]
                 elif result.get("msg") in ["TASK_QUEUE_MAXED", "TASK_INSTANCE_MAXED"]:
-                    print(f"Color preprocess task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
+                    metrics.count_queue_maxed('runninghub')
+                    tracing.event('task.queue_maxed', provider='runninghub', attempt=attempt + 1)
+                    logger.warning(f"Color preprocess task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
                     if attempt < max_retries - 1:
-                        # 在睡眠期间也要检查取消状态
-                        for i in range(retry_delay):
-                            if cancel_check_func and cancel_check_func():
-                                print(f"发色预处理任务在等待重试期间被取消")
-                                return None
-                            time.sleep(1)
+                        if not self._wait_before_retry(retry_delay, cancel_check_func, "发色预处理任务在等待重试期间被取消"):
+                            return None
                         continue
                     else:
                         end_time = time.time()
                         elapsed_time = end_time - start_time
-                        print(f"Max retries reached, color preprocess task queue still full (总耗时: {elapsed_time:.2f}秒)")
+                        logger.warning(f"Max retries reached, color preprocess task queue still full (总耗时: {elapsed_time:.2f}秒)")
                         return None
                 else:
                     end_time = time.time()
                     elapsed_time = end_time - start_time
-                    print(f"Color preprocess task failed: {result} (耗时: {elapsed_time:.2f}秒)")
+                    logger.error(f"Color preprocess task failed: {result} (耗时: {elapsed_time:.2f}秒)")
                     return None
+            except DeadlineExceeded as e:
+                logger.warning(f"发色预处理任务超出会话截止时间，停止重试: {e}")
+                return None
             except Exception as e:
                 end_time = time.time()
                 elapsed_time = end_time - start_time
-                print(f"Error running color preprocess task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    continue
-                else:
+                logger.error(f"Error running color preprocess task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
+                # 提交请求可能已经到达RunningHub，重发会重复创建（并计费）任务
+                if not request_not_sent(e):
                     return None
-            finally:
-                conn.close()
+                if attempt < max_retries - 1 and self._wait_before_retry(retry_delay, cancel_check_func, "发色预处理任务在等待重试期间被取消"):
+                    continue
+                return None
 
         return None
 
     def call_runninghub_color_preprocess(self, image_filename):
         """完整的发色预处理流程：发起任务 -> 轮询状态 -> 获取结果"""
-        thread_name = threading.current_thread().name
 
         # Step 1: 发起预处理任务
-        print(f"[{thread_name}] 发起发色预处理任务...")
+        logger.info("发起发色预处理任务...")
         task_id = self.run_color_preprocess_task(image_filename)
         if not task_id:
             return None
 
         # Step 2: 轮询任务状态
-        print(f"[{thread_name}] Color preprocess task {task_id} started, waiting for completion...")
+        logger.info(f"Color preprocess task {task_id} started, waiting for completion...", extra={'task_id': task_id})
         max_wait = 300  # 5分钟超时
         wait_time = 0
         status = None
@@ -1049,33 +927,57 @@ class HairstyleProcessor:
             if status == "SUCCESS":
                 break
             elif status in ["FAILED", "CANCELLED"]:
-                print(f"[{thread_name}] Color preprocess task failed with status: {status}")
+                logger.error(f"Color preprocess task failed with status: {status}")
                 return None
 
             time.sleep(2)
             wait_time += 2
             if wait_time % 30 == 0:  # 每30秒打印一次进度
-                print(f"[{thread_name}] Color preprocess still processing... ({wait_time}s)")
+                logger.debug(f"Color preprocess still processing... ({wait_time}s)")
 
         if status != "SUCCESS":
-            print(f"[{thread_name}] Color preprocess task did not complete successfully: {status}")
+            logger.warning(f"Color preprocess task did not complete successfully: {status}")
             return None
 
         # Step 3: 获取预处理结果
-        print(f"[{thread_name}] Getting color preprocess results...")
+        logger.info("Getting color preprocess results...")
         results = self.get_task_results(task_id)
         if not results:
-            print(f"[{thread_name}] Failed to get color preprocess results")
+            logger.error("Failed to get color preprocess results")
             return None
 
-        print(f"[{thread_name}] Color preprocess completed successfully")
+        logger.info("Color preprocess completed successfully")
         return results
 
     def upload_image(self, image_path):
+        """Upload image to RunningHub server and return fileName (reused while the same content is registered)"""
+        return self.asset_registry.get_or_upload('runninghub', image_path, self._upload_image_to_runninghub)
+
+    def submit_with_asset_retry(self, image_paths, file_names, submit_func):
+        """Call submit_func(*file_names); if RunningHub rejects a reused fileName, forget the
+        registered uploads, re-upload image_paths once and submit again. Returns the task ID or None."""
+        try:
+            return submit_func(*file_names)
+        except InvalidAssetError as e:
+            logger.warning(f"RunningHub rejected uploaded images ({e}), re-uploading once...")
+
+        for image_path in image_paths:
+            self.asset_registry.forget('runninghub', image_path)
+        file_names = [self.upload_image(image_path) for image_path in image_paths]
+        if not all(file_names):
+            logger.error("Re-upload after rejected images failed")
+            return None
+        try:
+            return submit_func(*file_names)
+        except InvalidAssetError as e:
+            logger.error(f"RunningHub still rejects re-uploaded images: {e}")
+            return None
+
+    def _upload_image_to_runninghub(self, image_path):
         """Upload image to RunningHub server and return fileName"""
-        corrected_path = image_path
+        # 上传缩放/重编码后的图片，减少上传体积
+        corrected_path = self.upload_transformer.prepare(image_path)
         
-        conn = http.client.HTTPSConnection(self.host)
         dataList = []
         boundary = 'wL36Yn8afVp8Ag7AmP8qZ0SA4n1v9T'
         
@@ -1107,34 +1009,23 @@ class HairstyleProcessor:
         
         body = b'\r\n'.join(dataList)
         headers = {
-            'Host': self.host,
             'Content-type': 'multipart/form-data; boundary={}'.format(boundary)
         }
         
         try:
-            conn.request("POST", "/task/openapi/upload", body, headers)
-            res = conn.getresponse()
-            data = res.read()
-            result = json.loads(data.decode("utf-8"))
+            with metrics.time_stage('upload', 'runninghub'):
+                result = self.runninghub.post("/task/openapi/upload", body, headers, operation="upload")
             
             if result.get("code") == 0:
-                print(f"Upload successful for {image_path}: {result['data']['fileName']}")
+                logger.info(f"Upload successful for {image_path}: {result['data']['fileName']}")
                 return result["data"]["fileName"]
             else:
-                print(f"Upload failed for {image_path}: {result}")
-                print(f"API Response: {result}")
+                logger.error(f"Upload failed for {image_path}: {result}")
+                logger.debug(f"API Response: {result}")
                 return None
         except Exception as e:
-            print(f"Error uploading {image_path}: {e}")
+            logger.error(f"Error uploading {image_path}: {e}")
             return None
-        finally:
-            conn.close()
-            # Clean up temporary corrected file if it was created
-            if corrected_path != image_path and os.path.exists(corrected_path):
-                try:
-                    os.remove(corrected_path)
-                except:
-                    pass
     
     def run_hairstyle_task(self, hairstyle_filename, user_filename, max_retries=10, retry_delay=20, cancel_check_func=None):
         """Run AI hairstyle transfer task with retry mechanism for TASK_QUEUE_MAXED"""
@@ -1166,68 +1057,67 @@ class HairstyleProcessor:
         })
 
         headers = {
-            'Host': self.host,
             'Content-Type': 'application/json'
         }
 
         for attempt in range(max_retries):
             # 检查是否需要取消
             if cancel_check_func and cancel_check_func():
-                print(f"任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
+                logger.info(f"任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
                 return None
 
-            conn = http.client.HTTPSConnection(self.host)
             try:
-                conn.request("POST", "/task/openapi/ai-app/run", payload, headers)
-                res = conn.getresponse()
-                data = res.read()
-                result = json.loads(data.decode("utf-8"))
+                result = self.runninghub.post("/task/openapi/ai-app/run", payload, headers, operation="run")
 
                 if result.get("code") == 0:
                     end_time = time.time()  # 记录结束时间
                     elapsed_time = end_time - start_time
                     self.task_times.append(elapsed_time)
                     self.task_count += 1
-                    print(f"Task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
+                    logger.info(f"Task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
                     return result["data"]["taskId"]
                 elif result.get("msg") in ["TASK_QUEUE_MAXED", "TASK_INSTANCE_MAXED"]:
-                    print(f"Task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
+                    metrics.count_queue_maxed('runninghub')
+                    tracing.event('task.queue_maxed', provider='runninghub', attempt=attempt + 1)
+                    logger.warning(f"Task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
                     if attempt < max_retries - 1:  # Don't sleep on the last attempt
-                        # 在睡眠期间也要检查取消状态
-                        for i in range(retry_delay):
-                            if cancel_check_func and cancel_check_func():
-                                print(f"任务在等待重试期间被取消")
-                                return None
-                            time.sleep(1)
+                        if not self._wait_before_retry(retry_delay, cancel_check_func, "任务在等待重试期间被取消"):
+                            return None
                         continue
                     else: 
                         end_time = time.time()  # 记录结束时间（失败时）
                         elapsed_time = end_time - start_time
                         self.task_times.append(elapsed_time)
                         self.task_count += 1
-                        print(f"Max retries reached, task queue still full (总耗时: {elapsed_time:.2f}秒)")
+                        logger.warning(f"Max retries reached, task queue still full (总耗时: {elapsed_time:.2f}秒)")
                         return None
                 else:
                     end_time = time.time()  # 记录结束时间（失败时）
                     elapsed_time = end_time - start_time
                     self.task_times.append(elapsed_time)
                     self.task_count += 1
-                    print(f"Task failed: {result} (耗时: {elapsed_time:.2f}秒)")
-                    print(f"API Response: {result}")
+                    logger.error(f"Task failed: {result} (耗时: {elapsed_time:.2f}秒)")
+                    logger.debug(f"API Response: {result}")
+                    if is_invalid_asset_error(result.get("msg")):
+                        raise InvalidAssetError(result.get("msg"))
                     return None
+            except InvalidAssetError:
+                raise
+            except DeadlineExceeded as e:
+                logger.warning(f"任务超出会话截止时间，停止重试: {e}")
+                return None
             except Exception as e:
                 end_time = time.time()  # 记录结束时间（异常时）
                 elapsed_time = end_time - start_time
                 self.task_times.append(elapsed_time)
                 self.task_count += 1
-                print(f"Error running task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    continue
-                else:
+                logger.error(f"Error running task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
+                # 提交请求可能已经到达RunningHub，重发会重复创建（并计费）任务
+                if not request_not_sent(e):
                     return None
-            finally:
-                conn.close()
+                if attempt < max_retries - 1 and self._wait_before_retry(retry_delay, cancel_check_func, "任务在等待重试期间被取消"):
+                    continue
+                return None
 
         return None
 
@@ -1260,353 +1150,246 @@ class HairstyleProcessor:
         })
 
         headers = {
-            'Host': self.host,
             'Content-Type': 'application/json'
         }
 
         for attempt in range(max_retries):
             # 检查是否需要取消
             if cancel_check_func and cancel_check_func():
-                print(f"颜色换装任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
+                logger.info(f"颜色换装任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
                 return None
 
-            conn = http.client.HTTPSConnection(self.host)
             try:
-                conn.request("POST", "/task/openapi/ai-app/run", payload, headers)
-                res = conn.getresponse()
-                data = res.read()
-                result = json.loads(data.decode("utf-8"))
+                result = self.runninghub.post("/task/openapi/ai-app/run", payload, headers, operation="run")
 
                 if result.get("code") == 0:
                     end_time = time.time()  # 记录结束时间
                     elapsed_time = end_time - start_time
                     self.task_times.append(elapsed_time)
                     self.task_count += 1
-                    print(f"Color task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
+                    logger.info(f"Color task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
                     return result["data"]["taskId"]
                 elif result.get("msg") in ["TASK_QUEUE_MAXED", "TASK_INSTANCE_MAXED"]:
-                    print(f"Color task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
+                    metrics.count_queue_maxed('runninghub')
+                    tracing.event('task.queue_maxed', provider='runninghub', attempt=attempt + 1)
+                    logger.warning(f"Color task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
                     if attempt < max_retries - 1:  # Don't sleep on the last attempt
-                        # 在睡眠期间也要检查取消状态
-                        for i in range(retry_delay):
-                            if cancel_check_func and cancel_check_func():
-                                print(f"颜色换装任务在等待重试期间被取消")
-                                return None
-                            time.sleep(1)
+                        if not self._wait_before_retry(retry_delay, cancel_check_func, "颜色换装任务在等待重试期间被取消"):
+                            return None
                         continue
                     else:
                         end_time = time.time()  # 记录结束时间（失败时）
                         elapsed_time = end_time - start_time
                         self.task_times.append(elapsed_time)
                         self.task_count += 1
-                        print(f"Max retries reached, color task queue still full (总耗时: {elapsed_time:.2f}秒)")
+                        logger.warning(f"Max retries reached, color task queue still full (总耗时: {elapsed_time:.2f}秒)")
                         return None
                 else:
                     end_time = time.time()  # 记录结束时间（失败时）
                     elapsed_time = end_time - start_time
                     self.task_times.append(elapsed_time)
                     self.task_count += 1
-                    print(f"Color task failed: {result} (耗时: {elapsed_time:.2f}秒)")
-                    print(f"API Response: {result}")
+                    logger.error(f"Color task failed: {result} (耗时: {elapsed_time:.2f}秒)")
+                    logger.debug(f"API Response: {result}")
+                    if is_invalid_asset_error(result.get("msg")):
+                        raise InvalidAssetError(result.get("msg"))
                     return None
+            except InvalidAssetError:
+                raise
+            except DeadlineExceeded as e:
+                logger.warning(f"颜色换装任务超出会话截止时间，停止重试: {e}")
+                return None
             except Exception as e:
                 end_time = time.time()  # 记录结束时间（异常时）
                 elapsed_time = end_time - start_time
                 self.task_times.append(elapsed_time)
                 self.task_count += 1
-                print(f"Error running color task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    continue
-                else:
+                logger.error(f"Error running color task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
+                # 提交请求可能已经到达RunningHub，重发会重复创建（并计费）任务
+                if not request_not_sent(e):
                     return None
-            finally:
-                conn.close()
+                if attempt < max_retries - 1 and self._wait_before_retry(retry_delay, cancel_check_func, "颜色换装任务在等待重试期间被取消"):
+                    continue
+                return None
 
         return None
 
-    def run_3d_task(self, user_filename, max_retries=10, retry_delay=20, cancel_check_func=None):
+    def run_3d_task(self, user_filename, max_retries=10, retry_delay=20, cancel_check_func=None,
+                    callback_url=None, provider_name=None):
         """Run AI 3D photo to video task with retry mechanism for TASK_QUEUE_MAXED"""
-        if self.should_use_pai_for_3d():
-            return self.run_3d_task_with_pai(user_filename, cancel_check_func=cancel_check_func)
-
-        if self.should_use_volcengine_for_3d():
-            return self.run_3d_task_with_volcengine(user_filename, cancel_check_func=cancel_check_func)
-
-        if not self.webapp_3d_id:
-            raise ValueError("3D webapp ID is required. Set RUNNINGHUB_3D_WEBAPP_ID environment variable.")
-
-        start_time = time.time()
-
-        payload = json.dumps({
-            "webappId": self.webapp_3d_id,
-            "apiKey": self.api_key,
-            "nodeInfoList": [
-                {
-                    "nodeId": "146",
-                    "fieldName": "image",
-                    "fieldValue": user_filename,
-                    "description": "user"
-                }
-            ],
-            "instanceType": "plus",
-            "usePersonalQueue": "true"
-        })
-
-        headers = {
-            'Host': self.host,
-            'Content-Type': 'application/json'
-        }
-
-        for attempt in range(max_retries):
-            # 检查是否需要取消
-            if cancel_check_func and cancel_check_func():
-                print(f"3D任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
-                return None
-
-            conn = http.client.HTTPSConnection(self.host)
-            try:
-                conn.request("POST", "/task/openapi/ai-app/run", payload, headers)
-                res = conn.getresponse()
-                data = res.read()
-                result = json.loads(data.decode("utf-8"))
-
-                if result.get("code") == 0:
-                    end_time = time.time()
-                    elapsed_time = end_time - start_time
-                    self.task_times.append(elapsed_time)
-                    self.task_count += 1
-                    print(f"3D task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
-                    return result["data"]["taskId"]
-                elif result.get("msg") in ["TASK_QUEUE_MAXED", "TASK_INSTANCE_MAXED"]:
-                    print(f"3D task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
-                    if attempt < max_retries - 1:
-                        for i in range(retry_delay):
-                            if cancel_check_func and cancel_check_func():
-                                print(f"3D任务在等待重试期间被取消")
-                                return None
-                            time.sleep(1)
-                        continue
-                    else:
-                        end_time = time.time()
-                        elapsed_time = end_time - start_time
-                        self.task_times.append(elapsed_time)
-                        self.task_count += 1
-                        print(f"Max retries reached, 3D task queue still full (总耗时: {elapsed_time:.2f}秒)")
-                        return None
-                else:
-                    end_time = time.time()
-                    elapsed_time = end_time - start_time
-                    self.task_times.append(elapsed_time)
-                    self.task_count += 1
-                    print(f"3D task failed: {result} (耗时: {elapsed_time:.2f}秒)")
-                    print(f"API Response: {result}")
-                    return None
-            except Exception as e:
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                self.task_times.append(elapsed_time)
-                self.task_count += 1
-                print(f"Error running 3D task (attempt {attempt + 1}/{max_retries}): {e} (耗时: {elapsed_time:.2f}秒)")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    return None
-            finally:
-                conn.close()
-
-        return None
+        provider = self.get_video_provider(provider_name)
+        if provider.name == 'runninghub':
+            # 提交在共享事件循环线程上执行，看不到当前线程的会话截止时间，需显式传入
+            coro = self.video_engine.submit(provider.name, user_filename, cancel_check_func, callback_url,
+                                            max_retries=max_retries, retry_delay=retry_delay,
+                                            deadline=current_deadline())
+        else:
+            coro = self.video_engine.submit(provider.name, user_filename, cancel_check_func, callback_url)
+        return self.video_engine.run(coro)
 
     def check_task_status(self, task_id):
         """Check task status"""
-        conn = http.client.HTTPSConnection(self.host, timeout=120)  # 添加30秒超时
         payload = json.dumps({
             "apiKey": self.api_key,
             "taskId": task_id
         })
 
         headers = {
-            'Host': self.host,
             'Content-Type': 'application/json'
         }
 
         try:
-            conn.request("POST", "/task/openapi/status", payload, headers)
-            res = conn.getresponse()
-            data = res.read()
-            result = json.loads(data.decode("utf-8"))
+            result = self.runninghub.post("/task/openapi/status", payload, headers, operation="status", idempotent=True)
 
             if result.get("code") == 0:
                 return result["data"]
             else:
-                print(f"Status check failed for task {task_id}: code={result.get('code')}, msg={result.get('msg', 'unknown')}")
+                logger.warning(f"Status check failed for task {task_id}: code={result.get('code')}, msg={result.get('msg', 'unknown')}",
+                               extra={'task_id': task_id, 'rate_key': 'status_check_failed'})
                 return None
         except Exception as e:
-            print(f"Error checking status for task {task_id}: {e}")
+            logger.warning(f"Error checking status for task {task_id}: {e}",
+                           extra={'task_id': task_id, 'rate_key': 'status_check_failed'})
             return None
-        finally:
-            conn.close()
     
     def get_task_results(self, task_id):
         """Get task results"""
-        conn = http.client.HTTPSConnection(self.host)
         payload = json.dumps({
             "apiKey": self.api_key,
             "taskId": task_id
         })
 
         headers = {
-            'Host': self.host,
             'Content-Type': 'application/json'
         }
 
         try:
-            conn.request("POST", "/task/openapi/outputs", payload, headers)
-            res = conn.getresponse()
-            data = res.read()
-            result = json.loads(data.decode("utf-8"))
+            result = self.runninghub.post("/task/openapi/outputs", payload, headers, operation="outputs", idempotent=True)
 
             if result.get("code") == 0:
                 return result["data"]
             else:
-                print(f"Get results failed: {result}")
+                logger.error(f"Get results failed: {result}")
                 return None
         except Exception as e:
-            print(f"Error getting results: {e}")
+            logger.error(f"Error getting results: {e}")
             return None
-        finally:
-            conn.close()
 
     def cancel_task(self, task_id):
         """Cancel task"""
-        conn = http.client.HTTPSConnection(self.host)
         payload = json.dumps({
             "apiKey": self.api_key,
             "taskId": task_id
         })
 
         headers = {
-            'Host': self.host,
             'Content-Type': 'application/json'
         }
 
         try:
-            conn.request("POST", "/task/openapi/cancel", payload, headers)
-            res = conn.getresponse()
-            data = res.read()
-            result = json.loads(data.decode("utf-8"))
+            result = self.runninghub.post("/task/openapi/cancel", payload, headers, operation="cancel")
 
             if result.get("code") == 0:
-                print(f"Task cancelled successfully: {task_id}")
+                logger.info(f"Task cancelled successfully: {task_id}", extra={'task_id': task_id})
                 return True
             else:
-                print(f"Cancel task failed: {result}")
+                logger.error(f"Cancel task failed: {result}")
                 return False
         except Exception as e:
-            print(f"Error cancelling task: {e}")
+            logger.error(f"Error cancelling task: {e}")
             return False
-        finally:
-            conn.close()
     
     def download_image(self, url, save_path):
-        """Download image from URL"""
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
-                return True
-            else:
-                print(f"Failed to download {url}")
-                return False
-        except Exception as e:
-            print(f"Error downloading {url}: {e}")
-            return False
+        """Download image from URL (streamed to a temp file, resumed on failure)"""
+        return get_download_manager().download(url, save_path) is not None
+
+    def download_results(self, results, results_dir, filename_template):
+        """Download all result files of one task in parallel, keeping the result order"""
+        items = []
+        for i, result in enumerate(results):
+            result_url = result.get("fileUrl")
+            if result_url:
+                result_filename = filename_template.format(i=i)
+                items.append((result_url, os.path.join(results_dir, result_filename)))
+
+        result_paths = []
+        result_filenames = []
+        for (result_url, result_path), downloaded in zip(items, get_download_manager().download_all(items)):
+            if downloaded:
+                result_paths.append(result_path)
+                result_filenames.append(os.path.basename(result_path))
+        return result_paths, result_filenames
     
     def create_combined_image(self, hairstyle_path, user_path, result_paths, output_path):
-        """Create a combined image with hairstyle reference, user photo, and all generated results"""
+        """Create a combined image with hairstyle reference, user photo, and all generated results
+
+        Returns the path actually written (its extension follows COMPOSITE_FORMAT), or None on failure.
+        """
         try:
-            # Open hairstyle and user images
-            hairstyle_img = Image.open(hairstyle_path)
-            user_img = Image.open(user_path)
-            
-            # Open all result images
-            result_imgs = []
-            for result_path in result_paths:
-                if os.path.exists(result_path):
-                    result_imgs.append(Image.open(result_path))
-            
-            if not result_imgs:
-                all_imgs = [hairstyle_img, user_img]
-                # print("No result images found")
-                # return False
-            
-            # Collect all images
-            all_imgs = [hairstyle_img, user_img] + result_imgs
-            
-            # Convert to RGB if necessary
-            for i, img in enumerate(all_imgs):
-                if img.mode != 'RGB':
-                    all_imgs[i] = img.convert('RGB')
-            
-            # Define target height (use the minimum height among all images, but at least 512px)
-            target_height = max(512, min(img.height for img in all_imgs))
-            
-            # Resize all images to the same height while maintaining aspect ratio
-            def resize_to_height(img, target_height):
-                aspect_ratio = img.width / img.height
-                target_width = int(target_height * aspect_ratio)
-                return img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-            
-            resized_imgs = [resize_to_height(img, target_height) for img in all_imgs]
-            
-            # Calculate total width
-            total_width = sum(img.width for img in resized_imgs)
-            
-            # Create new image for the combined result
-            combined_img = Image.new('RGB', (total_width, target_height), (255, 255, 255))
-            
-            # Paste images side by side
-            x_offset = 0
-            for img in resized_imgs:
-                combined_img.paste(img, (x_offset, 0))
-                x_offset += img.width
-            
-            # Save the combined image
-            combined_img.save(output_path, 'PNG', quality=95)
-            print(f"Combined image saved: {output_path}")
-            return True
-            
+            image_paths = [hairstyle_path, user_path] + [path for path in result_paths if os.path.exists(path)]
+            combined_path = self.compositor.compose(image_paths, output_path)
+            logger.info(f"Combined image saved: {combined_path}")
+            return combined_path
+
         except Exception as e:
-            print(f"Error creating combined image: {e}")
+            logger.error(f"Error creating combined image: {e}")
+            return None
+
+    def open_job_ledger(self, db_path=None):
+        """打开批处理任务账本（JOB_LEDGER_ENABLED=false 时不记录）"""
+        if self.ledger is None and env_bool('JOB_LEDGER_ENABLED', True):
+            db_path = db_path or os.environ.get('JOB_LEDGER_PATH') or os.path.join(self.data_dir, 'job_ledger.db')
+            self.ledger = JobLedger(db_path)
+            logger.info(f"Job ledger: {db_path} {self.ledger.count_by_status()}")
+        return self.ledger
+
+    def _ledger_get(self, job_key):
+        return self.ledger.get(job_key) if self.ledger else None
+
+    def _ledger_update(self, job_key, kind, status, **fields):
+        if self.ledger:
+            try:
+                self.ledger.update(job_key, kind, status, **fields)
+            except Exception as e:
+                logger.error(f"写入任务账本失败 {job_key}: {e}")
+
+    def _restore_completed_result(self, entry):
+        """账本中已完成且结果文件仍在时，直接恢复结果记录"""
+        result = entry.get('result') if entry else None
+        if not result or entry.get('status') != STATUS_COMPLETED:
             return False
-    
-    def resize_image_for_word(self, image_path, max_width=2.5):
-        """Resize image to fit in Word document"""
-        try:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                aspect_ratio = height / width
-                
-                if width > max_width * 96:  # 96 DPI default
-                    new_width = max_width
-                    new_height = new_width * aspect_ratio
-                    return new_width, new_height
-                else:
-                    return width / 96, height / 96
-        except:
-            return max_width, max_width
-    
+        if not all(os.path.exists(path) for path in result.get('result_images', [])):
+            return False
+        with self.results_lock:
+            self.results.append(result)
+        return True
+
+    def _sample(self, items, k, label):
+        """随机抽取k个；启用任务账本时用固定种子，重新运行能抽到相同的组合继续处理"""
+        items = sorted(items)
+        if len(items) <= k:
+            return items
+        rng = random.Random(f"{os.environ.get('BATCH_SAMPLE_SEED', 'ledger')}:{label}") if self.ledger else random
+        return rng.sample(items, k)
+
+    def _results_dir(self, name):
+        """结果目录 results_<name>_<MMDD>_；BATCH_RESUME=true 时沿用最近一次运行的目录续跑"""
+        results_dir = os.path.join(self.data_dir, f"results_{name}_{datetime.now().strftime('%m%d')}_")
+        if env_bool('BATCH_RESUME', False) and not os.path.isdir(results_dir):
+            previous = glob.glob(os.path.join(self.data_dir, f"results_{name}_[0-9][0-9][0-9][0-9]_"))
+            if previous:
+                results_dir = max(previous, key=os.path.getmtime)
+        os.makedirs(results_dir, exist_ok=True)
+        return results_dir
+
     def process_single_combination_with_timeout(self, task_info):
         """Process a single user-hairstyle combination with timeout control"""
         start_time = time.time()
-        thread_name = threading.current_thread().name
         user_file = task_info[2]
         hairstyle_file = task_info[3]
 
         try:
-            print(f"[{thread_name}] 开始处理任务 (超时限制: {self.task_timeout}秒): {user_file} + {hairstyle_file}")
+            logger.info(f"开始处理任务 (超时限制: {self.task_timeout}秒): {user_file} + {hairstyle_file}")
             result = self.process_single_combination(task_info)
             end_time = time.time()
             elapsed = end_time - start_time
@@ -1614,57 +1397,80 @@ class HairstyleProcessor:
             # 检查是否超时
             if elapsed > self.task_timeout:
                 self.timeout_count += 1
-                print(f"[{thread_name}] ⚠️ 任务超时 (耗时: {elapsed:.2f}秒): {user_file} + {hairstyle_file}")
+                logger.warning(f"⚠️ 任务超时 (耗时: {elapsed:.2f}秒): {user_file} + {hairstyle_file}")
                 return None
 
-            print(f"[{thread_name}] 任务完成，耗时: {elapsed:.2f}秒: {user_file} + {hairstyle_file}")
+            logger.info(f"任务完成，耗时: {elapsed:.2f}秒: {user_file} + {hairstyle_file}")
             return result
 
         except Exception as e:
             end_time = time.time()
             elapsed = end_time - start_time
-            print(f"[{thread_name}] ❌ 任务异常 (耗时: {elapsed:.2f}秒): {user_file} + {hairstyle_file}")
-            print(f"[{thread_name}] 异常详情: {e}")
+            logger.error(f"❌ 任务异常 (耗时: {elapsed:.2f}秒): {user_file} + {hairstyle_file}")
+            logger.error(f"异常详情: {e}")
             return None
 
     def process_single_combination(self, task_info):
         """Process a single user-hairstyle combination with Gemini preprocessing"""
         user_full_path, hairstyle_full_path, user_file, hairstyle_file, gender_name, results_dir = task_info
 
-        print(f"[{threading.current_thread().name}] Processing: {user_file} + {hairstyle_file}")
+        logger.info(f"Processing: {user_file} + {hairstyle_file}")
+
+        job_key = JobLedger.make_key('hairstyle', user_full_path, hairstyle_full_path)
+        entry = self._ledger_get(job_key)
+        if self._restore_completed_result(entry):
+            logger.info(f"Already completed (ledger), skipping: {user_file} + {hairstyle_file}")
+            return True
 
         try:
             # Step 1: Gemini预处理图像
-            # print(f"[{threading.current_thread().name}] Step 1: Gemini preprocessing...")
+            # print(f"Step 1: Gemini preprocessing...")
             # processed_user_path, processed_hairstyle_path = self.preprocess_images_concurrently(
             #     user_full_path, hairstyle_full_path
             # )
             processed_user_path, processed_hairstyle_path = user_full_path, hairstyle_full_path
 
-            # Step 2: Upload processed images
-            print(f"[{threading.current_thread().name}] Step 2: Uploading processed images...")
-            user_filename = self.upload_image(processed_user_path)
-            if not user_filename:
-                print(f"[{threading.current_thread().name}] Failed to upload user image, trying original...")
-                user_filename = self.upload_image(user_full_path)
-                if not user_filename:
-                    return
-
-            hairstyle_filename = self.upload_image(processed_hairstyle_path)
-            if not hairstyle_filename:
-                print(f"[{threading.current_thread().name}] Failed to upload hairstyle image, trying original...")
-                hairstyle_filename = self.upload_image(hairstyle_full_path)
-                if not hairstyle_filename:
+            if entry and entry['status'] == STATUS_SUBMITTED and entry.get('task_id'):
+                # 上次运行已提交的任务，直接继续轮询
+                task_id = entry['task_id']
+                logger.info(f"Resuming task {task_id} from ledger...", extra={'task_id': task_id})
+            else:
+                if entry and entry['status'] == STATUS_UPLOADED:
+                    # 复用上次运行已上传的文件
+                    user_filename = entry['user_upload']
+                    hairstyle_filename = entry['hairstyle_upload']
+                else:
+                    # Step 2: Upload processed images
+                    logger.info(f"Step 2: Uploading processed images...")
+                    user_filename = self.upload_image(processed_user_path)
+                    if not user_filename:
+                        logger.warning(f"Failed to upload user image, trying original...")
+                        user_filename = self.upload_image(user_full_path)
+                        if not user_filename:
+                            return
+
+                    hairstyle_filename = self.upload_image(processed_hairstyle_path)
+                    if not hairstyle_filename:
+                        logger.warning(f"Failed to upload hairstyle image, trying original...")
+                        hairstyle_filename = self.upload_image(hairstyle_full_path)
+                        if not hairstyle_filename:
+                            return
+                    self._ledger_update(job_key, 'hairstyle', STATUS_UPLOADED,
+                                        user_upload=user_filename, hairstyle_upload=hairstyle_filename)
+
+                # Run task
+                logger.info(f"Running hairstyle transfer task...")
+                task_id = self.submit_with_asset_retry(
+                    [hairstyle_full_path, user_full_path], [hairstyle_filename, user_filename], self.run_hairstyle_task
+                )
+                if not task_id:
+                    # 上传的文件可能已失效，下次运行重新上传
+                    self._ledger_update(job_key, 'hairstyle', STATUS_FAILED, user_upload=None, hairstyle_upload=None)
                     return
-            
-            # Run task
-            print(f"[{threading.current_thread().name}] Running hairstyle transfer task...")
-            task_id = self.run_hairstyle_task(hairstyle_filename, user_filename)
-            if not task_id:
-                return
+                self._ledger_update(job_key, 'hairstyle', STATUS_SUBMITTED, task_id=task_id)
             
             # Wait for completion
-            print(f"[{threading.current_thread().name}] Task {task_id} started, waiting for completion...")
+            logger.info(f"Task {task_id} started, waiting for completion...", extra={'task_id': task_id})
             max_wait = 1000  # 5 minutes max
             wait_time = 0
             
@@ -1673,38 +1479,32 @@ class HairstyleProcessor:
                 if status == "SUCCESS":
                     break
                 elif status in ["FAILED", "CANCELLED"]:
-                    print(f"[{threading.current_thread().name}] Task failed with status: {status}")
+                    logger.error(f"Task failed with status: {status}")
+                    self._ledger_update(job_key, 'hairstyle', STATUS_FAILED, task_id=None, last_error=status)
                     return
                 
                 time.sleep(2)
                 wait_time += 2
                 if wait_time % 10 == 0:  # Print every 10 seconds
-                    print(f"[{threading.current_thread().name}] Still processing... ({wait_time}s)")
+                    logger.debug(f"Still processing... ({wait_time}s)")
             
             if status != "SUCCESS":
-                print(f"[{threading.current_thread().name}] Task did not complete successfully: {status}")
+                logger.warning(f"Task did not complete successfully: {status}")
+                # 轮询超时（任务可能已过期或不存在），下次运行重新提交而不是再次轮询同一个task_id
+                self._ledger_update(job_key, 'hairstyle', STATUS_FAILED, task_id=None,
+                                    last_error=f"poll timeout ({status})")
                 return
             
             # Get results
-            print(f"[{threading.current_thread().name}] Getting results...")
+            logger.info(f"Getting results...")
             results = self.get_task_results(task_id)
             if not results:
                 return
             
-            # Download result images and create combined images
-            result_paths = []
-            result_filenames = []
-            
-            # Download all result images first
-            for i, result in enumerate(results):
-                result_url = result.get("fileUrl")
-                if result_url:
-                    result_filename = f"{gender_name}_{user_file}_{hairstyle_file}_result_{i}.png"
-                    result_path = os.path.join(results_dir, result_filename)
-                    
-                    if self.download_image(result_url, result_path):
-                        result_paths.append(result_path)
-                        result_filenames.append(result_filename)
+            # Download all result images first (in parallel)
+            result_paths, result_filenames = self.download_results(
+                results, results_dir, f"{gender_name}_{user_file}_{hairstyle_file}_result_{{i}}.png"
+            )
             
             # Create one combined image with all results (original hairstyle + original user + results)
             if result_paths:
@@ -1712,52 +1512,58 @@ class HairstyleProcessor:
                 combined_path = os.path.join(results_dir, combined_filename)
 
                 # Use original images for the combined image to show the transformation
-                if self.create_combined_image(hairstyle_full_path, user_full_path, result_paths, combined_path):
-                    print(f"[{threading.current_thread().name}] Created combined image: {combined_filename}")
+                created_path = self.create_combined_image(hairstyle_full_path, user_full_path, result_paths, combined_path)
+                if created_path:
+                    combined_path = created_path
+                    combined_filename = os.path.basename(created_path)
+                    logger.info(f"Created combined image: {combined_filename}")
 
                 # Store result info (thread-safe) - include both original and processed paths
+                result_info = {
+                    'gender': gender_name,
+                    'user_image': user_full_path,  # 保留原始路径用于记录
+                    'hairstyle_image': hairstyle_full_path,  # 保留原始路径用于记录
+                    'processed_user_image': processed_user_path,  # 新增预处理路径
+                    'processed_hairstyle_image': processed_hairstyle_path,  # 新增预处理路径
+                    'result_images': result_paths,
+                    'combined_image': combined_path if os.path.exists(combined_path) else None,
+                    'user_filename': user_file,
+                    'hairstyle_filename': hairstyle_file,
+                    'result_filenames': result_filenames,
+                    'combined_filename': combined_filename
+                }
                 with self.results_lock:
-                    self.results.append({
-                        'gender': gender_name,
-                        'user_image': user_full_path,  # 保留原始路径用于记录
-                        'hairstyle_image': hairstyle_full_path,  # 保留原始路径用于记录
-                        'processed_user_image': processed_user_path,  # 新增预处理路径
-                        'processed_hairstyle_image': processed_hairstyle_path,  # 新增预处理路径
-                        'result_images': result_paths,
-                        'combined_image': combined_path if os.path.exists(combined_path) else None,
-                        'user_filename': user_file,
-                        'hairstyle_filename': hairstyle_file,
-                        'result_filenames': result_filenames,
-                        'combined_filename': combined_filename
-                    })
+                    self.results.append(result_info)
+                self._ledger_update(job_key, 'hairstyle', STATUS_COMPLETED, result=result_info)
                 return True
             
-            print(f"[{threading.current_thread().name}] Completed: {user_file} + {hairstyle_file}")
+            logger.info(f"Completed: {user_file} + {hairstyle_file}")
             
         except Exception as e:
-            print(f"[{threading.current_thread().name}] Error processing {user_file} + {hairstyle_file}: {e}")
+            logger.error(f"Error processing {user_file} + {hairstyle_file}: {e}")
     
     def process_gender_folder(self, gender_path, gender_name):
         """Process all combinations for a gender (man/woman) with concurrent processing"""
+        # 记录每个组合的进度，中断后重新运行可续跑
+        self.open_job_ledger()
         hairstyle_path = os.path.join(gender_path, "hairstyle")
         user_path = os.path.join(gender_path, "user")
         
         if not os.path.exists(hairstyle_path) or not os.path.exists(user_path):
-            print(f"Missing hairstyle or user folder for {gender_name}")
+            logger.warning(f"Missing hairstyle or user folder for {gender_name}")
             return
         
         hairstyle_files = [f for f in os.listdir(hairstyle_path) if f.lower().endswith(('.jpg', '.jpeg', '.png','.JPG', '.JPEG', '.PNG'))]
         user_files = [f for f in os.listdir(user_path) if f.lower().endswith(('.jpg', '.jpeg', '.png','.JPG', '.JPEG', '.PNG'))]
         
-        # For women, randomly select 50 hairstyles
-        if  len(hairstyle_files) > 30:
-            hairstyle_files = random.sample(hairstyle_files, 30)
-            print(f"Randomly selected 50 hairstyles from {len(os.listdir(hairstyle_path))} total")
+        # 发型较多时随机抽取30个
+        if len(hairstyle_files) > 30:
+            hairstyle_files = self._sample(hairstyle_files, 30, gender_name)
+            logger.info(f"Randomly selected 30 hairstyles from {len(os.listdir(hairstyle_path))} total")
         
-        print(f"Processing {gender_name}: {len(hairstyle_files)} hairstyles × {len(user_files)} users = {len(hairstyle_files) * len(user_files)} combinations")
+        logger.info(f"Processing {gender_name}: {len(hairstyle_files)} hairstyles × {len(user_files)} users = {len(hairstyle_files) * len(user_files)} combinations")
         
-        results_dir = os.path.join(self.data_dir, f"results_{gender_name}_{datetime.now().strftime('%m%d')}_")
-        os.makedirs(results_dir, exist_ok=True)
+        results_dir = self._results_dir(gender_name)
         
         # Create task list
         tasks = []
@@ -1770,7 +1576,7 @@ class HairstyleProcessor:
                 # break
         
         # Process tasks concurrently
-        print(f"Starting concurrent processing with {self.max_workers} workers (timeout: {self.task_timeout}s per task)...")
+        logger.info(f"Starting concurrent processing with {self.max_workers} workers (timeout: {self.task_timeout}s per task)...")
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             # Submit all tasks
             future_to_task = {executor.submit(self.process_single_combination_with_timeout, task): task for task in tasks}
@@ -1791,101 +1597,122 @@ class HairstyleProcessor:
                     result = future.result(timeout=self.task_timeout + 30)  # 给额外30秒的缓冲时间
                     if result is not None:
                         successful += 1
-                        print(f"✅ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                        logger.info(f"✅ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
                     else:
                         failed += 1
-                        print(f"❌ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                        logger.info(f"❌ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
 
                 except concurrent.futures.TimeoutError:
                     timeout_tasks += 1
                     failed += 1
-                    print(f"⏰ Future timeout: {user_file} + {hairstyle_file}")
-                    print(f"⚠️ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                    logger.warning(f"⏰ Future timeout: {user_file} + {hairstyle_file}")
+                    logger.info(f"⚠️ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
 
                 except Exception as exc:
                     failed += 1
-                    print(f"💥 Task {user_file} + {hairstyle_file} generated an exception: {exc}")
-                    print(f"❌ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                    logger.error(f"💥 Task {user_file} + {hairstyle_file} generated an exception: {exc}")
+                    logger.info(f"❌ Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
             
-            print(f"\n=== 处理完成统计 ===")
-            print(f"总任务数: {len(tasks)}")
-            print(f"成功完成: {successful}")
-            print(f"失败任务: {failed}")
-            print(f"超时任务: {self.timeout_count}")
-            print(f"成功率: {(successful/len(tasks)*100):.1f}%")
-            print(f"===================")
+            logger.info("=== 处理完成统计 ===")
+            logger.info(f"总任务数: {len(tasks)}")
+            logger.info(f"成功完成: {successful}")
+            logger.info(f"失败任务: {failed}")
+            logger.info(f"超时任务: {self.timeout_count}")
+            logger.info(f"成功率: {(successful/len(tasks)*100):.1f}%")
+            logger.info("===================")
         
-        print(f"Completed processing {gender_name} folder")
+        logger.info(f"Completed processing {gender_name} folder")
 
     def process_single_color_combination_with_timeout(self, task_info):
         """处理单个 用户图 × 发色参考 的组合（带超时控制）"""
         start_time = time.time()
-        thread_name = threading.current_thread().name
         user_file = task_info[2]
         color_file = task_info[3]
 
         try:
-            print(f"[{thread_name}] 开始处理发色任务 (超时限制: {self.task_timeout}秒): {user_file} + {color_file}")
+            logger.info(f"开始处理发色任务 (超时限制: {self.task_timeout}秒): {user_file} + {color_file}")
             result = self.process_single_color_combination(task_info)
             end_time = time.time()
             elapsed = end_time - start_time
 
             if elapsed > self.task_timeout:
                 self.timeout_count += 1
-                print(f"[{thread_name}] ⚠️ 发色任务超时 (耗时: {elapsed:.2f}秒): {user_file} + {color_file}")
+                logger.warning(f"⚠️ 发色任务超时 (耗时: {elapsed:.2f}秒): {user_file} + {color_file}")
                 return None
 
-            print(f"[{thread_name}] 发色任务完成，耗时: {elapsed:.2f}秒: {user_file} + {color_file}")
+            logger.info(f"发色任务完成，耗时: {elapsed:.2f}秒: {user_file} + {color_file}")
             return result
 
         except Exception as e:
             end_time = time.time()
             elapsed = end_time - start_time
-            print(f"[{thread_name}] ❌ 发色任务异常 (耗时: {elapsed:.2f}秒): {user_file} + {color_file}")
-            print(f"[{thread_name}] 异常详情: {e}")
+            logger.error(f"❌ 发色任务异常 (耗时: {elapsed:.2f}秒): {user_file} + {color_file}")
+            logger.error(f"异常详情: {e}")
             return None
 
     def process_single_color_combination(self, task_info):
         """处理单个 用户图 × 发色参考 的组合"""
         user_full_path, color_full_path, user_file, color_file, results_dir = task_info
 
-        print(f"[{threading.current_thread().name}] Processing Color: {user_file} + {color_file}")
+        logger.info(f"Processing Color: {user_file} + {color_file}")
+
+        job_key = JobLedger.make_key('color', user_full_path, color_full_path)
+        entry = self._ledger_get(job_key)
+        if self._restore_completed_result(entry):
+            logger.info(f"Already completed (ledger), skipping color: {user_file} + {color_file}")
+            return True
 
         try:
-            # Step 1: 上传原图（这里不做Gemini预处理，保持一致性和速度）
-            print(f"[{threading.current_thread().name}] Step 1: Uploading images for color task...")
-            import os
-            user_dir, user_name = os.path.split(user_full_path)
-            if '.' in user_name:
-                name_parts = user_name.split('.')
-                if len(name_parts) > 2:
-                    user_name_new = ''.join(name_parts[:-1]) + '.' + name_parts[-1]
-                else:
-                    user_name_new = user_name
-                user_full_path_new = os.path.join(user_dir, user_name_new)
-                if user_full_path_new != user_full_path:
-                    import shutil
-                    shutil.copy(user_full_path, user_full_path_new)
+            if entry and entry['status'] == STATUS_SUBMITTED and entry.get('task_id'):
+                # 上次运行已提交的任务，直接继续轮询
+                task_id = entry['task_id']
+                logger.info(f"Resuming color task {task_id} from ledger...", extra={'task_id': task_id})
             else:
-                user_full_path_new = user_full_path
-            user_filename = self.upload_image(user_full_path_new)
-            if not user_filename:
-                print(f"[{threading.current_thread().name}] Failed to upload user image for color task")
-                return
-
-            color_filename = self.upload_image(color_full_path)
-            if not color_filename:
-                print(f"[{threading.current_thread().name}] Failed to upload color reference image")
-                return
-
-            # Step 2: 运行颜色换装任务（使用预处理后的发色图）
-            print(f"[{threading.current_thread().name}] Running color transfer task...")
-            task_id = self.run_color_task(color_filename, user_filename)
-            if not task_id:
-                return
+                if entry and entry['status'] == STATUS_UPLOADED:
+                    # 复用上次运行已上传的文件
+                    user_filename = entry['user_upload']
+                    color_filename = entry['color_upload']
+                else:
+                    # Step 1: 上传原图（这里不做Gemini预处理，保持一致性和速度）
+                    logger.info(f"Step 1: Uploading images for color task...")
+                    user_dir, user_name = os.path.split(user_full_path)
+                    if '.' in user_name:
+                        name_parts = user_name.split('.')
+                        if len(name_parts) > 2:
+                            user_name_new = ''.join(name_parts[:-1]) + '.' + name_parts[-1]
+                        else:
+                            user_name_new = user_name
+                        user_full_path_new = os.path.join(user_dir, user_name_new)
+                        if user_full_path_new != user_full_path:
+                            import shutil
+                            shutil.copy(user_full_path, user_full_path_new)
+                    else:
+                        user_full_path_new = user_full_path
+                    user_filename = self.upload_image(user_full_path_new)
+                    if not user_filename:
+                        logger.error(f"Failed to upload user image for color task")
+                        return
+
+                    color_filename = self.upload_image(color_full_path)
+                    if not color_filename:
+                        logger.error(f"Failed to upload color reference image")
+                        return
+                    self._ledger_update(job_key, 'color', STATUS_UPLOADED,
+                                        user_upload=user_filename, color_upload=color_filename)
+
+                # Step 2: 运行颜色换装任务（使用预处理后的发色图）
+                logger.info(f"Running color transfer task...")
+                task_id = self.submit_with_asset_retry(
+                    [color_full_path, user_full_path], [color_filename, user_filename], self.run_color_task
+                )
+                if not task_id:
+                    # 上传的文件可能已失效，下次运行重新上传
+                    self._ledger_update(job_key, 'color', STATUS_FAILED, user_upload=None, color_upload=None)
+                    return
+                self._ledger_update(job_key, 'color', STATUS_SUBMITTED, task_id=task_id)
 
             # Step 3: 轮询任务状态
-            print(f"[{threading.current_thread().name}] Color task {task_id} started, waiting for completion...")
+            logger.info(f"Color task {task_id} started, waiting for completion...", extra={'task_id': task_id})
             max_wait = 1000
             wait_time = 0
             status = None
@@ -1894,87 +1721,89 @@ class HairstyleProcessor:
                 if status == "SUCCESS":
                     break
                 elif status in ["FAILED", "CANCELLED"]:
-                    print(f"[{threading.current_thread().name}] Color task failed with status: {status}")
+                    logger.error(f"Color task failed with status: {status}")
+                    self._ledger_update(job_key, 'color', STATUS_FAILED, task_id=None, last_error=status)
                     return
                 time.sleep(10)
                 wait_time += 10
                 if wait_time % 10 == 0:
-                    print(f"[{threading.current_thread().name}] Color task still processing... ({wait_time}s)")
+                    logger.debug(f"Color task still processing... ({wait_time}s)")
 
             if status != "SUCCESS":
-                print(f"[{threading.current_thread().name}] Color task did not complete successfully: {status}")
+                logger.warning(f"Color task did not complete successfully: {status}")
+                # 轮询超时（任务可能已过期或不存在），下次运行重新提交而不是再次轮询同一个task_id
+                self._ledger_update(job_key, 'color', STATUS_FAILED, task_id=None,
+                                    last_error=f"poll timeout ({status})")
                 return
 
             # Step 4: 获取结果
-            print(f"[{threading.current_thread().name}] Getting color task results...")
+            logger.info(f"Getting color task results...")
             results = self.get_task_results(task_id)
             if not results:
                 return
 
-            # Step 5: 下载结果图
-            result_paths = []
-            result_filenames = []
-            for i, result in enumerate(results):
-                result_url = result.get("fileUrl")
-                if result_url:
-                    result_filename = f"color_{user_file}_{color_file}_result_{i}.png"
-                    result_path = os.path.join(results_dir, result_filename)
-                    if self.download_image(result_url, result_path):
-                        result_paths.append(result_path)
-                        result_filenames.append(result_filename)
+            # Step 5: 并行下载结果图
+            result_paths, result_filenames = self.download_results(
+                results, results_dir, f"color_{user_file}_{color_file}_result_{{i}}.png"
+            )
 
             # === 新增：拼接两种特殊图片 ===
             start_img_path = None
             end_img_path = None
             # 1. start图：发色参考图+用户图
             start_filename = f"{color_file}_{user_file}_start.png"
-            start_img_path = os.path.join(results_dir, start_filename)
-            self.create_combined_image(color_full_path, user_full_path, [], start_img_path) 
+            start_img_path = self.create_combined_image(
+                color_full_path, user_full_path, [], os.path.join(results_dir, start_filename)
+            )
             # 2. end图：发色参考图+第一个结果图
             if result_paths:
                 end_filename = f"{color_file}_{user_file}_end.png"
-                end_img_path = os.path.join(results_dir, end_filename)
                 # 只取第一个结果图
-                self.create_combined_image(color_full_path, result_paths[0], [], end_img_path)
+                end_img_path = self.create_combined_image(
+                    color_full_path, result_paths[0], [], os.path.join(results_dir, end_filename)
+                )
 
             # 补充：原有统计和存储结果
             if result_paths:
                 # 记录结果（沿用字段名方便下游复用）
+                result_info = {
+                    'gender': 'color',
+                    'user_image': user_full_path,
+                    'hairstyle_image': color_full_path,
+                    'processed_user_image': user_full_path,
+                    'processed_hairstyle_image': color_full_path,
+                    'result_images': result_paths,
+                    'combined_image': None,  # 已被start/end图替换
+                    'user_filename': user_file,
+                    'hairstyle_filename': color_file,
+                    'result_filenames': result_filenames,
+                    'start_image': start_img_path,
+                    'end_image': end_img_path
+                }
                 with self.results_lock:
-                    self.results.append({
-                        'gender': 'color',
-                        'user_image': user_full_path,
-                        'hairstyle_image': color_full_path,
-                        'processed_user_image': user_full_path,
-                        'processed_hairstyle_image': color_full_path,
-                        'result_images': result_paths,
-                        'combined_image': None,  # 已被start/end图替换
-                        'user_filename': user_file,
-                        'hairstyle_filename': color_file,
-                        'result_filenames': result_filenames,
-                        'start_image': start_img_path,
-                        'end_image': end_img_path
-                    })
+                    self.results.append(result_info)
+                self._ledger_update(job_key, 'color', STATUS_COMPLETED, result=result_info)
                 return True
 
-            print(f"[{threading.current_thread().name}] Completed Color: {user_file} + {color_file}")
+            logger.info(f"Completed Color: {user_file} + {color_file}")
 
         except Exception as e:
-            print(f"[{threading.current_thread().name}] Error processing color {user_file} + {color_file}: {e}")
+            logger.error(f"Error processing color {user_file} + {color_file}: {e}")
 
     def process_color_folder(self, user_dir, color_dir):
         """批量处理 用户图目录 × 发色参考目录 的所有组合（并发）"""
+        # 记录每个组合的进度，中断后重新运行可续跑
+        self.open_job_ledger()
         if not os.path.exists(user_dir) or not os.path.exists(color_dir):
-            print(f"发色任务缺少目录: user_dir或color_dir不存在")
+            logger.warning("发色任务缺少目录: user_dir或color_dir不存在")
             return
 
         user_files = [f for f in os.listdir(user_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'))]
         color_files = [f for f in os.listdir(color_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'))]
 
-        print(f"Processing color: {len(color_files)} colors × {len(user_files)} users = {len(color_files) * len(user_files)} combinations")
+        logger.info(f"Processing color: {len(color_files)} colors × {len(user_files)} users = {len(color_files) * len(user_files)} combinations")
 
-        results_dir = os.path.join(self.data_dir, f"results_color_{datetime.now().strftime('%m%d')}_")
-        os.makedirs(results_dir, exist_ok=True)
+        results_dir = self._results_dir('color')
 
         tasks = []
         for user_file in user_files:
@@ -1984,9 +1813,9 @@ class HairstyleProcessor:
                 task_info = (user_full_path, color_full_path, user_file, color_file, results_dir)
                 tasks.append(task_info)
 
-        tasks = random.sample(tasks, 100)
+        tasks = self._sample(tasks, 100, 'color')
 
-        print(f"Starting concurrent color processing with {self.max_workers} workers (timeout: {self.task_timeout}s per task)...")
+        logger.info(f"Starting concurrent color processing with {self.max_workers} workers (timeout: {self.task_timeout}s per task)...")
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             future_to_task = {executor.submit(self.process_single_color_combination_with_timeout, task): task for task in tasks}
 
@@ -2003,93 +1832,43 @@ class HairstyleProcessor:
                     result = future.result(timeout=self.task_timeout + 30)
                     if result is not None:
                         successful += 1
-                        print(f"✅ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                        logger.info(f"✅ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
                     else:
                         failed += 1
-                        print(f"❌ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                        logger.info(f"❌ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
                 except concurrent.futures.TimeoutError:
                     timeout_tasks += 1
                     failed += 1
-                    print(f"⏰ Color Future timeout: {user_file} + {color_file}")
-                    print(f"⚠️ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+                    logger.warning(f"⏰ Color Future timeout: {user_file} + {color_file}")
+                    logger.info(f"⚠️ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
                 except Exception as exc:
                     failed += 1
-                    print(f"💥 Color Task {user_file} + {color_file} generated an exception: {exc}")
-                    print(f"❌ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
-
-            print(f"\n=== 发色处理完成统计 ===")
-            print(f"总任务数: {len(tasks)}")
-            print(f"成功完成: {successful}")
-            print(f"失败任务: {failed}")
-            print(f"超时任务: {self.timeout_count}")
-            print(f"成功率: {(successful/len(tasks)*100):.1f}%")
-            print(f"===================")
-
-        print(f"Completed processing color folder")
+                    logger.error(f"💥 Color Task {user_file} + {color_file} generated an exception: {exc}")
+                    logger.info(f"❌ Color Progress: {completed}/{len(tasks)} - Success: {successful}, Failed: {failed}, Timeout: {timeout_tasks}")
+
+            logger.info("=== 发色处理完成统计 ===")
+            logger.info(f"总任务数: {len(tasks)}")
+            logger.info(f"成功完成: {successful}")
+            logger.info(f"失败任务: {failed}")
+            logger.info(f"超时任务: {self.timeout_count}")
+            logger.info(f"成功率: {(successful/len(tasks)*100):.1f}%")
+            logger.info("===================")
+
+        logger.info("Completed processing color folder")
     
     def create_word_document(self, output_path="hairstyle_results.docx"):
-        """Create Word document with all results"""
-        doc = Document()
-        doc.add_heading('发型换装结果', 0)
-        
-        doc.add_paragraph(f'生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-        doc.add_paragraph(f'总共处理: {len(self.results)} 个组合')
-        
-        for i, result in enumerate(self.results):
-            doc.add_heading(f'结果 {i+1}: {result["gender"]} - {result["user_filename"]} + {result["hairstyle_filename"]}', level=1)
-            
-            # Add combined image if available
-            if result.get('combined_image') and os.path.exists(result['combined_image']):
-                doc.add_paragraph('拼接图片 (发型参考 + 用户照片 + 生成结果):')
-                width, height = self.resize_image_for_word(result['combined_image'], max_width=6.0)  # Wider for combined image
-                paragraph = doc.add_paragraph()
-                run = paragraph.add_run()
-                run.add_picture(result['combined_image'], width=Inches(width), height=Inches(height))
-                doc.add_paragraph()  # Add some space
-            
-            # Create table for individual images
-            doc.add_paragraph('单独图片:')
-            result_images = result.get('result_images', [])
-            num_cols = 2 + len(result_images)  # hairstyle + user + result images
-            table = doc.add_table(rows=2, cols=num_cols)
-            table.style = 'Table Grid'
-            
-            # Headers
-            hdr_cells = table.rows[0].cells
-            hdr_cells[0].text = '发型参考图'
-            hdr_cells[1].text = '用户照片'
-            for j in range(len(result_images)):
-                hdr_cells[2 + j].text = f'生成结果{j+1}'
-            
-            # Images
-            img_cells = table.rows[1].cells
-            
-            # Add hairstyle image
-            if os.path.exists(result['hairstyle_image']):
-                width, height = self.resize_image_for_word(result['hairstyle_image'])
-                paragraph = img_cells[0].paragraphs[0]
-                run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                run.add_picture(result['hairstyle_image'], width=Inches(width), height=Inches(height))
-            
-            # Add user image
-            if os.path.exists(result['user_image']):
-                width, height = self.resize_image_for_word(result['user_image'])
-                paragraph = img_cells[1].paragraphs[0]
-                run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                run.add_picture(result['user_image'], width=Inches(width), height=Inches(height))
-            
-            # Add result images
-            for j, result_image in enumerate(result_images):
-                if os.path.exists(result_image):
-                    width, height = self.resize_image_for_word(result_image)
-                    paragraph = img_cells[2 + j].paragraphs[0]
-                    run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                    run.add_picture(result_image, width=Inches(width), height=Inches(height))
-            
-            doc.add_page_break()
-        
-        doc.save(output_path)
-        print(f"Word document saved: {output_path}")
+        """Create Word document(s) with all results, returns the list of written documents
+
+        Images are embedded as downscaled JPEG copies; large batches are split into
+        several documents (REPORT_RESULTS_PER_DOCUMENT).
+        """
+        with ReportBuilder.from_env() as builder:
+            return builder.write_docx(self.results, output_path)
+
+    def create_zip_report(self, output_path="hairstyle_results.zip"):
+        """Create a ZIP report (index.html + downscaled images) with all results"""
+        with ReportBuilder.from_env() as builder:
+            return builder.write_zip(self.results, output_path)
 
     def get_cache_info(self):
         """获取缓存信息"""
@@ -2118,7 +1897,7 @@ class HairstyleProcessor:
                             cache_info[image_type]['total_size'] += file_stat.st_size
                             cache_info[image_type]['total_files'] += 1
                 except Exception as e:
-                    print(f"获取{image_type}缓存信息失败: {e}")
+                    logger.error(f"获取{image_type}缓存信息失败: {e}")
 
         return cache_info
 
@@ -2207,10 +1986,10 @@ class HairstyleProcessor:
                         if filename_hash:
                             del cache_index[filename_hash]
 
-                        print(f"删除缓存文件: {file_info['filename']} ({file_info['size'] / 1024:.1f}KB)")
+                        logger.info(f"删除缓存文件: {file_info['filename']} ({file_info['size'] / 1024:.1f}KB)")
 
                     except Exception as e:
-                        print(f"删除文件失败 {file_info['filepath']}: {e}")
+                        logger.error(f"删除文件失败 {file_info['filepath']}: {e}")
 
                 # 更新缓存索引
                 if cleaned_files_in_type > 0:
@@ -2218,21 +1997,33 @@ class HairstyleProcessor:
                         with open(cache_index_path, 'w', encoding='utf-8') as f:
                             json.dump(cache_index, f, ensure_ascii=False, indent=2)
                     except Exception as e:
-                        print(f"更新{image_type}缓存索引失败: {e}")
+                        logger.error(f"更新{image_type}缓存索引失败: {e}")
 
                 total_cleaned_files += cleaned_files_in_type
                 total_cleaned_size += cleaned_size_in_type
 
                 if cleaned_files_in_type > 0:
-                    print(f"清理{image_type}缓存: {cleaned_files_in_type}个文件, {cleaned_size_in_type / 1024:.1f}KB")
+                    logger.info(f"清理{image_type}缓存: {cleaned_files_in_type}个文件, {cleaned_size_in_type / 1024:.1f}KB")
 
             except Exception as e:
-                print(f"清理{image_type}缓存目录失败: {e}")
+                logger.error(f"清理{image_type}缓存目录失败: {e}")
+
+        # 清理上传前变换缓存
+        try:
+            upload_cleaned_files, upload_cleaned_size = self.upload_transformer.prune(
+                max_age_hours=max_age_hours, max_total_size_mb=max_total_size_mb
+            )
+            if upload_cleaned_files > 0:
+                logger.info(f"清理上传缓存: {upload_cleaned_files}个文件, {upload_cleaned_size / 1024:.1f}KB")
+            total_cleaned_files += upload_cleaned_files
+            total_cleaned_size += upload_cleaned_size
+        except Exception as e:
+            logger.error(f"清理上传缓存目录失败: {e}")
 
         if total_cleaned_files > 0:
-            print(f"缓存清理完成: 总计删除{total_cleaned_files}个文件, {total_cleaned_size / 1024:.1f}KB")
+            logger.info(f"缓存清理完成: 总计删除{total_cleaned_files}个文件, {total_cleaned_size / 1024:.1f}KB")
         else:
-            print("无需清理缓存文件")
+            logger.info("无需清理缓存文件")
 
         return {
             'cleaned_files': total_cleaned_files,
@@ -2251,7 +2042,7 @@ class HairstyleProcessor:
                 'usage_percent': (used / total) * 100
             }
         except Exception as e:
-            print(f"获取磁盘使用情况失败: {e}")
+            logger.error(f"获取磁盘使用情况失败: {e}")
             return None
 
     def delete_cache_file(self, file_path, image_type):
@@ -2263,12 +2054,12 @@ class HairstyleProcessor:
             normalized_cache_dir = os.path.normpath(cache_dir)
 
             if not normalized_file_path.startswith(normalized_cache_dir):
-                print(f"安全检查失败: 文件路径不在缓存目录内 {file_path}")
+                logger.error(f"安全检查失败: 文件路径不在缓存目录内 {file_path}")
                 return False
 
             # 检查文件是否存在
             if not os.path.exists(file_path):
-                print(f"文件不存在: {file_path}")
+                logger.warning(f"文件不存在: {file_path}")
                 return False
 
             # 获取文件大小（用于统计）
@@ -2299,13 +2090,13 @@ class HairstyleProcessor:
                             json.dump(cache_index, f, ensure_ascii=False, indent=2)
 
                 except Exception as e:
-                    print(f"更新缓存索引失败: {e}")
+                    logger.error(f"更新缓存索引失败: {e}")
 
-            print(f"删除缓存文件成功: {os.path.basename(file_path)} ({file_size / 1024:.1f}KB)")
+            logger.info(f"删除缓存文件成功: {os.path.basename(file_path)} ({file_size / 1024:.1f}KB)")
             return True
 
         except Exception as e:
-            print(f"删除缓存文件失败 {file_path}: {e}")
+            logger.error(f"删除缓存文件失败 {file_path}: {e}")
             return False
 
     def get_cache_files_detailed(self):
@@ -2361,13 +2152,13 @@ class HairstyleProcessor:
                                     'created_time_str': datetime.fromtimestamp(file_stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S')
                                 })
                             except Exception as e:
-                                print(f"获取文件 {filename} 信息失败: {e}")
+                                logger.error(f"获取文件 {filename} 信息失败: {e}")
 
                     # 按修改时间排序（新的在前）
                     cache_files[image_type].sort(key=lambda x: x['modified_time'], reverse=True)
 
                 except Exception as e:
-                    print(f"获取{image_type}缓存文件详情失败: {e}")
+                    logger.error(f"获取{image_type}缓存文件详情失败: {e}")
 
         return cache_files
 
@@ -2375,62 +2166,61 @@ class HairstyleProcessor:
         """计算并显示run_hairstyle_task和Gemini预处理的统计信息"""
 
         # RunningHub任务统计
-        if not self.task_times:
-            print("没有RunningHub任务运行记录")
+        task_stats = self.task_times.snapshot()
+        if not task_stats['count']:
+            logger.info("没有RunningHub任务运行记录")
             runninghub_avg = 0.0
         else:
-            total_time = sum(self.task_times)
-            runninghub_avg = total_time / len(self.task_times)
-            min_time = min(self.task_times)
-            max_time = max(self.task_times)
-
-            print(f"\n=== RunningHub任务统计 ===")
-            print(f"总任务数: {len(self.task_times)}")
-            print(f"总运行时间: {total_time:.2f}秒")
-            print(f"平均运行时间: {runninghub_avg:.2f}秒")
-            print(f"最短运行时间: {min_time:.2f}秒")
-            print(f"最长运行时间: {max_time:.2f}秒")
-            print(f"========================\n")
+            runninghub_avg = task_stats['mean']
+
+            logger.info("=== RunningHub任务统计 ===")
+            logger.info(f"总任务数: {task_stats['count']}")
+            logger.info(f"总运行时间: {task_stats['total']:.2f}秒")
+            logger.info(f"平均运行时间: {runninghub_avg:.2f}秒 (标准差 {task_stats['stddev']:.2f}秒)")
+            logger.info(f"P50/P95运行时间: {task_stats['p50']:.2f}秒 / {task_stats['p95']:.2f}秒")
+            logger.info(f"最短运行时间: {task_stats['min']:.2f}秒")
+            logger.info(f"最长运行时间: {task_stats['max']:.2f}秒")
+            logger.info("========================")
 
         # Gemini预处理统计
-        if not self.gemini_times:
-            print("没有Gemini预处理记录")
+        gemini_stats = self.gemini_times.snapshot()
+        if not gemini_stats['count']:
+            logger.info("没有Gemini预处理记录")
             gemini_avg = 0.0
         else:
-            total_gemini_time = sum(self.gemini_times)
-            gemini_avg = total_gemini_time / len(self.gemini_times)
-            min_gemini_time = min(self.gemini_times)
-            max_gemini_time = max(self.gemini_times)
-
-            print(f"=== Gemini预处理统计 ===")
-            print(f"总预处理请求数: {len(self.gemini_times)}")
-            print(f"成功处理数: {self.gemini_success_count}")
-            print(f"失败处理数: {self.gemini_fail_count}")
-            print(f"成功率: {(self.gemini_success_count / (self.gemini_success_count + self.gemini_fail_count) * 100):.1f}%" if (self.gemini_success_count + self.gemini_fail_count) > 0 else "N/A")
-            print(f"总预处理时间: {total_gemini_time:.2f}秒")
-            print(f"平均预处理时间: {gemini_avg:.2f}秒")
-            print(f"最短预处理时间: {min_gemini_time:.2f}秒")
-            print(f"最长预处理时间: {max_gemini_time:.2f}秒")
-            print(f"========================\n")
+            gemini_avg = gemini_stats['mean']
+
+            logger.info("=== Gemini预处理统计 ===")
+            logger.info(f"总预处理请求数: {gemini_stats['count']}")
+            logger.info(f"成功处理数: {self.gemini_success_count}")
+            logger.info(f"失败处理数: {self.gemini_fail_count}")
+            logger.info(f"成功率: {(self.gemini_success_count / (self.gemini_success_count + self.gemini_fail_count) * 100):.1f}%" if (self.gemini_success_count + self.gemini_fail_count) > 0 else "N/A")
+            logger.info(f"总预处理时间: {gemini_stats['total']:.2f}秒")
+            logger.info(f"平均预处理时间: {gemini_avg:.2f}秒")
+            logger.info(f"P50/P95预处理时间: {gemini_stats['p50']:.2f}秒 / {gemini_stats['p95']:.2f}秒")
+            logger.info(f"最短预处理时间: {gemini_stats['min']:.2f}秒")
+            logger.info(f"最长预处理时间: {gemini_stats['max']:.2f}秒")
+            logger.info("========================")
 
         # 综合统计
         total_processed_combinations = len(self.results)
         if total_processed_combinations > 0 or self.timeout_count > 0:
-            print(f"=== 综合处理统计 ===")
-            print(f"处理的图像组合数: {total_processed_combinations}")
-            print(f"超时任务数: {self.timeout_count}")
+            logger.info("=== 综合处理统计 ===")
+            logger.info(f"处理的图像组合数: {total_processed_combinations}")
+            logger.info(f"超时任务数: {self.timeout_count}")
             if self.timeout_count > 0:
                 total_attempts = total_processed_combinations + self.timeout_count
-                print(f"任务成功率: {(total_processed_combinations/total_attempts*100):.1f}%")
-                print(f"任务超时率: {(self.timeout_count/total_attempts*100):.1f}%")
-            print(f"平均RunningHub任务时间: {runninghub_avg:.2f}秒")
-            print(f"平均Gemini预处理时间: {gemini_avg:.2f}秒")
-            print(f"任务超时限制: {self.task_timeout}秒")
-            print(f"===================\n")
+                logger.info(f"任务成功率: {(total_processed_combinations/total_attempts*100):.1f}%")
+                logger.info(f"任务超时率: {(self.timeout_count/total_attempts*100):.1f}%")
+            logger.info(f"平均RunningHub任务时间: {runninghub_avg:.2f}秒")
+            logger.info(f"平均Gemini预处理时间: {gemini_avg:.2f}秒")
+            logger.info(f"任务超时限制: {self.task_timeout}秒")
+            logger.info("===================")
 
         return runninghub_avg
 
 def main():
+    setup_logging(default_format='text')
     hair_base_path = "/Users/alex_wu/work/hair"
     
     # Set random seed for reproducible results
@@ -2456,7 +2246,7 @@ def main():
     user_dir_for_color = "/Users/alex_wu/work/hair/woman/wanghong"
     color_dir = "/Users/alex_wu/work/hair/color"
     if os.path.exists(user_dir_for_color) and os.path.exists(color_dir):
-        print("Starting color transfer processing...")
+        logger.info("Starting color transfer processing...")
         processor.process_color_folder(user_dir_for_color, color_dir)
 
     # Create Word document with all results
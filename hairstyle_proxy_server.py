@@ -1,26 +1,44 @@
-from flask import Flask, request, jsonify, render_template_string, session
+import logging
+from flask import Flask, request, jsonify, render_template_string, session, send_file, redirect
 from flask_cors import CORS
 import tempfile
 import os
 import uuid
-from hairstyle_processor_v2 import HairstyleProcessor
+from hairstyle_processor_v2 import HairstyleProcessor, env_bool
+from image_utils import draft_to_scale, file_content_hash, ThumbnailCache
+from result_mirror import ResultMirror
+from runninghub_client import request_deadline, remaining_time, DeadlineExceeded
+import metrics
+import tracing
+from logging_setup import setup_logging
 import threading
 import time
 import hashlib
+import hmac
+import secrets
 import datetime
 from datetime import timedelta
 import sqlite3
 import json
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlparse
 import jwt
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from PIL import Image, ImageOps
 
+setup_logging()
+logger = logging.getLogger(__name__)
+
 # JWT 配置
 JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'hairstyle-admin-secret-key-change-in-production')
 JWT_ACCESS_TOKEN_EXPIRES = 3600      # 1小时
 JWT_REFRESH_TOKEN_EXPIRES = 604800   # 7天
 app = Flask(__name__)
+# Railway 在 gunicorn 前面终止 TLS：按代理的 X-Forwarded-Proto/Host 还原外部地址，
+# 否则 request.host_url 等生成的镜像结果地址会变成 http://
+app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'hairstyle-admin-session-secret-key')
 app.permanent_session_lifetime = timedelta(days=7)  # Session 有效期7天
 CORS(app, supports_credentials=True)
@@ -28,27 +46,51 @@ CORS(app, supports_credentials=True)
 # 全局存储临时会话数据（生产环境建议用Redis）
 sessions = {}
 
+# 上传图片入库配置：输出边长上限、JPEG质量，以及是否在后台线程池中处理
+UPLOAD_INGEST_MAX_SIDE = int(os.environ.get('UPLOAD_INGEST_MAX_SIDE', '1536'))
+UPLOAD_INGEST_QUALITY = int(os.environ.get('UPLOAD_INGEST_QUALITY', '90'))
+UPLOAD_INGEST_ASYNC = env_bool('UPLOAD_INGEST_ASYNC', False)
+ingest_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('UPLOAD_INGEST_WORKERS', '4')),
+    thread_name_prefix='upload-ingest'
+)
+# (session_id, image_type) -> 后台入库任务的Future，由ingest_lock保护（prefetch_futures同样由它保护）
+ingest_futures = {}
+ingest_lock = threading.Lock()
+
+# 推测式预上传：图片到达后立即在后台上传到RunningHub，
+# 开始处理时直接使用已得到的fileName，上传不再占用处理耗时
+SPECULATIVE_UPLOAD_ENABLED = env_bool('SPECULATIVE_UPLOAD_ENABLED', False)
+prefetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SPECULATIVE_UPLOAD_WORKERS', '4')),
+    thread_name_prefix='upload-prefetch'
+)
+# (session_id, image_type) -> (图片路径, 预上传任务的Future)，由ingest_lock保护
+prefetch_futures = {}
+# 等待预上传时检查取消的间隔（秒）
+PREFETCH_WAIT_SLICE = 1.0
+
 def ensure_data_directory():
     """确保数据目录存在并有适当的权限"""
     data_dir = os.environ.get('RAILWAY_VOLUME_MOUNT_PATH', '/data')
     try:
         if not os.path.exists(data_dir):
             os.makedirs(data_dir, exist_ok=True)
-            print(f"创建数据目录: {data_dir}")
+            logger.info(f"创建数据目录: {data_dir}")
         
         # 检查目录权限
         if not os.access(data_dir, os.W_OK):
-            print(f"警告: 数据目录 {data_dir} 没有写权限")
+            logger.warning(f"警告: 数据目录 {data_dir} 没有写权限")
         else:
-            print(f"数据目录就绪: {data_dir}")
+            logger.debug(f"数据目录就绪: {data_dir}")
             
         return data_dir
     except Exception as e:
-        print(f"初始化数据目录失败: {e}")
+        logger.error(f"初始化数据目录失败: {e}")
         # 回退到当前目录
         fallback_dir = os.path.join(os.getcwd(), 'data')
         os.makedirs(fallback_dir, exist_ok=True)
-        print(f"使用回退数据目录: {fallback_dir}")
+        logger.info(f"使用回退数据目录: {fallback_dir}")
         return fallback_dir
 
 def crop_to_square(img):
@@ -61,16 +103,153 @@ def crop_to_square(img):
     top = (height - size) // 2
     return img.crop((left, top, left + size, top + size))
 
+def ingest_upload_image(source, dest_path, max_side=UPLOAD_INGEST_MAX_SIDE, quality=UPLOAD_INGEST_QUALITY):
+    """处理上传图片：按目标尺寸解码JPEG、修正EXIF方向、居中裁剪为正方形、限制分辨率后保存"""
+    with Image.open(source) as img:
+        # 裁剪后的边长等于短边，JPEG直接按短边目标尺寸缩放解码
+        if max_side:
+            draft_to_scale(img, max_side / min(img.size))
+
+        img = ImageOps.exif_transpose(img)  # 自动根据EXIF方向旋转图片
+
+        # 先裁剪为1:1正方形（居中裁剪），再缩放和转换，减少处理的像素
+        img = crop_to_square(img)
+        if max_side and img.width > max_side:
+            img = img.resize((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        # 转换为RGB模式（避免PNG透明通道问题）
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        img.save(dest_path, 'JPEG', quality=quality)
+    return dest_path
+
+def _ingest_raw_upload(raw_path, dest_path):
+    """后台入库：处理原始上传文件后删除原始文件"""
+    try:
+        with tracing.span('image.ingest', background=True):
+            return ingest_upload_image(raw_path, dest_path)
+    finally:
+        try:
+            os.remove(raw_path)
+        except OSError:
+            pass
+
+def _discard_ingest(future):
+    """丢弃后台入库任务：任务完成后删除其输出文件，避免仍在运行的任务在清理之后再写出孤立文件"""
+    def _remove_output(done_future):
+        try:
+            path = done_future.result()
+        except Exception:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    future.add_done_callback(_remove_output)
+
+def set_ingest_future(session_id, image_type, future=None):
+    """登记（future为None时清除）图片的后台入库任务，被替换的旧任务完成后删除其输出"""
+    key = (session_id, image_type)
+    with ingest_lock:
+        previous = ingest_futures.pop(key, None)
+        if future is not None:
+            ingest_futures[key] = future
+    if previous is not None:
+        _discard_ingest(previous)
+
+def wait_for_ingest(session_id, image_type, timeout=60):
+    """等待后台入库完成，成功或无后台任务时返回True"""
+    with ingest_lock:
+        future = ingest_futures.get((session_id, image_type))
+    if future is None:
+        return True
+    try:
+        future.result(timeout=timeout)
+        return True
+    except Exception as e:
+        logger.error(f"{image_type}图片后台处理失败: {e}", extra={'session_id': session_id})
+        return False
+
+def _prefetch_upload(session_id, image_type, image_path):
+    """后台预上传：等待入库完成后上传到RunningHub，返回fileName"""
+    with tracing.session_trace(session_id), tracing.span('prefetch', image_type=image_type), \
+            metrics.job_context('prefetch'):
+        return _run_prefetch_upload(session_id, image_type, image_path)
+
+def _run_prefetch_upload(session_id, image_type, image_path):
+    if not wait_for_ingest(session_id, image_type):
+        return None
+
+    # 入库期间图片已被替换或删除时不再上传
+    with session_lock:
+        session_data = sessions.get(session_id)
+        if not session_data or session_data.get(f'{image_type}_image') != image_path:
+            return None
+    file_name = processor.upload_image(image_path)
+    if file_name:
+        logger.info(f"{image_type}图片预上传完成: {file_name}", extra={'session_id': session_id})
+    return file_name
+
+def set_prefetch_future(session_id, image_type, image_path=None, future=None):
+    """登记（future为None时清除）图片的预上传任务，被替换的旧任务尚未开始时直接取消"""
+    key = (session_id, image_type)
+    with ingest_lock:
+        previous = prefetch_futures.pop(key, None)
+        if future is not None:
+            prefetch_futures[key] = (image_path, future)
+    if previous is not None:
+        previous[1].cancel()
+
+def start_prefetch(session_id, image_type, image_path):
+    """开启推测式预上传时，提交图片的后台上传任务"""
+    if not SPECULATIVE_UPLOAD_ENABLED or processor is None:
+        set_prefetch_future(session_id, image_type)
+        return
+    set_prefetch_future(session_id, image_type, image_path,
+                        prefetch_executor.submit(_prefetch_upload, session_id, image_type, image_path))
+
+def wait_for_prefetch(session_id, image_path, check_cancel, timeout=120):
+    """返回图片预上传得到的fileName；没有预上传或预上传失败时返回None
+
+    最多等待timeout秒且不超过会话剩余时间，等待期间每隔PREFETCH_WAIT_SLICE秒检查一次取消。
+    """
+    with ingest_lock:
+        entries = [(image_type, prefetch_futures.get((session_id, image_type))) for image_type in ('user', 'hairstyle')]
+    for image_type, entry in entries:
+        if entry is None or entry[0] != image_path:
+            continue
+        remaining = remaining_time()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded("等待预上传前已超出会话截止时间")
+            timeout = min(timeout, remaining)
+        deadline = time.monotonic() + timeout
+        while True:
+            raise_if_cancelled(session_id, check_cancel, f"等待{image_type}图片预上传时")
+            left = deadline - time.monotonic()
+            if left <= 0:
+                logger.warning(f"{image_type}图片预上传等待超时 ({timeout:.0f}秒)", extra={'session_id': session_id})
+                return None
+            try:
+                return entry[1].result(timeout=min(left, PREFETCH_WAIT_SLICE))
+            except FutureTimeoutError:
+                continue
+            except Exception as e:
+                logger.error(f"{image_type}图片预上传失败: {e}", extra={'session_id': session_id})
+                return None
+    return None
+
 # 数据库初始化
 def init_database():
     """初始化SQLite数据库"""
     data_dir = ensure_data_directory()
 
     db_path = os.path.join(data_dir, 'hairstyle_auth.db')
-    print(f"数据库路径: {db_path}")
-    print(f"数据目录是否存在: {os.path.exists(data_dir)}")
-    print(f"数据库文件是否存在: {os.path.exists(db_path)}")
-    print(f"RAILWAY_VOLUME_MOUNT_PATH环境变量: {os.environ.get('RAILWAY_VOLUME_MOUNT_PATH', '未设置')}")
+    logger.debug(f"数据库路径: {db_path}")
+    logger.debug(f"数据目录是否存在: {os.path.exists(data_dir)}")
+    logger.debug(f"数据库文件是否存在: {os.path.exists(db_path)}")
+    logger.debug(f"RAILWAY_VOLUME_MOUNT_PATH环境变量: {os.environ.get('RAILWAY_VOLUME_MOUNT_PATH', '未设置')}")
 
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
@@ -155,7 +334,7 @@ def init_database():
     # 尝试为现有 devices 表添加 shop_id 列（如果不存在）
     try:
         cursor.execute('ALTER TABLE devices ADD COLUMN shop_id INTEGER REFERENCES shops(id)')
-        print("为 devices 表添加了 shop_id 列")
+        logger.info("为 devices 表添加了 shop_id 列")
     except sqlite3.OperationalError:
         pass  # 列已存在
 
@@ -185,7 +364,7 @@ def init_database():
                 VALUES (?, ?, ?)
             ''', (code, sub_type, days))
         conn.commit()
-        print(f"初始化了 {len(test_codes)} 个测试激活码到数据库")
+        logger.info(f"初始化了 {len(test_codes)} 个测试激活码到数据库")
 
     # 检查是否有超级管理员，如果没有则创建默认超级管理员
     cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'super_admin'")
@@ -198,7 +377,7 @@ def init_database():
             VALUES (?, ?, ?, ?, ?)
         ''', ('admin', default_password, '超级管理员', 'super_admin', 'active'))
         conn.commit()
-        print("创建了默认超级管理员账号: admin / admin123")
+        logger.info("创建了默认超级管理员账号: admin / admin123")
 
     conn.close()
 
@@ -921,15 +1100,83 @@ init_database()
 # 初始化处理器，从环境变量获取API密钥
 try:
     processor = HairstyleProcessor()
-    print("HairstyleProcessor initialized successfully")
+    logger.info("HairstyleProcessor initialized successfully")
 except ValueError as e:
-    print(f"Warning: {e}")
-    print("Please set RUNNINGHUB_API_KEY environment variable in Railway")
+    logger.warning(f"Warning: {e}")
+    logger.warning("Please set RUNNINGHUB_API_KEY environment variable in Railway")
     processor = None
 
 # 简单的内存存储锁
 session_lock = threading.Lock()
 
+# 会话取消标志：取消检查在共享事件循环的协程里频繁调用，读Event不需要获取session_lock
+cancel_events = {}
+
+
+def session_cancel_event(session_id):
+    """返回会话的取消Event（不存在时创建）"""
+    return cancel_events.setdefault(session_id, threading.Event())
+
+# 生成结果镜像：任务完成后把远端结果下载到本地，由 /api/result 提供访问
+RESULT_MIRROR_ENABLED = env_bool('RESULT_MIRROR_ENABLED', True)
+RESULT_MIRROR_MAX_AGE_HOURS = int(os.environ.get('RESULT_MIRROR_MAX_AGE_HOURS', '72'))
+result_mirror = None
+if RESULT_MIRROR_ENABLED:
+    try:
+        result_mirror = ResultMirror(
+            ensure_data_directory(),
+            max_workers=int(os.environ.get('RESULT_MIRROR_WORKERS', '4'))
+        )
+    except Exception as e:
+        logger.error(f"初始化结果镜像失败: {e}")
+        result_mirror = None
+
+# 管理后台缓存浏览使用的缩略图缓存
+try:
+    thumbnail_cache = ThumbnailCache.from_env(os.path.join(ensure_data_directory(), 'thumb_cache'))
+except Exception as e:
+    logger.error(f"初始化缩略图缓存失败: {e}")
+    thumbnail_cache = None
+
+# 3D任务完成回调：配置公网地址后，服务商完成任务时回调 /api/callback/3d 立即触发一次状态查询
+VIDEO_3D_CALLBACK_BASE_URL = os.environ.get('VIDEO_3D_CALLBACK_BASE_URL', '').rstrip('/')
+
+def video_3d_callback_url(session_id, token):
+    """返回会话的3D任务回调地址，未配置回调时返回None"""
+    if not VIDEO_3D_CALLBACK_BASE_URL:
+        return None
+    return f"{VIDEO_3D_CALLBACK_BASE_URL}/api/callback/3d/{session_id}/{token}"
+
+def session_provider(session_id, job_type):
+    """任务类型对应的服务商（3D任务为会话实际使用的服务商），用于指标标签"""
+    if job_type == '3d':
+        return sessions.get(session_id, {}).get('provider_3d') or 'unknown'
+    return 'runninghub'
+
+def mirror_session_results(session_id, result_urls, job_type=None):
+    """在后台镜像会话的生成结果"""
+    if result_mirror is None or not result_urls:
+        return
+    job_type = job_type or metrics.current_job_type()
+    result_mirror.mirror_all(result_urls, session_provider(session_id, job_type), job_type)
+    logger.debug(f"已提交 {len(result_urls)} 个结果镜像任务", extra={'session_id': session_id})
+
+def send_cached_file(path, mimetype, etag=None, immutable=False, max_age=None):
+    """发送本地文件，支持ETag/Last-Modified条件请求(304)和Range请求
+
+    etag默认使用文件内容哈希；immutable用于按内容哈希命名、不会变化的文件，
+    其余文件不指定max_age时要求客户端每次用ETag重新验证。
+    """
+    if etag is None:
+        etag = file_content_hash(path)
+    if immutable:
+        max_age = 31536000
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=max_age)
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
 # ==================== 认证 API ====================
 
 @app.route('/api/auth/login', methods=['POST'])
@@ -1565,15 +1812,21 @@ def home():
             "upload_page": "GET /upload/<session_id>/<image_type>",
             "upload_image": "POST /api/upload/<session_id>/<image_type>",
             "process_hairstyle": "POST /api/process/<session_id>",
+            "process_pipeline": "POST /api/pipeline/<session_id>",
             "get_session": "GET /api/session/<session_id>",
+            "get_result": "GET /api/result/<session_id>/<index>?v=<sha256>",
+            "video_3d_callback": "POST /api/callback/3d/<session_id>/<token>",
             "cancel_session": "POST /api/cancel-session/<session_id>",
             "cancel_task": "POST /task/openapi/cancel",
             "cache_info": "GET /api/admin/cache/info",
             "clean_cache": "POST /api/admin/cache/clean",
             "system_status": "GET /api/admin/system/status",
+            "metrics": "GET /metrics",
+            "session_trace": "GET /api/admin/session/<session_id>/trace",
             "list_cache_files": "GET /api/admin/cache/files",
             "delete_cache_file": "DELETE /api/admin/cache/files/<image_type>/<filename>",
-            "serve_cache_image": "GET /api/admin/cache/image/<image_type>/<filename>"
+            "serve_cache_image": "GET /api/admin/cache/image/<image_type>/<filename>",
+            "serve_cache_thumbnail": "GET /api/admin/cache/thumb/<image_type>/<filename>?size=128|256|512&format=webp|jpeg"
         }
     })
 
@@ -1773,39 +2026,39 @@ def upload_image(session_id, image_type):
     if file.filename == '':
         return jsonify({'success': False, 'error': '文件名为空'}), 400
 
-    try:
-        # 获取数据目录并创建临时文件目录
-        data_dir = ensure_data_directory()
-        temp_dir = os.path.join(data_dir, 'temp_uploads')
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir, exist_ok=True)
+    with tracing.session_trace(session_id), tracing.span('image.receive', image_type=image_type) as receive_span:
+        try:
+            # 获取数据目录并创建临时文件目录
+            data_dir = ensure_data_directory()
+            temp_dir = os.path.join(data_dir, 'temp_uploads')
+            if not os.path.exists(temp_dir):
+                os.makedirs(temp_dir, exist_ok=True)
         
-        # 保存到临时文件
-        temp_filename = f"{session_id}_{image_type}_{int(time.time() * 1000)}.jpg"
-        temp_filepath = os.path.join(temp_dir, temp_filename)
-
-        # 使用PIL处理EXIF方向，修复图片旋转问题
-        img = Image.open(file.stream)
-        img = ImageOps.exif_transpose(img)  # 自动根据EXIF方向旋转图片
-
-        # 转换为RGB模式（避免PNG透明通道问题）
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-
-        # 裁剪为1:1正方形（居中裁剪）
-        img = crop_to_square(img)
-
-        # 保存处理后的图片
-        img.save(temp_filepath, 'JPEG', quality=95)
+            # 保存到临时文件
+            temp_filename = f"{session_id}_{image_type}_{int(time.time() * 1000)}.jpg"
+            temp_filepath = os.path.join(temp_dir, temp_filename)
+
+            if UPLOAD_INGEST_ASYNC:
+                # 先保存原始文件立即返回，解码/裁剪/压缩在后台线程池完成
+                raw_filepath = f"{temp_filepath}.raw"
+                file.save(raw_filepath)
+                set_ingest_future(session_id, image_type, ingest_executor.submit(
+                    tracing.wrap(_ingest_raw_upload), raw_filepath, temp_filepath
+                ))
+            else:
+                set_ingest_future(session_id, image_type)
+                with tracing.span('image.ingest', background=False):
+                    ingest_upload_image(file.stream, temp_filepath)
 
-        # 创建图片访问URL，添加时间戳避免缓存
-        base_url = request.url_root.rstrip('/')
-        timestamp = int(time.time() * 1000)  # 使用毫秒时间戳
-        image_url = f"{base_url}/api/image/{session_id}/{image_type}?t={timestamp}"
+            # 创建图片访问URL，添加时间戳避免缓存
+            base_url = request.url_root.rstrip('/')
+            timestamp = int(time.time() * 1000)  # 使用毫秒时间戳
+            image_url = f"{base_url}/api/image/{session_id}/{image_type}?t={timestamp}"
 
-        with session_lock:
-            sessions[session_id][f'{image_type}_image'] = temp_filepath
-            sessions[session_id][f'{image_type}_image_url'] = image_url
+            with session_lock:
+                sessions[session_id][f'{image_type}_image'] = temp_filepath
+                sessions[session_id][f'{image_type}_image_url'] = image_url
+            start_prefetch(session_id, image_type, temp_filepath)
 
             return jsonify({
                 'success': True,
@@ -1813,8 +2066,9 @@ def upload_image(session_id, image_type):
                 'image_url': image_url
             })
 
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        except Exception as e:
+            receive_span.fail(e)
+            return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/session/<session_id>')
 def get_session(session_id):
@@ -1839,7 +2093,30 @@ def get_session(session_id):
 
     # 如果处理完成，返回结果URL
     if session_data['status'] == 'completed' and 'result_urls' in session_data:
-        response['result_urls'] = session_data['result_urls']
+        remote_urls = session_data['result_urls']
+        response['result_urls'] = remote_urls
+        # 已镜像到本地的结果改为本服务地址，重复查看不再访问远端；
+        # 同一会话的后续任务会替换结果，地址带上内容哈希(v)以便客户端长期缓存
+        if result_mirror is not None:
+            response['result_urls'] = []
+            for index, url in enumerate(remote_urls):
+                entry = result_mirror.get(url)
+                response['result_urls'].append(
+                    f"{request.host_url.rstrip('/')}/api/result/{session_id}/{index}?v={entry['sha256']}"
+                    if entry else url
+                )
+            response['remote_result_urls'] = remote_urls
+
+    # 流水线进度（当前步骤及已完成步骤的结果）
+    pipeline = session_data.get('pipeline')
+    if pipeline:
+        with session_lock:
+            response['pipeline'] = {
+                'total_steps': len(pipeline['steps']),
+                'current_step': pipeline['current_step'],
+                'steps': [step['type'] for step in pipeline['steps']],
+                'step_results': list(pipeline['step_results'])
+            }
 
     # 如果处理失败，返回错误信息
     if session_data['status'] == 'failed' and 'error' in session_data:
@@ -1870,6 +2147,7 @@ def process_hairstyle(session_id):
         with session_lock:
             sessions[session_id]['status'] = 'processing'
             sessions[session_id]['cancel_requested'] = False
+            session_cancel_event(session_id).clear()
 
         # 启动后台处理线程
         processing_thread = threading.Thread(
@@ -1892,137 +2170,429 @@ def process_hairstyle(session_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-def process_hairstyle_async(session_id):
-    """异步处理发型转换的后台函数"""
+# 单个处理步骤的整体时限（秒）：RunningHub每次请求的超时都不会超过剩余时间
+SESSION_SLA_SECONDS = float(os.environ.get('SESSION_SLA_SECONDS', '900'))
+
+
+class StepCancelled(Exception):
+    """处理步骤中检测到取消请求"""
+
+
+def make_cancel_checker(session_id):
+    """返回会话的取消检查函数（只读Event，不获取session_lock，可在事件循环中调用）"""
+    return session_cancel_event(session_id).is_set
+
+
+def raise_if_cancelled(session_id, check_cancel, stage):
+    if check_cancel():
+        logger.info(f"{stage}检测到取消请求", extra={'session_id': session_id})
+        raise StepCancelled(stage)
+
+
+def session_step_image(session_id, image_type):
+    """会话中上传的图片，作为处理步骤的输入 {'path': 本地路径, 'url': 公网URL}"""
+    session_data = sessions.get(session_id, {})
+    return {
+        'path': session_data.get(f'{image_type}_image'),
+        'url': session_data.get(f'{image_type}_image_url'),
+    }
+
+
+# reference_url 只能是本服务的图片/结果地址，或白名单中的上游结果域名（逗号分隔，包含子域名）
+REFERENCE_URL_ALLOWED_HOSTS = [
+    host.strip().lower() for host in os.environ.get('REFERENCE_URL_ALLOWED_HOSTS', '').split(',') if host.strip()
+]
+# 下载步骤输入图片的最长等待时间（秒），同时受会话截止时间限制
+STEP_DOWNLOAD_TIMEOUT = float(os.environ.get('STEP_DOWNLOAD_TIMEOUT', '120'))
+
+
+def resolve_reference_url(url, own_host):
+    """把reference_url解析为参考图来源，不允许的地址返回None
+
+    本服务的 /api/image/<session_id>/<image_type> 直接使用该会话的本地图片，
+    /api/result/<session_id>/<index> 使用该结果的上游地址（已镜像时读本地缓存），都不经服务端请求自身；
+    其他地址只允许 REFERENCE_URL_ALLOWED_HOSTS 中的域名，防止借服务端访问内网地址。
+    """
     try:
-        session_data = sessions.get(session_id)
-        if not session_data:
-            return
+        parsed = urlparse(str(url))
+    except ValueError:
+        return None
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return None
 
-        user_image_path = session_data['user_image']
-        hairstyle_image_path = session_data['hairstyle_image']
+    if parsed.netloc == own_host:
+        parts = parsed.path.strip('/').split('/')
+        if len(parts) != 4 or parts[0] != 'api':
+            return None
+        ref_session = sessions.get(parts[2])
+        if ref_session is None:
+            return None
+        if parts[1] == 'image' and parts[3] in ('user', 'hairstyle') and ref_session.get(f'{parts[3]}_image'):
+            return {'session_id': parts[2], 'image_type': parts[3]}
+        if parts[1] == 'result' and parts[3].isdigit():
+            result_urls = ref_session.get('result_urls') or []
+            if int(parts[3]) < len(result_urls):
+                return {'url': result_urls[int(parts[3])]}
+        return None
 
-        print(f"[{session_id}] 开始Gemini预处理图像...")
-        # user_image_path, hairstyle_image_path = processor.preprocess_images_concurrently(
-        #     user_image_path, hairstyle_image_path
-        # )
+    host = parsed.hostname.lower()
+    if any(host == allowed or host.endswith('.' + allowed) for allowed in REFERENCE_URL_ALLOWED_HOSTS):
+        return {'url': parsed.geturl()}
+    return None
 
-        # 检查取消状态
-        # if sessions.get(session_id, {}).get('cancel_requested', False):
-        #     print(f"[{session_id}] 预处理完成后检测到取消请求")
-        #     with session_lock:
-        #         sessions[session_id]['status'] = 'cancelled'
-        #     return
-
-        # 上传到RunningHub
-        print(f"[{session_id}] 开始上传用户图片: {user_image_path}")
-        user_filename = processor.upload_image(user_image_path)
-        if not user_filename:
-            raise Exception("用户图片上传失败")
-        print(f"[{session_id}] 用户图片上传成功: {user_filename}")
 
-        # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 用户图片上传后检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
+def reference_step_image(reference):
+    """按 resolve_reference_url 的结果取参考图"""
+    if reference.get('session_id'):
+        if not wait_for_ingest(reference['session_id'], reference['image_type']):
+            raise Exception("参考图片处理失败")
+        image = session_step_image(reference['session_id'], reference['image_type'])
+        if not image['path'] or not os.path.exists(image['path']):
+            raise Exception("参考图片已不存在")
+        return image
+    return {'path': None, 'url': reference['url']}
+
+
+def step_image_path(session_id, image):
+    """返回步骤输入图片的本地路径，只有URL（如上一步的结果）时先下载到本地"""
+    if image.get('path'):
+        return image['path']
+
+    url = image.get('url')
+    if not url:
+        raise Exception("步骤输入图片不存在")
+
+    entry = None
+    if result_mirror is not None:
+        timeout = STEP_DOWNLOAD_TIMEOUT
+        remaining = remaining_time()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded("下载步骤输入图片前已超出会话截止时间")
+            timeout = min(timeout, remaining)
+        try:
+            entry = result_mirror.mirror(url, job_type=metrics.current_job_type()).result(timeout=timeout)
+        except FutureTimeoutError:
+            raise Exception(f"下载步骤输入图片超时 ({timeout:.0f}秒): {url}")
+    if entry:
+        image['path'] = entry['path']
+    else:
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("下载步骤输入图片时已超出会话截止时间")
+        save_path = os.path.join(ensure_data_directory(), 'temp_uploads', f"{session_id}_step_{uuid.uuid4().hex}.png")
+        with metrics.time_stage('download', 'unknown'):
+            downloaded = processor.download_image(url, save_path)
+        if not downloaded:
+            raise Exception(f"下载步骤输入图片失败: {url}")
+        image['path'] = save_path
+    logger.info(f"步骤输入图片已下载到本地: {image['path']}", extra={'session_id': session_id})
+    return image['path']
+
+
+def upload_step_image(session_id, image, label, check_cancel):
+    """上传步骤输入图片到RunningHub并返回fileName（同一内容已上传过时直接复用）"""
+    image_path = step_image_path(session_id, image)
+    filename = wait_for_prefetch(session_id, image_path, check_cancel)
+    if filename and processor.asset_registry.get('runninghub', image_path) != filename:
+        # 预上传结果已被RunningHub拒绝并从登记表删除，重新上传
+        filename = None
+    if filename:
+        logger.info(f"使用预上传的{label}: {filename}", extra={'session_id': session_id})
+    else:
+        logger.info(f"开始上传{label}: {image_path}", extra={'session_id': session_id})
+        filename = processor.upload_image(image_path)
+    if not filename:
+        raise Exception(f"{label}上传失败")
+    logger.info(f"{label}上传成功: {filename}", extra={'session_id': session_id})
+    raise_if_cancelled(session_id, check_cancel, f"{label}上传后")
+    return filename
+
+
+def start_step_task(session_id, task_id, check_cancel, label):
+    """记录已启动的任务ID；启动失败时区分取消和失败"""
+    if not task_id:
+        # 检查是否是因为取消导致的失败
+        if check_cancel():
+            logger.info(f"{label}任务启动时检测到取消请求", extra={'session_id': session_id})
+            raise StepCancelled(f"{label}任务启动")
+        raise Exception(f"{label}任务启动失败")
+    logger.info(f"{label}任务启动成功，任务ID: {task_id}", extra={'session_id': session_id, 'task_id': task_id})
+
+    # 保存task_id到session中
+    with session_lock:
+        sessions[session_id]['task_id'] = task_id
+
 
-        print(f"[{session_id}] 开始上传发型图片: {hairstyle_image_path}")
-        hairstyle_filename = processor.upload_image(hairstyle_image_path)
-        if not hairstyle_filename:
-            raise Exception("发型图片上传失败")
-        print(f"[{session_id}] 发型图片上传成功: {hairstyle_filename}")
+def wait_for_runninghub_task(session_id, task_id, check_cancel, label, max_wait=600):
+    """轮询RunningHub任务直到完成（最多10分钟，且不超过会话剩余时间），返回结果列表"""
+    remaining = remaining_time()
+    if remaining is not None:
+        max_wait = min(max_wait, remaining)
+    wait_time = 0
+    status = None
+    none_count = 0  # 记录连续None状态的次数
+    max_none_retries = 5  # 最多允许连续5次None状态
+    timer = metrics.TaskTimer('runninghub')
 
+    while wait_time < max_wait:
         # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 发型图片上传后检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
+        if check_cancel():
+            logger.info(f"{label}处理过程中检测到取消请求，尝试取消任务...", extra={'session_id': session_id})
+            processor.cancel_task(task_id)
+            raise StepCancelled(f"{label}处理过程中")
 
-        # 定义取消检查函数
-        def check_cancel():
-            with session_lock:
-                return sessions.get(session_id, {}).get('cancel_requested', False)
+        with tracing.span('poll', provider='runninghub') as poll_span:
+            status = processor.check_task_status(task_id)
+            poll_span.set('status', str(status))
+        timer.status(status)
+        if status == "SUCCESS":
+            break
+        elif status in ["FAILED", "CANCELLED"]:
+            raise Exception(f"{label}任务失败: {status}")
+        elif status is None:
+            none_count += 1
+            logger.warning(f"状态检查返回None (第{none_count}次)，继续等待...",
+                           extra={'session_id': session_id, 'task_id': task_id, 'rate_key': 'status_none'})
+            if none_count >= max_none_retries:
+                raise Exception(f"状态检查连续失败{max_none_retries}次")
+        else:
+            # 重置None计数器（状态正常返回）
+            none_count = 0
+            # 同一状态的进度消息由日志限流控制输出频率，状态变化时立即输出
+            logger.info(f"{label}任务状态: {status}，继续等待...",
+                        extra={'session_id': session_id, 'task_id': task_id, 'status': status,
+                               'rate_key': f'task_status:{status}'})
+
+        time.sleep(10)
+        wait_time += 10
+
+    if status != "SUCCESS":
+        raise Exception(f"{label}任务未成功完成: {status}")
+    timer.finish(status)
+
+    # 获取结果
+    with metrics.time_stage('result_fetch', 'runninghub'):
+        results = processor.get_task_results(task_id)
+    if not results:
+        raise Exception(f"获取{label}结果失败")
+    logger.info(f"{label}任务ID: {task_id}完成,结果：{results}", extra={'session_id': session_id, 'task_id': task_id})
+    return results
+
+
+def run_hairstyle_step(session_id, user_image, hairstyle_image, check_cancel):
+    """发型转换步骤，返回结果URL列表"""
+    # print(f"[{session_id}] 开始Gemini预处理图像...")
+    # user_image_path, hairstyle_image_path = processor.preprocess_images_concurrently(
+    #     user_image_path, hairstyle_image_path
+    # )
+
+    # 上传到RunningHub
+    user_filename = upload_step_image(session_id, user_image, '用户图片', check_cancel)
+    hairstyle_filename = upload_step_image(session_id, hairstyle_image, '发型图片', check_cancel)
+
+    # 运行任务
+    logger.info("开始运行发型转换任务...", extra={'session_id': session_id})
+    with metrics.time_stage('submit', 'runninghub'):
+        task_id = processor.submit_with_asset_retry(
+            [hairstyle_image['path'], user_image['path']], [hairstyle_filename, user_filename],
+            lambda hairstyle_name, user_name: processor.run_hairstyle_task(
+                hairstyle_name, user_name, cancel_check_func=check_cancel)
+        )
+    start_step_task(session_id, task_id, check_cancel, '发型转换')
 
-        # 运行任务
-        print(f"[{session_id}] 开始运行发型转换任务...")
-        task_id = processor.run_hairstyle_task(hairstyle_filename, user_filename, cancel_check_func=check_cancel)
-        if not task_id:
-            # 检查是否是因为取消导致的失败
-            if check_cancel():
-                with session_lock:
-                    sessions[session_id]['status'] = 'cancelled'
-                print(f"[{session_id}] 任务启动时检测到取消请求")
-                return
-            else:
-                raise Exception("任务启动失败")
-        print(f"[{session_id}] 任务启动成功，任务ID: {task_id}")
+    results = wait_for_runninghub_task(session_id, task_id, check_cancel, '发型转换')
+    return [result.get("fileUrl") for result in results if result.get("fileUrl")]
+
+
+def run_color_step(session_id, user_image, color_image, check_cancel):
+    """换发色步骤（不经过Gemini预处理），返回结果URL列表"""
+    # 直接上传原图到RunningHub
+    user_filename = upload_step_image(session_id, user_image, '用户图片', check_cancel)
+    color_filename = upload_step_image(session_id, color_image, '发色参考图', check_cancel)
+
+    # 发色参考图的RunningHub预处理（call_runninghub_color_preprocess）目前未启用，直接使用原图
+    logger.info("开始运行换发色任务...", extra={'session_id': session_id})
+    with metrics.time_stage('submit', 'runninghub'):
+        task_id = processor.submit_with_asset_retry(
+            [color_image['path'], user_image['path']], [color_filename, user_filename],
+            lambda color_name, user_name: processor.run_color_task(
+                color_name, user_name, cancel_check_func=check_cancel)
+        )
+    start_step_task(session_id, task_id, check_cancel, '换发色')
+
+    results = wait_for_runninghub_task(session_id, task_id, check_cancel, '换发色')
+    return [result.get("fileUrl") for result in results if result.get("fileUrl")]
+
+
+def prepare_3d_input(session_id, provider_name, user_image, check_cancel):
+    """按服务商准备3D任务的输入图片"""
+    if provider_name == 'volcengine':
+        # 火山引擎直接读取公网URL：上一步的结果留在服务商侧，不需要下载再上传
+        user_3d_input = user_image.get('url')
+        if not user_3d_input:
+            raise Exception("用户图片公网URL不存在，无法调用火山引擎3D服务")
+        logger.info(f"使用火山引擎3D服务，输入图片URL: {user_3d_input}", extra={'session_id': session_id})
+    elif provider_name == 'pai':
+        # 拍我AI上传接口需要本地图片文件路径，不需要先转成公网URL或RunningHub文件名
+        user_3d_input = step_image_path(session_id, user_image)
+        logger.info(f"使用拍我AI 3D服务，输入本地图片: {user_3d_input}", extra={'session_id': session_id})
+    else:
+        # 保留原有 RunningHub 上传逻辑
+        user_3d_input = upload_step_image(session_id, user_image, '用户图片', check_cancel)
+    return user_3d_input
 
-        # 保存task_id到session中
+
+def run_3d_step(session_id, user_image, check_cancel):
+    """3D照片转视频步骤，返回结果URL列表
+
+    按健康状态和预计耗时依次尝试可用的服务商，提交成功后任务固定在该服务商上。
+    """
+    candidates = processor.rank_3d_providers()
+    if not candidates:
+        raise Exception("没有可用的3D服务商（未配置或均已熔断）")
+
+    callback_token = secrets.token_urlsafe(16)
+    with session_lock:
+        sessions[session_id]['callback_token'] = callback_token
+
+    task_id = None
+    for provider_name in candidates:
+        try:
+            user_3d_input = prepare_3d_input(session_id, provider_name, user_image, check_cancel)
+        except StepCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"3D服务商 {provider_name} 输入准备失败: {e}", extra={'session_id': session_id})
+            continue
+
+        raise_if_cancelled(session_id, check_cancel, "用户图片准备完成后")
+
+        # 运行3D转换任务（服务商支持时附带完成回调地址）
+        callback_url = None
+        if processor.get_video_provider(provider_name).supports_callback:
+            callback_url = video_3d_callback_url(session_id, callback_token)
         with session_lock:
-            sessions[session_id]['task_id'] = task_id
-
-        # 等待完成（最多10分钟）
-        max_wait = 600
-        wait_time = 0
-        status = None
-        none_count = 0  # 记录连续None状态的次数
-        max_none_retries = 5  # 最多允许连续5次None状态
-
-        while wait_time < max_wait:
-            # 检查取消状态
-            if check_cancel():
-                print(f"[{session_id}] 处理过程中检测到取消请求，尝试取消任务...")
-                processor.cancel_task(task_id)
-                with session_lock:
-                    sessions[session_id]['status'] = 'cancelled'
-                return
+            sessions[session_id]['provider_3d'] = provider_name
 
-            status = processor.check_task_status(task_id)
-            if status == "SUCCESS":
-                break
-            elif status in ["FAILED", "CANCELLED"]:
-                raise Exception(f"任务失败: {status}")
-            elif status is None:
-                none_count += 1
-                print(f"[{session_id}] 状态检查返回None (第{none_count}次)，继续等待...")
-                if none_count >= max_none_retries:
-                    raise Exception(f"状态检查连续失败{max_none_retries}次")
-            else:
-                # 重置None计数器（状态正常返回）
-                none_count = 0
-                if wait_time % 30 == 0:  # 每30秒打印一次进度
-                    print(f"[{session_id}] 任务状态: {status}，继续等待...")
+        logger.info(f"开始运行3D转换任务 ({provider_name})...", extra={'session_id': session_id})
 
-            time.sleep(10)
-            wait_time += 10
+        def submit_3d(image_input):
+            return processor.run_3d_task(image_input, cancel_check_func=check_cancel,
+                                         callback_url=callback_url, provider_name=provider_name)
 
-        if status != "SUCCESS":
-            raise Exception("任务超时")
+        # RunningHub的fileName来自已上传登记，被拒绝时重新上传一次
+        if provider_name == 'runninghub':
+            task_id = processor.submit_with_asset_retry([user_image['path']], [user_3d_input], submit_3d)
+        else:
+            task_id = submit_3d(user_3d_input)
+        if task_id or check_cancel():
+            break
+        logger.warning(f"3D服务商 {provider_name} 提交失败，尝试下一个服务商...", extra={'session_id': session_id})
+
+    start_step_task(session_id, task_id, check_cancel, '3D')
+
+    # 等待完成（最多10分钟，且不超过会话剩余时间），轮询间隔由服务商的预计耗时决定，回调会提前唤醒
+    timeout = 600
+    deadline_bound = False
+    remaining = remaining_time()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceeded("等待3D任务前已超出会话截止时间")
+        if remaining < timeout:
+            # 被会话截止时间截短的等待超时不算服务商的问题
+            timeout = remaining
+            deadline_bound = True
+    def log_status(status):
+        if status is None:
+            logger.warning("状态检查返回None，继续等待...",
+                           extra={'session_id': session_id, 'task_id': task_id, 'rate_key': 'status_none'})
+        else:
+            logger.info(f"3D任务状态: {status}",
+                        extra={'session_id': session_id, 'task_id': task_id, 'status': status,
+                               'rate_key': f'task_status:{status}'})
 
-        # 获取结果
-        results = processor.get_task_results(task_id)
-        if not results:
-            raise Exception("获取结果失败")
-        print(f"[{session_id}] 任务ID: {task_id}完成,结果：{results}")
+    status = processor.wait_for_3d_task(
+        task_id, provider_name=provider_name, timeout=timeout, cancel_check_func=check_cancel,
+        has_callback=callback_url is not None, on_status=log_status, deadline_bound=deadline_bound
+    )
+
+    if status == 'CANCEL_REQUESTED':
+        logger.info("3D处理过程中检测到取消请求，尝试取消任务...", extra={'session_id': session_id})
+        processor.cancel_3d_task(task_id, provider_name=provider_name)
+        raise StepCancelled("3D处理过程中")
+    if status in ["FAILED", "CANCELLED"]:
+        raise Exception(f"3D任务失败: {status}")
+    if status != "SUCCESS":
+        raise Exception(f"3D任务未成功完成: {status}")
+
+    # 获取结果
+    logger.info("获取3D转换结果...", extra={'session_id': session_id})
+    with metrics.time_stage('result_fetch', provider_name, '3d'):
+        results = processor.get_3d_task_results(task_id, provider_name=provider_name)
+    if not results:
+        raise Exception("获取3D转换结果失败")
+    return [result.get("fileUrl") for result in results if result.get("fileUrl")]
+
+
+def run_session_job(session_id, task_type, label, step_func, image_types):
+    """单步骤任务的后台函数：准备会话图片、执行步骤并更新会话状态"""
+    start_time = time.monotonic()
+    with tracing.session_trace(session_id), metrics.job_context(task_type), \
+            tracing.span('job', job_type=task_type) as job_span:
+        status = _run_session_job(session_id, task_type, label, step_func, image_types)
+        job_span.set('status', status)
+    metrics.JOBS.inc(job_type=task_type, status=status)
+    metrics.observe_stage('total', session_provider(session_id, task_type), time.monotonic() - start_time, task_type)
+
+def _run_session_job(session_id, task_type, label, step_func, image_types):
+    """返回任务最终状态（completed/cancelled/failed）"""
+    try:
+        if session_id not in sessions:
+            return 'expired'
+        with session_lock:
+            # 单步骤任务不再显示之前流水线的进度
+            sessions[session_id].pop('pipeline', None)
+
+        if not all(wait_for_ingest(session_id, image_type) for image_type in image_types):
+            raise Exception("上传图片处理失败")
 
-        # 提取图片URL
-        result_urls = [result.get("fileUrl") for result in results if result.get("fileUrl")]
+        logger.info(f"开始{label}处理...", extra={'session_id': session_id})
+        check_cancel = make_cancel_checker(session_id)
+        raise_if_cancelled(session_id, check_cancel, "处理开始前")
 
+        images = [session_step_image(session_id, image_type) for image_type in image_types]
+        with request_deadline(SESSION_SLA_SECONDS):
+            result_urls = step_func(session_id, *images, check_cancel)
+
+        # 更新session状态
         with session_lock:
             sessions[session_id]['status'] = 'completed'
             sessions[session_id]['result_urls'] = result_urls
+            sessions[session_id]['task_type'] = task_type
+        mirror_session_results(session_id, result_urls, task_type)
+
+        logger.info(f"{label}处理完成，生成了 {len(result_urls)} 个结果", extra={'session_id': session_id})
+        return 'completed'
 
-        print(f"[{session_id}] 任务处理完成，生成了 {len(result_urls)} 个结果")
+    except StepCancelled:
+        with session_lock:
+            if session_id in sessions:
+                sessions[session_id]['status'] = 'cancelled'
+        return 'cancelled'
 
     except Exception as e:
-        print(f"[{session_id}] 异步处理失败: {e}")
+        logger.error(f"{label}处理失败: {e}", extra={'session_id': session_id})
         with session_lock:
-            if sessions.get(session_id):
+            if session_id in sessions:
                 sessions[session_id]['status'] = 'failed'
                 sessions[session_id]['error'] = str(e)
+        return 'failed'
+
+
+def process_hairstyle_async(session_id):
+    """异步处理发型转换的后台函数"""
+    run_session_job(session_id, 'hairstyle', '发型转换', run_hairstyle_step, ('user', 'hairstyle'))
 
 @app.route('/api/image/<session_id>/<image_type>')
 def get_image(session_id, image_type):
@@ -2036,15 +2606,46 @@ def get_image(session_id, image_type):
     session_data = sessions[session_id]
     image_path = session_data.get(f'{image_type}_image')
 
+    if not wait_for_ingest(session_id, image_type):
+        return "图片处理失败", 500
+
     if not image_path or not os.path.exists(image_path):
         return "图片不存在", 404
 
     try:
-        from flask import send_file
-        return send_file(image_path, mimetype='image/jpeg')
+        # 上传图片在重新上传后会变化，使用内容哈希ETag让客户端重新验证
+        return send_cached_file(image_path, 'image/jpeg')
     except Exception as e:
         return f"读取图片失败: {e}", 500
 
+@app.route('/api/result/<session_id>/<int:index>')
+def get_result(session_id, index):
+    """获取生成结果（优先使用本地镜像）
+
+    地址按会话和序号区分，会随同一会话的下一次任务变化：只有带上与当前内容一致的
+    ?v=<sha256> 时才按不可变文件长期缓存，否则要求客户端用ETag重新验证。
+    """
+    if session_id not in sessions:
+        return "会话不存在", 404
+
+    result_urls = sessions[session_id].get('result_urls') or []
+    if index >= len(result_urls):
+        return "结果不存在", 404
+
+    url = result_urls[index]
+    entry = result_mirror.get(url) if result_mirror is not None else None
+    if entry is None:
+        # 尚未镜像完成，先重定向到远端地址，同时确保镜像任务已提交
+        if result_mirror is not None:
+            result_mirror.mirror(url)
+        return redirect(url, code=302)
+
+    try:
+        return send_cached_file(entry['path'], entry['content_type'], etag=entry['sha256'],
+                                immutable=request.args.get('v') == entry['sha256'])
+    except Exception as e:
+        return f"读取结果失败: {e}", 500
+
 @app.route('/api/reset-image/<session_id>/<image_type>', methods=['POST'])
 def reset_image(session_id, image_type):
     """重置指定类型的图片"""
@@ -2067,6 +2668,8 @@ def reset_image(session_id, image_type):
                     pass
 
             # 清除图片相关数据
+            set_ingest_future(session_id, image_type)
+            set_prefetch_future(session_id, image_type)
             sessions[session_id][f'{image_type}_image'] = None
             sessions[session_id][f'{image_type}_image_url'] = None
 
@@ -2105,6 +2708,7 @@ def process_color(session_id):
         with session_lock:
             sessions[session_id]['status'] = 'processing'
             sessions[session_id]['cancel_requested'] = False
+            session_cancel_event(session_id).clear()
             sessions[session_id]['task_type'] = 'color'  # 标记任务类型
 
         # 启动后台处理线程
@@ -2130,183 +2734,7 @@ def process_color(session_id):
 
 def process_color_async(session_id):
     """异步处理换发色的后台函数"""
-    try:
-        session_data = sessions.get(session_id)
-        if not session_data:
-            return
-
-        user_image_path = session_data['user_image']
-        hairstyle_image_path = session_data['hairstyle_image']
-
-        print(f"[{session_id}] 开始换发色处理（不经过Gemini预处理）...")
-
-        # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 处理开始前检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
-
-        # 直接上传原图到RunningHub（不经过Gemini预处理）
-        print(f"[{session_id}] 开始上传用户图片: {user_image_path}")
-        user_filename = processor.upload_image(user_image_path)
-        if not user_filename:
-            raise Exception("用户图片上传失败")
-        print(f"[{session_id}] 用户图片上传成功: {user_filename}")
-
-        # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 用户图片上传后检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
-
-        print(f"[{session_id}] 开始上传发型图片: {hairstyle_image_path}")
-        color_filename = processor.upload_image(hairstyle_image_path)
-        if not color_filename:
-            raise Exception("发型图片上传失败")
-        print(f"[{session_id}] 发型图片上传成功: {color_filename}")
-
-        # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 发型图片上传后检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
-
-        # 定义取消检查函数
-        def check_cancel():
-            with session_lock:
-                return sessions.get(session_id, {}).get('cancel_requested', False)
-
-        # Step 1.5: 对发色参考图调用RunningHub预处理
-        # print(f"[{session_id}] 开始发色预处理...")
-        # preprocess_results = processor.call_runninghub_color_preprocess(color_filename)
-
-        # # 使用预处理结果作为发色参考图
-        processed_color_filename = color_filename  # 默认使用原图
-
-        # if preprocess_results and len(preprocess_results) > 0:
-        #     print(f"[{session_id}] 发色预处理成功，得到 {len(preprocess_results)} 个结果")
-        #     # 保存第一个预处理结果
-        #     first_result = preprocess_results[0]
-        #     if first_result.get("fileUrl"):
-        #         # 下载预处理结果到临时文件
-        #         import requests
-        #         data_dir = ensure_data_directory()
-        #         temp_dir = os.path.join(data_dir, 'temp_uploads')
-        #         preprocess_temp_path = os.path.join(temp_dir, f"{session_id}_color_preprocess_{int(time.time() * 1000)}.png")
-
-        #         try:
-        #             response = requests.get(first_result["fileUrl"])
-        #             if response.status_code == 200:
-        #                 with open(preprocess_temp_path, 'wb') as f:
-        #                     f.write(response.content)
-        #                 print(f"[{session_id}] 下载预处理结果成功: {preprocess_temp_path}")
-
-        #                 # 重新上传预处理后的图片
-        #                 processed_color_filename = processor.upload_image(preprocess_temp_path)
-        #                 if processed_color_filename:
-        #                     print(f"[{session_id}] 预处理图片上传成功: {processed_color_filename}")
-        #                 else:
-        #                     print(f"[{session_id}] 预处理图片上传失败，使用原图")
-        #                     processed_color_filename = color_filename
-        #             else:
-        #                 print(f"[{session_id}] 下载预处理结果失败，使用原图")
-        #         except Exception as e:
-        #             print(f"[{session_id}] 处理预处理结果失败: {e}，使用原图")
-        # else:
-        #     print(f"[{session_id}] 发色预处理失败或无结果，使用原图")
-
-        # # 检查取消状态
-        # if sessions.get(session_id, {}).get('cancel_requested', False):
-        #     print(f"[{session_id}] 发色预处理后检测到取消请求")
-        #     with session_lock:
-        #         sessions[session_id]['status'] = 'cancelled'
-        #     return
-        # 运行换发色任务（使用预处理后的发色图）
-        print(f"[{session_id}] 开始运行换发色任务...")
-        task_id = processor.run_color_task(processed_color_filename, user_filename, cancel_check_func=check_cancel)
-        if not task_id:
-            # 检查是否是因为取消导致的失败
-            if check_cancel():
-                with session_lock:
-                    sessions[session_id]['status'] = 'cancelled'
-                print(f"[{session_id}] 换发色任务启动时检测到取消请求")
-                return
-            else:
-                raise Exception("换发色任务启动失败")
-        print(f"[{session_id}] 换发色任务启动成功，任务ID: {task_id}")
-
-        # 保存task_id到session中
-        with session_lock:
-            sessions[session_id]['task_id'] = task_id
-
-        # 等待完成（最多10分钟）
-        max_wait = 600
-        wait_time = 0
-        status = None
-        none_count = 0  # 记录连续None状态的次数
-        max_none_retries = 5  # 最多允许连续5次None状态
-
-        while wait_time < max_wait:
-            # 检查取消状态
-            if check_cancel():
-                print(f"[{session_id}] 换发色处理过程中检测到取消请求，尝试取消任务...")
-                processor.cancel_task(task_id)
-                with session_lock:
-                    sessions[session_id]['status'] = 'cancelled'
-                return
-
-            status = processor.check_task_status(task_id)
-            if status == "SUCCESS":
-                break
-            elif status in ["FAILED", "CANCELLED"]:
-                raise Exception(f"换发色任务失败: {status}")
-            elif status is None:
-                none_count += 1
-                print(f"[{session_id}] 状态检查返回None (第{none_count}次)，继续等待...")
-                if none_count >= max_none_retries:
-                    raise Exception(f"状态检查连续失败{max_none_retries}次")
-            else:
-                # 重置None计数器（状态正常返回）
-                none_count = 0
-                if wait_time % 30 == 0:  # 每30秒打印一次进度
-                    print(f"[{session_id}] 换发色任务状态: {status}，继续等待...")
-
-            time.sleep(10)
-            wait_time += 10
-
-        if status != "SUCCESS":
-            raise Exception(f"换发色任务未成功完成: {status}")
-
-        # 获取结果
-        print(f"[{session_id}] 获取换发色结果...")
-        results = processor.get_task_results(task_id)
-        if not results:
-            raise Exception("获取换发色结果失败")
-
-        # 保存结果图片并获取下载URL
-        result_urls = []
-        for i, result in enumerate(results):
-            result_url = result.get("fileUrl")
-            if result_url:
-                result_urls.append(result_url)
-
-        # 更新session状态
-        with session_lock:
-            sessions[session_id]['status'] = 'completed'
-            sessions[session_id]['result_urls'] = result_urls
-            sessions[session_id]['task_type'] = 'color'
-
-        print(f"[{session_id}] 换发色处理完成，生成了 {len(result_urls)} 张结果图片")
-
-    except Exception as e:
-        print(f"[{session_id}] 换发色处理失败: {e}")
-        with session_lock:
-            if session_id in sessions:
-                sessions[session_id]['status'] = 'failed'
-                sessions[session_id]['error'] = str(e)
+    run_session_job(session_id, 'color', '换发色', run_color_step, ('user', 'hairstyle'))
 
 
 @app.route('/api/process-3d/<session_id>', methods=['POST'])
@@ -2337,6 +2765,7 @@ def process_3d(session_id):
         with session_lock:
             sessions[session_id]['status'] = 'processing'
             sessions[session_id]['cancel_requested'] = False
+            session_cancel_event(session_id).clear()
             sessions[session_id]['task_type'] = '3d'
 
         # 启动后台处理线程
@@ -2362,139 +2791,220 @@ def process_3d(session_id):
 
 def process_3d_async(session_id):
     """异步处理3D照片转视频的后台函数"""
-    try:
-        session_data = sessions.get(session_id)
-        if not session_data:
-            return
+    run_session_job(session_id, '3d', '3D转换', run_3d_step, ('user',))
+
+
+# ==================== 多步骤流水线 ====================
+
+PIPELINE_STEPS = {
+    'hairstyle': ('发型转换', run_hairstyle_step),
+    'color': ('换发色', run_color_step),
+    '3d': ('3D转换', run_3d_step),
+}
+PIPELINE_MAX_STEPS = int(os.environ.get('PIPELINE_MAX_STEPS', '5'))
+
+
+def validate_pipeline_steps(session_data, steps, own_host):
+    """检查流水线步骤，返回错误信息，没有问题时返回None"""
+    if not isinstance(steps, list) or not steps:
+        return '流水线步骤不能为空'
+    if len(steps) > PIPELINE_MAX_STEPS:
+        return f'流水线步骤最多{PIPELINE_MAX_STEPS}个'
+
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get('type') not in PIPELINE_STEPS:
+            return f'第{index + 1}步类型错误，可选: {", ".join(PIPELINE_STEPS)}'
+        step_type = step['type']
+        if step_type == 'color' and not processor.color_webapp_id:
+            return '换发色功能未配置'
+        if step_type == '3d' and not processor.is_3d_enabled():
+            return '3D转换功能未配置'
+        if step_type in ('hairstyle', 'color'):
+            reference_url = step.get('reference_url')
+            if reference_url and resolve_reference_url(reference_url, own_host) is None:
+                return f'第{index + 1}步参考图地址无效或不在允许的域名内'
+            if not reference_url and not session_data['hairstyle_image']:
+                return f'第{index + 1}步缺少参考图：请上传发型图片或指定reference_url'
+        if step.get('input', 'previous') not in ('previous', 'original'):
+            return f'第{index + 1}步input只能是previous或original'
+        if not isinstance(step.get('result_index', 0), int) or step.get('result_index', 0) < 0:
+            return f'第{index + 1}步result_index无效'
+    return None
 
-        user_image_path = session_data['user_image']
 
-        print(f"[{session_id}] 开始3D照片转视频处理...")
+@app.route('/api/pipeline/<session_id>', methods=['POST'])
+def process_pipeline(session_id):
+    """启动多步骤处理流水线（异步）
 
-        # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 处理开始前检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
+    请求体: {"steps": [{"type": "hairstyle"}, {"type": "color", "reference_url": "..."}, {"type": "3d"}]}
+    每一步默认以上一步的第一个结果作为用户图片（"input": "original" 改用会话上传的原图，
+    "result_index" 选择上一步的第几个结果）；发型/换发色步骤的参考图默认是会话上传的发型图片，
+    也可以用 "reference_url" 指定。进度通过 /api/session/<session_id> 的 pipeline 字段查看。
+    """
+    if session_id not in sessions:
+        return jsonify({'success': False, 'error': '会话不存在'}), 404
 
-        provider_name = processor.get_3d_provider()
-        use_volcengine = provider_name == 'volcengine'
-        use_pai = provider_name == 'pai'
-        user_image_url = session_data.get('user_image_url')
-
-        if use_volcengine:
-            if not user_image_url:
-                raise Exception("用户图片公网URL不存在，无法调用火山引擎3D服务")
-            user_3d_input = user_image_url
-            print(f"[{session_id}] 使用火山引擎3D服务，输入图片URL: {user_3d_input}")
-        elif use_pai:
-            # 拍我AI上传接口需要本地图片文件路径，不需要先转成公网URL或RunningHub文件名
-            user_3d_input = user_image_path
-            print(f"[{session_id}] 使用拍我AI 3D服务，输入本地图片: {user_3d_input}")
-        else:
-            # 保留原有 RunningHub 上传逻辑
-            print(f"[{session_id}] 开始上传用户图片: {user_image_path}")
-            user_3d_input = processor.upload_image(user_image_path)
-            if not user_3d_input:
-                raise Exception("用户图片上传失败")
-            print(f"[{session_id}] 用户图片上传成功: {user_3d_input}")
+    session_data = sessions[session_id]
 
-        # 检查取消状态
-        if sessions.get(session_id, {}).get('cancel_requested', False):
-            print(f"[{session_id}] 用户图片上传后检测到取消请求")
-            with session_lock:
-                sessions[session_id]['status'] = 'cancelled'
-            return
+    if not session_data['user_image']:
+        return jsonify({'success': False, 'error': '用户图片未上传'}), 400
 
-        # 定义取消检查函数
-        def check_cancel():
-            with session_lock:
-                return sessions.get(session_id, {}).get('cancel_requested', False)
+    # 检查处理器是否正确初始化
+    if processor is None:
+        return jsonify({'success': False, 'error': '服务器配置错误：API密钥未设置'}), 500
 
-        # 运行3D转换任务
-        print(f"[{session_id}] 开始运行3D转换任务...")
-        task_id = processor.run_3d_task(user_3d_input, cancel_check_func=check_cancel)
-        if not task_id:
-            # 检查是否是因为取消导致的失败
-            if check_cancel():
-                with session_lock:
-                    sessions[session_id]['status'] = 'cancelled'
-                print(f"[{session_id}] 3D任务启动时检测到取消请求")
-                return
-            else:
-                raise Exception("3D任务启动失败")
-        print(f"[{session_id}] 3D任务启动成功，任务ID: {task_id}")
+    data = request.get_json(silent=True) or {}
+    steps = data.get('steps')
+    error = validate_pipeline_steps(session_data, steps, request.host)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+
+    # 检查是否已经在处理中
+    if session_data.get('status') == 'processing':
+        return jsonify({'success': False, 'error': '任务已在处理中'}), 400
 
-        # 保存task_id到session中
+    try:
+        steps = [dict(step) for step in steps]
+        for step in steps:
+            if step.get('reference_url'):
+                step['reference'] = resolve_reference_url(step['reference_url'], request.host)
         with session_lock:
-            sessions[session_id]['task_id'] = task_id
-
-        # 等待完成（最多10分钟）
-        max_wait = 600
-        wait_time = 0
-        status = None
-        none_count = 0  # 记录连续None状态的次数
-        max_none_retries = 5  # 最多允许连续5次None状态
-
-        while wait_time < max_wait:
-            # 检查取消状态
-            if check_cancel():
-                print(f"[{session_id}] 3D处理过程中检测到取消请求，尝试取消任务...")
-                processor.cancel_3d_task(task_id)
-                with session_lock:
-                    sessions[session_id]['status'] = 'cancelled'
-                return
-
-            status = processor.check_3d_task_status(task_id)
-            if status == "SUCCESS":
-                break
-            elif status in ["FAILED", "CANCELLED"]:
-                raise Exception(f"3D任务失败: {status}")
-            elif status is None:
-                none_count += 1
-                print(f"[{session_id}] 状态检查返回None (第{none_count}次)，继续等待...")
-                if none_count >= max_none_retries:
-                    raise Exception(f"状态检查连续失败{max_none_retries}次")
-            else:
-                # 重置None计数器（状态正常返回）
-                none_count = 0
-                print(f"[{session_id}] 3D任务状态: {status}，继续等待...")
+            sessions[session_id]['status'] = 'processing'
+            sessions[session_id]['cancel_requested'] = False
+            session_cancel_event(session_id).clear()
+            sessions[session_id]['task_type'] = steps[0]['type']
+            sessions[session_id]['pipeline'] = {
+                'steps': steps,
+                'current_step': 0,
+                'step_results': []
+            }
 
-            time.sleep(2)
-            wait_time += 2
+        # 启动后台处理线程
+        processing_thread = threading.Thread(
+            target=process_pipeline_async,
+            args=(session_id, steps),
+            daemon=True
+        )
+        processing_thread.start()
 
-        if status != "SUCCESS":
-            raise Exception(f"3D任务未成功完成: {status}")
+        return jsonify({
+            'success': True,
+            'message': f'流水线已启动，共{len(steps)}步',
+            'session_id': session_id,
+            'status': 'processing'
+        })
 
-        # 获取结果
-        print(f"[{session_id}] 获取3D转换结果...")
-        results = processor.get_3d_task_results(task_id)
-        if not results:
-            raise Exception("获取3D转换结果失败")
+    except Exception as e:
+        with session_lock:
+            sessions[session_id]['status'] = 'failed'
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # 保存结果URL
-        result_urls = []
-        for i, result in enumerate(results):
-            result_url = result.get("fileUrl")
-            if result_url:
-                result_urls.append(result_url)
 
-        # 更新session状态
+def process_pipeline_async(session_id, steps):
+    """依次执行流水线步骤，上一步的结果直接作为下一步的输入"""
+    start_time = time.monotonic()
+    with tracing.session_trace(session_id), tracing.span('pipeline', steps=len(steps)) as pipeline_span:
+        status = _run_pipeline(session_id, steps)
+        pipeline_span.set('status', status)
+    metrics.JOBS.inc(job_type='pipeline', status=status)
+    metrics.observe_stage('total', 'all', time.monotonic() - start_time, 'pipeline')
+
+def _run_pipeline(session_id, steps):
+    """返回流水线最终状态（completed/cancelled/failed）"""
+    try:
+        if session_id not in sessions:
+            return 'expired'
+
+        needs_hairstyle_image = any(
+            step['type'] in ('hairstyle', 'color') and not step.get('reference_url') for step in steps
+        )
+        if not wait_for_ingest(session_id, 'user') or (needs_hairstyle_image and not wait_for_ingest(session_id, 'hairstyle')):
+            raise Exception("上传图片处理失败")
+
+        check_cancel = make_cancel_checker(session_id)
+        original_image = session_step_image(session_id, 'user')
+        previous_urls = None
+
+        for index, step in enumerate(steps):
+            step_type = step['type']
+            label, step_func = PIPELINE_STEPS[step_type]
+            raise_if_cancelled(session_id, check_cancel, f"第{index + 1}步开始前")
+
+            with session_lock:
+                sessions[session_id]['pipeline']['current_step'] = index
+                sessions[session_id]['task_type'] = step_type
+                sessions[session_id]['task_id'] = None
+
+            # 用户图片：上一步的结果（只有URL，保留在服务商侧），或会话上传的原图
+            if previous_urls is None or step.get('input') == 'original':
+                user_image = dict(original_image)
+            else:
+                result_index = step.get('result_index', 0)
+                if result_index >= len(previous_urls):
+                    raise Exception(f"第{index}步只有{len(previous_urls)}个结果，无法选择第{result_index + 1}个")
+                user_image = {'path': None, 'url': previous_urls[result_index]}
+
+            logger.info(f"流水线第{index + 1}/{len(steps)}步: {label}", extra={'session_id': session_id})
+            step_start = time.time()
+            with request_deadline(SESSION_SLA_SECONDS), metrics.job_context(step_type), \
+                    tracing.span('step', job_type=step_type, index=index):
+                if step_type == '3d':
+                    result_urls = step_func(session_id, user_image, check_cancel)
+                else:
+                    if step.get('reference'):
+                        reference_image = reference_step_image(step['reference'])
+                    else:
+                        reference_image = session_step_image(session_id, 'hairstyle')
+                    result_urls = step_func(session_id, user_image, reference_image, check_cancel)
+
+            if not result_urls:
+                raise Exception(f"第{index + 1}步{label}没有生成结果")
+
+            with session_lock:
+                sessions[session_id]['pipeline']['step_results'].append({
+                    'type': step_type,
+                    'result_urls': result_urls,
+                    'elapsed': round(time.time() - step_start, 2)
+                })
+            mirror_session_results(session_id, result_urls, step_type)
+            previous_urls = result_urls
+
         with session_lock:
             sessions[session_id]['status'] = 'completed'
-            sessions[session_id]['result_urls'] = result_urls
-            sessions[session_id]['task_type'] = '3d'
+            sessions[session_id]['result_urls'] = previous_urls
+        logger.info(f"流水线处理完成，共{len(steps)}步，最终生成了 {len(previous_urls)} 个结果", extra={'session_id': session_id})
+        return 'completed'
 
-        print(f"[{session_id}] 3D转换处理完成，生成了 {len(result_urls)} 个结果")
+    except StepCancelled:
+        with session_lock:
+            if session_id in sessions:
+                sessions[session_id]['status'] = 'cancelled'
+        return 'cancelled'
 
     except Exception as e:
-        print(f"[{session_id}] 3D转换处理失败: {e}")
+        logger.error(f"流水线处理失败: {e}", extra={'session_id': session_id})
         with session_lock:
             if session_id in sessions:
                 sessions[session_id]['status'] = 'failed'
                 sessions[session_id]['error'] = str(e)
+        return 'failed'
+
+
+@app.route('/api/callback/3d/<session_id>/<token>', methods=['POST'])
+def video_3d_callback(session_id, token):
+    """3D服务商任务完成回调：只唤醒轮询，最终状态仍以服务商查询结果为准"""
+    with session_lock:
+        session_data = sessions.get(session_id)
+        expected_token = session_data.get('callback_token') if session_data else None
+        task_id = session_data.get('task_id') if session_data else None
+
+    if not expected_token or not hmac.compare_digest(expected_token, token):
+        return jsonify({'success': False, 'error': '回调地址无效'}), 404
 
+    if task_id and processor is not None:
+        processor.video_engine.notify(task_id)
+        logger.info(f"收到3D任务回调，立即查询任务状态: {task_id}", extra={'session_id': session_id, 'task_id': task_id})
+    return jsonify({'success': True})
 
 @app.route('/api/cancel-session/<session_id>', methods=['POST'])
 def cancel_session_task(session_id):
@@ -2521,13 +3031,14 @@ def cancel_session_task(session_id):
         # 设置取消标志
         with session_lock:
             sessions[session_id]['cancel_requested'] = True
+            session_cancel_event(session_id).set()
             sessions[session_id]['status'] = 'cancelled'
 
         # 如果有task_id，尝试取消远程任务
         if task_id:
-            print(f"收到基于Session的取消任务请求 - SessionID: {session_id}, TaskID: {task_id}")
+            logger.info(f"收到基于Session的取消任务请求 - SessionID: {session_id}, TaskID: {task_id}", extra={'session_id': session_id, 'task_id': task_id})
             if session_data.get('task_type') == '3d':
-                success = processor.cancel_3d_task(task_id)
+                success = processor.cancel_3d_task(task_id, provider_name=session_data.get('provider_3d'))
             else:
                 success = cancel_task_on_server(task_id)
 
@@ -2540,7 +3051,7 @@ def cancel_session_task(session_id):
             })
         else:
             # 没有task_id，可能正在排队或刚开始处理
-            print(f"收到基于Session的取消请求 - SessionID: {session_id}, 状态: {current_status} (排队阶段)")
+            logger.info(f"收到基于Session的取消请求 - SessionID: {session_id}, 状态: {current_status} (排队阶段)", extra={'session_id': session_id})
 
             return jsonify({
                 'success': True,
@@ -2550,7 +3061,7 @@ def cancel_session_task(session_id):
             })
 
     except Exception as e:
-        print(f"基于Session取消任务失败: {e}")
+        logger.error(f"基于Session取消任务失败: {e}")
         return jsonify({
             'success': False,
             'error': f'服务器内部错误: {str(e)}'
@@ -2589,7 +3100,7 @@ def cancel_task():
             }), 500
 
         # 记录取消请求信息
-        print(f"收到取消任务请求 - TaskID: {task_id}")
+        logger.info(f"收到取消任务请求 - TaskID: {task_id}", extra={'task_id': task_id})
 
         # 调用取消任务方法（使用服务器环境变量中的API密钥）
         success = cancel_task_on_server(task_id)
@@ -2611,7 +3122,7 @@ def cancel_task():
             }), 400
 
     except Exception as e:
-        print(f"取消任务失败: {e}")
+        logger.error(f"取消任务失败: {e}")
         return jsonify({
             'code': 1,
             'msg': f'服务器内部错误: {str(e)}',
@@ -2622,14 +3133,14 @@ def cancel_task_on_server(task_id):
     """在服务器上取消任务的具体实现"""
     try:
         if processor is None:
-            print("处理器未初始化")
+            logger.error("处理器未初始化")
             return False
 
         # 调用HairstyleProcessor的取消任务方法
         return processor.cancel_task(task_id)
 
     except Exception as e:
-        print(f"取消任务时发生错误: {e}")
+        logger.error(f"取消任务时发生错误: {e}")
         return False
 
 # 清理过期会话的后台任务
@@ -2647,6 +3158,10 @@ def cleanup_expired_sessions():
         for session_id in expired_sessions:
             with session_lock:
                 session_data = sessions.pop(session_id, {})
+            cancel_events.pop(session_id, None)
+            for image_type in ('user', 'hairstyle'):
+                set_ingest_future(session_id, image_type)
+                set_prefetch_future(session_id, image_type)
 
             # 清理临时文件
             try:
@@ -2670,11 +3185,11 @@ def cleanup_expired_sessions():
                         if current_time - file_mtime > 24 * 3600 * 3:  #  三天过期
                             try:
                                 os.remove(filepath)
-                                print(f"清理过期临时文件: {filename}")
+                                logger.debug(f"清理过期临时文件: {filename}")
                             except:
                                 pass
         except Exception as e:
-            print(f"清理临时文件目录失败: {e}")
+            logger.error(f"清理临时文件目录失败: {e}")
 
 # Gemini缓存清理后台任务
 def cleanup_gemini_cache():
@@ -2684,7 +3199,7 @@ def cleanup_gemini_cache():
 
         try:
             if processor is not None:
-                print("开始定期清理Gemini缓存...")
+                logger.info("开始定期清理Gemini缓存...")
 
                 # 获取磁盘使用情况
                 disk_usage = processor.get_disk_usage()
@@ -2696,12 +3211,12 @@ def cleanup_gemini_cache():
                     # 计算推荐的缓存大小限制 (磁盘总空间的90%)
                     recommended_cache_size_mb = int(total_mb * 0.9)
 
-                    print(f"当前磁盘使用率: {usage_percent:.1f}%, 剩余空间: {free_mb:.1f}MB")
-                    print(f"推荐缓存大小限制: {recommended_cache_size_mb}MB (磁盘90%)")
+                    logger.info(f"当前磁盘使用率: {usage_percent:.1f}%, 剩余空间: {free_mb:.1f}MB")
+                    logger.info(f"推荐缓存大小限制: {recommended_cache_size_mb}MB (磁盘90%)")
 
                     # 如果磁盘使用率超过85%或剩余空间少于50MB，进行更激进的清理
                     if usage_percent > 85 or free_mb < 50:
-                        print("磁盘空间不足，进行激进清理...")
+                        logger.warning("磁盘空间不足，进行激进清理...")
                         # 激进清理：6小时，缓存限制为磁盘空间的50%
                         aggressive_cache_limit = int(total_mb * 0.5)
                         cleanup_result = processor.clean_old_cache(max_age_hours=6, max_total_size_mb=aggressive_cache_limit)
@@ -2710,13 +3225,34 @@ def cleanup_gemini_cache():
                         cleanup_result = processor.clean_old_cache(max_age_hours=24, max_total_size_mb=recommended_cache_size_mb)
 
                     if cleanup_result['cleaned_files'] > 0:
-                        print(f"Gemini缓存清理完成: 删除了{cleanup_result['cleaned_files']}个文件，释放{cleanup_result['cleaned_size'] / (1024*1024):.1f}MB空间")
+                        logger.info(f"Gemini缓存清理完成: 删除了{cleanup_result['cleaned_files']}个文件，释放{cleanup_result['cleaned_size'] / (1024*1024):.1f}MB空间")
                 else:
                     # 如果无法获取磁盘信息，使用默认清理策略
                     cleanup_result = processor.clean_old_cache(max_age_hours=24, max_total_size_mb=100)
 
         except Exception as e:
-            print(f"定期清理Gemini缓存失败: {e}")
+            logger.error(f"定期清理Gemini缓存失败: {e}")
+
+        try:
+            if result_mirror is not None:
+                removed_files, removed_size = result_mirror.prune(max_age_hours=RESULT_MIRROR_MAX_AGE_HOURS)
+                if removed_files > 0:
+                    logger.info(f"结果镜像清理完成: 删除了{removed_files}个文件，释放{removed_size / (1024*1024):.1f}MB空间")
+        except Exception as e:
+            logger.error(f"清理结果镜像失败: {e}")
+
+        try:
+            if thumbnail_cache is not None:
+                removed_files, removed_size = thumbnail_cache.prune()
+                if removed_files > 0:
+                    logger.info(f"缩略图缓存清理完成: 删除了{removed_files}个文件，释放{removed_size / (1024*1024):.1f}MB空间")
+        except Exception as e:
+            logger.error(f"清理缩略图缓存失败: {e}")
+
+        if processor is not None:
+            removed_assets = processor.asset_registry.prune()
+            if removed_assets > 0:
+                logger.info(f"已上传图片登记清理完成: 删除了{removed_assets}条过期记录")
 
         # 每次清理后等待6小时
 
@@ -2725,20 +3261,20 @@ def cleanup_gemini_cache():
 def activate_device_api():
     """设备激活"""
     try:
-        print("=== ACTIVATION REQUEST DEBUG ===")
-        print(f"Method: {request.method}")
-        print(f"Headers: {dict(request.headers)}")
-        print(f"Content-Type: {request.content_type}")
-        print(f"Raw data: {request.data}")
+        logger.debug("=== ACTIVATION REQUEST DEBUG ===")
+        logger.debug(f"Method: {request.method}")
+        logger.debug(f"Headers: {dict(request.headers)}")
+        logger.debug(f"Content-Type: {request.content_type}")
+        logger.debug(f"Raw data: {request.data}")
 
         data = request.get_json()
-        print(f"Parsed JSON: {data}")
+        logger.debug(f"Parsed JSON: {data}")
 
         device_id = data.get('device_id') if data else None
         activation_code = data.get('activation_code') if data else None
 
-        print(f"Extracted - device_id: {device_id}, activation_code: {activation_code}")
-        print("=== END DEBUG ===\n")
+        logger.debug(f"Extracted - device_id: {device_id}, activation_code: {activation_code}")
+        logger.debug("=== END DEBUG ===")
 
         if not device_id or not activation_code:
             return jsonify({'success': False, 'error': '设备ID和激活码不能为空'}), 400
@@ -2750,23 +3286,23 @@ def activate_device_api():
 
         # 先检查设备是否已激活（优先检查重新激活场景）
         device_info = get_device(device_id)
-        print(f"Device lookup result: {device_info}")
+        logger.debug(f"Device lookup result: {device_info}")
 
         # 如果激活码已被使用，需要检查是否是同一设备重新激活
         if code_info['used']:
-            print(f"Activation code {activation_code} is marked as used, checking device match...")
+            logger.info(f"Activation code {activation_code} is marked as used, checking device match...")
             if device_info and device_info['activation_code'] == activation_code:
-                print(f"✓ SAME DEVICE REACTIVATION - 激活码被同一设备使用，允许重新激活")
+                logger.info("✓ SAME DEVICE REACTIVATION - 激活码被同一设备使用，允许重新激活")
                 # 这是同一设备重新激活，继续处理重新激活逻辑
             else:
-                print(f"✗ DIFFERENT DEVICE - 激活码被其他设备使用")
+                logger.info("✗ DIFFERENT DEVICE - 激活码被其他设备使用")
                 return jsonify({'success': False, 'error': '激活码已被其他设备使用'}), 400
 
         if device_info:
-            print(f"Device found - stored activation_code: '{device_info['activation_code']}', current request: '{activation_code}'")
+            logger.debug(f"Device found - stored activation_code: '{device_info['activation_code']}', current request: '{activation_code}'")
             # 如果使用的是相同的激活码，允许重新激活（恢复激活状态）
             if device_info['activation_code'] == activation_code:
-                print(f"✓ REACTIVATION MATCHED - 设备 {device_id} 使用相同激活码重新激活，返回现有激活信息")
+                logger.info(f"✓ REACTIVATION MATCHED - 设备 {device_id} 使用相同激活码重新激活，返回现有激活信息")
 
                 # 解析过期时间
                 expires_at = datetime.datetime.fromisoformat(device_info['expires_at'].replace('Z', '+00:00'))
@@ -2806,7 +3342,7 @@ def activate_device_api():
                     'days_remaining': days_remaining
                 }), 400
         else:
-            print(f"✓ NEW DEVICE - 设备 {device_id} 未找到记录，执行新设备激活")
+            logger.info(f"✓ NEW DEVICE - 设备 {device_id} 未找到记录，执行新设备激活")
 
         # 激活设备
         now = datetime.datetime.now()
@@ -2815,7 +3351,7 @@ def activate_device_api():
         # 使用数据库函数激活设备
         activate_device_db(device_id, activation_code, code_info['subscription_type'], expire_date.isoformat())
 
-        print(f"设备 {device_id} 激活成功，过期时间: {expire_date}")
+        logger.info(f"设备 {device_id} 激活成功，过期时间: {expire_date}")
 
         return jsonify({
             'success': True,
@@ -2826,7 +3362,7 @@ def activate_device_api():
         })
 
     except Exception as e:
-        print(f"设备激活失败: {e}")
+        logger.error(f"设备激活失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/device/check-subscription', methods=['POST'])
@@ -2885,7 +3421,7 @@ def check_subscription():
         })
 
     except Exception as e:
-        print(f"订阅检查失败: {e}")
+        logger.error(f"订阅检查失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/admin/devices', methods=['GET'])
@@ -2945,7 +3481,7 @@ def delete_device_api(device_id):
                 'error': '设备不存在'
             }), 404
     except Exception as e:
-        print(f"删除设备失败: {e}")
+        logger.error(f"删除设备失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/admin/create-activation-code', methods=['POST'])
@@ -2988,7 +3524,7 @@ def create_activation_code():
             # 创建激活码到数据库
             if create_activation_code_db(activation_code, subscription_type, duration_days):
                 created_codes.append(activation_code)
-                print(f"创建激活码: {activation_code} ({subscription_type}, {duration_days}天)")
+                logger.info(f"创建激活码: {activation_code} ({subscription_type}, {duration_days}天)")
             else:
                 return jsonify({'success': False, 'error': f'创建激活码失败: {activation_code}'}), 500
 
@@ -3001,7 +3537,7 @@ def create_activation_code():
         })
 
     except Exception as e:
-        print(f"创建激活码失败: {e}")
+        logger.error(f"创建激活码失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # 缓存管理API接口
@@ -3032,7 +3568,7 @@ def get_cache_info():
         return jsonify(response)
 
     except Exception as e:
-        print(f"获取缓存信息失败: {e}")
+        logger.error(f"获取缓存信息失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/admin/cache/clean', methods=['POST'])
@@ -3078,7 +3614,7 @@ def clean_cache():
         })
 
     except Exception as e:
-        print(f"手动清理缓存失败: {e}")
+        logger.error(f"手动清理缓存失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/admin/system/status', methods=['GET'])
@@ -3108,16 +3644,62 @@ def get_system_status():
                 'gemini_stats': {
                     'success_count': processor.gemini_success_count,
                     'fail_count': processor.gemini_fail_count,
-                    'total_requests': len(processor.gemini_times)
-                }
+                    'coalesced_count': processor.gemini_coalesced_count,
+                    'total_requests': processor.gemini_times.count,
+                    'times': processor.gemini_times.snapshot()
+                },
+                'task_submit_times': processor.task_times.snapshot(),
+                'runninghub_stats': processor.runninghub.stats(),
+                'video_3d_providers': processor.video_engine.health_snapshot(),
+                'asset_registry': processor.asset_registry.stats(),
+                'tracing': tracing.tracer.stats()
             })
 
         return jsonify(response)
 
     except Exception as e:
-        print(f"获取系统状态失败: {e}")
+        logger.error(f"获取系统状态失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/admin/session/<session_id>/trace', methods=['GET'])
+def get_session_trace(session_id):
+    """获取会话的处理时间线（span列表，按开始时间排序）"""
+    spans = tracing.tracer.get_trace(session_id)
+    if spans is None:
+        return jsonify({'success': False, 'error': '没有该会话的追踪记录'}), 404
+
+    started_at = spans[0]['start_time']
+    for span in spans:
+        span['offset_ms'] = round((span['start_time'] - started_at) * 1000, 1)
+    with session_lock:
+        session_data = sessions.get(session_id)
+        status = session_data.get('status') if session_data else None
+    return jsonify({
+        'success': True,
+        'session_id': session_id,
+        'status': status,
+        'span_count': len(spans),
+        'spans': spans
+    })
+
+# Prometheus抓取地址；设置METRICS_TOKEN后需携带 Authorization: Bearer <token>
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus文本格式的运行指标"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return "Unauthorized", 401
+
+    counts = {}
+    with session_lock:
+        for session_data in sessions.values():
+            status = session_data.get('status') or 'unknown'
+            counts[(status,)] = counts.get((status,), 0) + 1
+    metrics.ACTIVE_SESSIONS.replace(counts)
+    metrics.refresh_process_metrics()
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/api/admin/cache/files', methods=['GET'])
 def list_cache_files():
     """获取缓存文件列表"""
@@ -3141,7 +3723,7 @@ def list_cache_files():
         })
 
     except Exception as e:
-        print(f"获取缓存文件列表失败: {e}")
+        logger.error(f"获取缓存文件列表失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/admin/cache/files/<image_type>/<path:filename>', methods=['DELETE'])
@@ -3174,46 +3756,79 @@ def delete_cache_file(image_type, filename):
             return jsonify({'success': False, 'error': '删除文件失败'}), 500
 
     except Exception as e:
-        print(f"删除缓存文件失败: {e}")
+        logger.error(f"删除缓存文件失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/admin/cache/image/<image_type>/<path:filename>')
-def serve_cache_image(image_type, filename):
-    """安全地提供缓存图片文件访问"""
-    try:
-        if processor is None:
-            return "处理器未初始化", 500
+def resolve_cache_image_path(image_type, filename):
+    """校验并返回缓存图片路径，返回 (路径, 错误信息, 状态码)"""
+    if processor is None:
+        return None, "处理器未初始化", 500
 
-        if image_type not in ['user', 'hairstyle']:
-            return "图片类型无效", 400
+    if image_type not in ['user', 'hairstyle']:
+        return None, "图片类型无效", 400
 
-        # 安全检查：确保文件名不包含路径遍历
-        if '..' in filename or '/' in filename or '\\' in filename:
-            return "无效的文件名", 400
+    # 安全检查：确保文件名不包含路径遍历
+    if '..' in filename or '/' in filename or '\\' in filename:
+        return None, "无效的文件名", 400
 
-        # 构建完整文件路径
-        cache_dir = os.path.join(processor.data_dir, f"gemini_processed_{image_type}")
-        file_path = os.path.join(cache_dir, filename)
+    # 构建完整文件路径
+    cache_dir = os.path.join(processor.data_dir, f"gemini_processed_{image_type}")
+    file_path = os.path.join(cache_dir, filename)
+
+    # 验证文件路径是否在缓存目录内（安全检查）
+    normalized_file_path = os.path.normpath(file_path)
+    normalized_cache_dir = os.path.normpath(cache_dir)
+
+    if not normalized_file_path.startswith(normalized_cache_dir):
+        return None, "文件路径不在缓存目录内", 403
 
-        # 验证文件路径是否在缓存目录内（安全检查）
-        normalized_file_path = os.path.normpath(file_path)
-        normalized_cache_dir = os.path.normpath(cache_dir)
+    # 检查文件是否存在
+    if not os.path.exists(file_path):
+        return None, "图片不存在", 404
 
-        if not normalized_file_path.startswith(normalized_cache_dir):
-            return "文件路径不在缓存目录内", 403
+    return file_path, None, 200
 
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            return "图片不存在", 404
+@app.route('/api/admin/cache/image/<image_type>/<path:filename>')
+def serve_cache_image(image_type, filename):
+    """安全地提供缓存图片文件访问"""
+    try:
+        file_path, error, status_code = resolve_cache_image_path(image_type, filename)
+        if file_path is None:
+            return error, status_code
 
         try:
-            from flask import send_file
-            return send_file(file_path, mimetype='image/png')
+            # 缓存文件名包含原图内容哈希，内容不会变化
+            return send_cached_file(file_path, 'image/png', immutable=True)
         except Exception as e:
             return f"读取图片失败: {e}", 500
 
     except Exception as e:
-        print(f"提供缓存图片失败: {e}")
+        logger.error(f"提供缓存图片失败: {e}")
+        return f"服务器内部错误: {str(e)}", 500
+
+@app.route('/api/admin/cache/thumb/<image_type>/<path:filename>')
+def serve_cache_thumbnail(image_type, filename):
+    """提供缓存图片的缩略图（size: 128/256/512，format: webp/jpeg）"""
+    try:
+        if thumbnail_cache is None:
+            return "缩略图缓存未初始化", 500
+
+        file_path, error, status_code = resolve_cache_image_path(image_type, filename)
+        if file_path is None:
+            return error, status_code
+
+        size = request.args.get('size', 128, type=int)
+        image_format = request.args.get('format', 'webp').lower()
+        if size not in ThumbnailCache.SIZES:
+            return f"缩略图尺寸无效，可选: {', '.join(str(s) for s in ThumbnailCache.SIZES)}", 400
+        if image_format not in ThumbnailCache.FORMATS:
+            return "缩略图格式无效，可选: webp, jpeg", 400
+
+        thumb_path, mime_type, etag = thumbnail_cache.get(file_path, size, image_format)
+        return send_cached_file(thumb_path, mime_type, etag=etag, immutable=True)
+
+    except Exception as e:
+        logger.error(f"提供缓存缩略图失败: {e}")
         return f"服务器内部错误: {str(e)}", 500
 
 def generate_activation_code(subscription_type, duration_days):
@@ -4120,11 +4735,11 @@ ADMIN_DASHBOARD_HTML = '''
             }
 
             tbody.innerHTML = files.map(file => {
-                const imageUrl = `/api/admin/cache/image/${type}/${encodeURIComponent(file.filename)}`;
+                const thumbUrl = `/api/admin/cache/thumb/${type}/${encodeURIComponent(file.filename)}?size=128`;
                 return `
                 <tr>
                     <td style="text-align: center; width: 80px;">
-                        <img src="${imageUrl}"
+                        <img src="${thumbUrl}" loading="lazy"
                              style="width: 60px; height: 60px; object-fit: cover; border-radius: 5px; cursor: pointer; border: 1px solid #ddd;"
                              onclick="viewImageModal('${type}', '${file.filename}', '${file.original_filename}', ${file.size}, '${file.modified_time_str}')"
                              title="点击查看大图"
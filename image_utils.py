@@ -0,0 +1,515 @@
+"""
+图片处理工具
+上传前的缩放/重编码（结果按内容哈希缓存）、缩略图缓存，以及按目标尺寸快速解码JPEG的辅助函数。
+"""
+
+import logging
+import os
+import io
+import math
+import time
+import base64
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# 记忆"原图无需变换"判定的最大条目数
+READY_HASHES_MAX = 4096
+
+
+def _env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on"}
+
+
+_hash_memo = OrderedDict()
+_hash_memo_size = 4096
+_memo_lock = threading.Lock()
+
+
+def file_content_hash(file_path):
+    """计算文件内容的MD5（按路径+大小+修改时间记忆，避免重复读取）"""
+    stat = os.stat(file_path)
+    memo_key = (file_path, stat.st_size, stat.st_mtime_ns)
+    with _memo_lock:
+        cached = _hash_memo.get(memo_key)
+        if cached:
+            _hash_memo.move_to_end(memo_key)
+            return cached
+
+    hash_md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_md5.update(chunk)
+    digest = hash_md5.hexdigest()
+
+    with _memo_lock:
+        _hash_memo[memo_key] = digest
+        while len(_hash_memo) > _hash_memo_size:
+            _hash_memo.popitem(last=False)
+    return digest
+
+
+class DecodedImageCache:
+    """按内存预算淘汰的已解码图片LRU缓存，键为 (路径, 修改时间, 目标高度)"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _image_bytes(img):
+        return img.width * img.height * len(img.getbands())
+
+    def get_or_load(self, image_path, target_height, loader):
+        """返回缓存的图片；未命中时调用 loader(image_path, target_height) 解码并放入缓存"""
+        cache_key = (image_path, os.stat(image_path).st_mtime_ns, target_height)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        img = loader(image_path, target_height)
+        size = self._image_bytes(img)
+        if size > self.max_bytes:
+            return img
+
+        with self._lock:
+            if cache_key not in self._entries:
+                self._entries[cache_key] = (img, size)
+                self._total_bytes += size
+            while self._total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self.evictions += 1
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+_size_memo = OrderedDict()
+_size_memo_size = 4096
+
+
+def image_size(image_path):
+    """读取图片尺寸（只解析文件头，按路径+修改时间记忆）"""
+    memo_key = (image_path, os.stat(image_path).st_mtime_ns)
+    with _memo_lock:
+        cached = _size_memo.get(memo_key)
+        if cached:
+            _size_memo.move_to_end(memo_key)
+            return cached
+
+    with Image.open(image_path) as img:
+        size = img.size
+
+    with _memo_lock:
+        _size_memo[memo_key] = size
+        while len(_size_memo) > _size_memo_size:
+            _size_memo.popitem(last=False)
+    return size
+
+
+def draft_to_scale(img, scale):
+    """让JPEG解码器按接近scale的比例直接解码（DCT缩放），解码结果不小于目标尺寸"""
+    if img.format != 'JPEG' or scale >= 1:
+        return img
+    width, height = img.size
+    img.draft('RGB', (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))))
+    return img
+
+
+def draft_to_max_edge(img, max_edge):
+    """按长边目标尺寸draft解码，长边不小于max_edge"""
+    if not max_edge:
+        return img
+    return draft_to_scale(img, max_edge / max(img.size))
+
+
+def needs_exif_transpose(img):
+    """图片是否带有需要旋转的EXIF方向信息"""
+    try:
+        return img.getexif().get(EXIF_ORIENTATION_TAG, 1) not in (None, 1)
+    except Exception:
+        return False
+
+
+class UploadImageTransformer:
+    """上传前图片变换：限制长边、按质量或字节预算重编码，结果按内容哈希缓存在磁盘上"""
+
+    FORMATS = {
+        'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+        'jpg': ('JPEG', 'jpg', 'image/jpeg'),
+        'webp': ('WEBP', 'webp', 'image/webp'),
+    }
+
+    def __init__(self, cache_dir, enabled=True, max_edge=1536, quality=85, max_bytes=0,
+                 image_format='jpeg', progressive=True, min_quality=50):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.max_edge = max_edge
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.min_quality = min_quality
+        self.progressive = progressive
+
+        image_format = (image_format or 'jpeg').strip().lower()
+        if image_format not in self.FORMATS:
+            logger.warning(f"Unknown upload image format '{image_format}', falling back to jpeg")
+            image_format = 'jpeg'
+        self.pil_format, self.extension, self.mime_type = self.FORMATS[image_format]
+
+        # 配置签名：配置变化时不会复用旧的缓存结果
+        self.signature = hashlib.md5(
+            f"{self.max_edge}|{self.quality}|{self.max_bytes}|{self.pil_format}|{self.progressive}".encode('utf-8')
+        ).hexdigest()[:8]
+
+        # 原图已满足要求（无需变换）的内容哈希，避免每次重新打开解析文件头
+        self._ready_hashes = OrderedDict()
+        self._ready_lock = threading.Lock()
+
+        # 统计信息
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, cache_dir):
+        """从环境变量读取上传前变换配置"""
+        return cls(
+            cache_dir,
+            enabled=_env_bool('UPLOAD_TRANSFORM_ENABLED', True),
+            max_edge=int(os.environ.get('UPLOAD_MAX_EDGE', '1536')),
+            quality=int(os.environ.get('UPLOAD_QUALITY', '85')),
+            max_bytes=int(os.environ.get('UPLOAD_MAX_BYTES', '0')),
+            image_format=os.environ.get('UPLOAD_FORMAT', 'jpeg'),
+            progressive=_env_bool('UPLOAD_PROGRESSIVE', True),
+        )
+
+    def content_hash(self, image_path):
+        """计算文件内容的MD5"""
+        return file_content_hash(image_path)
+
+    def _encode(self, img, quality):
+        buffer = io.BytesIO()
+        if self.pil_format == 'JPEG':
+            img.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=self.progressive)
+        else:
+            img.save(buffer, format=self.pil_format, quality=quality, method=4)
+        return buffer.getvalue()
+
+    def _is_upload_ready(self, img, image_path):
+        """原图已满足要求时直接使用，不再重编码"""
+        if img.format != self.pil_format or img.mode != 'RGB':
+            return False
+        if max(img.size) > self.max_edge or needs_exif_transpose(img):
+            return False
+        if self.max_bytes and os.path.getsize(image_path) > self.max_bytes:
+            return False
+        return True
+
+    def _transform(self, image_path):
+        with Image.open(image_path) as img:
+            if self._is_upload_ready(img, image_path):
+                return None
+
+            draft_to_max_edge(img, self.max_edge)
+            img = ImageOps.exif_transpose(img)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            if max(img.size) > self.max_edge:
+                img.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+
+            quality = self.quality
+            data = self._encode(img, quality)
+
+            # 字节预算：先降低质量，仍超出时再缩小尺寸
+            while self.max_bytes and len(data) > self.max_bytes:
+                if quality - 10 >= self.min_quality:
+                    quality -= 10
+                elif min(img.size) > 256:
+                    img = img.resize((int(img.width * 0.8), int(img.height * 0.8)), Image.Resampling.LANCZOS)
+                else:
+                    break
+                data = self._encode(img, quality)
+
+            return data
+
+    def prepare(self, image_path):
+        """返回用于上传的图片路径（变换后的缓存文件；无需变换或失败时返回原路径）"""
+        if not self.enabled:
+            return image_path
+
+        try:
+            content_hash = self.content_hash(image_path)
+            cached_path = os.path.join(self.cache_dir, f"{content_hash}_{self.signature}.{self.extension}")
+            if os.path.exists(cached_path):
+                self.cache_hits += 1
+                return cached_path
+            with self._ready_lock:
+                if content_hash in self._ready_hashes:
+                    self._ready_hashes.move_to_end(content_hash)
+                    self.cache_hits += 1
+                    return image_path
+
+            self.cache_misses += 1
+            data = self._transform(image_path)
+            if data is None:
+                with self._ready_lock:
+                    self._ready_hashes[content_hash] = True
+                    if len(self._ready_hashes) > READY_HASHES_MAX:
+                        self._ready_hashes.popitem(last=False)
+                return image_path
+
+            original_size = os.path.getsize(image_path)
+
+            # 原子写入，避免并发读取到半个文件
+            temp_path = f"{cached_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, cached_path)
+
+            self.bytes_in += original_size
+            self.bytes_out += len(data)
+            logger.debug(f"上传前图片压缩: {os.path.basename(image_path)} {original_size / 1024:.1f}KB -> {len(data) / 1024:.1f}KB")
+            return cached_path
+
+        except Exception as e:
+            logger.warning(f"上传前图片变换失败，使用原图: {e}")
+            return image_path
+
+    def encode_base64(self, image_path):
+        """返回变换后图片的base64字符串"""
+        with open(self.prepare(image_path), "rb") as image_file:
+            return base64.b64encode(image_file.read()).decode('utf-8')
+
+    def encode_data_url(self, image_path):
+        """返回变换后图片的data URL；变换失败回退到原图时按原图扩展名标注MIME类型"""
+        upload_path = self.prepare(image_path)
+        mime_type = self.mime_type
+        if upload_path == image_path:
+            mime_type = mimetypes.guess_type(image_path)[0] or mime_type
+        with open(upload_path, "rb") as image_file:
+            return f"data:{mime_type};base64,{base64.b64encode(image_file.read()).decode('utf-8')}"
+
+    def prune(self, max_age_hours=24, max_total_size_mb=None):
+        """清理过期或超出总大小限制的变换缓存，返回 (删除文件数, 释放字节数)"""
+        if not os.path.exists(self.cache_dir):
+            return 0, 0
+
+        current_time = time.time()
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            if os.path.isfile(filepath):
+                file_stat = os.stat(filepath)
+                entries.append((file_stat.st_mtime, file_stat.st_size, filepath))
+        entries.sort()
+
+        total_size = sum(size for _, size, _ in entries)
+        max_total_size = max_total_size_mb * 1024 * 1024 if max_total_size_mb else None
+
+        removed_files = 0
+        removed_size = 0
+        for mtime, size, filepath in entries:
+            expired = current_time - mtime > max_age_hours * 3600
+            over_budget = max_total_size is not None and total_size > max_total_size
+            if not expired and not over_budget:
+                continue
+            try:
+                os.remove(filepath)
+                removed_files += 1
+                removed_size += size
+                total_size -= size
+            except Exception as e:
+                logger.error(f"删除上传缓存文件失败 {filepath}: {e}")
+
+        return removed_files, removed_size
+
+
+class ThumbnailCache:
+    """按需生成缩略图，结果按 (内容哈希, 尺寸, 格式) 缓存在磁盘上，并有独立的容量上限"""
+
+    SIZES = (128, 256, 512)
+    FORMATS = {
+        'webp': ('WEBP', 'webp', 'image/webp'),
+        'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+        'jpg': ('JPEG', 'jpg', 'image/jpeg'),
+    }
+
+    def __init__(self, cache_dir, max_total_size_mb=200, max_workers=2, quality=80, grace_seconds=60):
+        self.cache_dir = cache_dir
+        self.max_total_size = max_total_size_mb * 1024 * 1024
+        self.quality = quality
+        # 最近生成或命中的缩略图在宽限期内不淘汰，避免刚返回的路径在发送前被删除
+        self.grace_seconds = grace_seconds
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="thumbnail")
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._total_size = self._scan_total_size()
+        self._prune_pending = False
+
+        # 统计信息
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @classmethod
+    def from_env(cls, cache_dir):
+        """从环境变量读取缩略图缓存配置"""
+        return cls(
+            cache_dir,
+            max_total_size_mb=int(os.environ.get('THUMB_CACHE_MAX_MB', '200')),
+            max_workers=int(os.environ.get('THUMB_WORKERS', '2')),
+            quality=int(os.environ.get('THUMB_QUALITY', '80')),
+            grace_seconds=int(os.environ.get('THUMB_PRUNE_GRACE_SECONDS', '60')),
+        )
+
+    def _scan_total_size(self):
+        total = 0
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            if os.path.isfile(filepath):
+                total += os.path.getsize(filepath)
+        return total
+
+    def get(self, source_path, size, image_format='webp'):
+        """返回 (缩略图路径, MIME类型, ETag)，缓存未命中时在线程池中生成"""
+        if size not in self.SIZES:
+            raise ValueError(f"Unsupported thumbnail size: {size}")
+        if image_format not in self.FORMATS:
+            raise ValueError(f"Unsupported thumbnail format: {image_format}")
+
+        pil_format, extension, mime_type = self.FORMATS[image_format]
+        content_hash = file_content_hash(source_path)
+        thumb_path = os.path.join(self.cache_dir, f"{content_hash}_{size}.{extension}")
+        etag = f"{content_hash}-{size}-{extension}"
+
+        if os.path.exists(thumb_path):
+            self.cache_hits += 1
+            try:
+                # 更新访问时间，容量淘汰时按最近使用排序
+                os.utime(thumb_path)
+            except OSError:
+                pass
+            return thumb_path, mime_type, etag
+
+        self.cache_misses += 1
+        with self._lock:
+            future = self._inflight.get(thumb_path)
+            if future is None:
+                future = self.executor.submit(self._generate, source_path, thumb_path, size, pil_format)
+                self._inflight[thumb_path] = future
+        try:
+            future.result()
+        finally:
+            with self._lock:
+                if self._inflight.get(thumb_path) is future:
+                    del self._inflight[thumb_path]
+
+        return thumb_path, mime_type, etag
+
+    def _generate(self, source_path, thumb_path, size, pil_format):
+        if os.path.exists(thumb_path):
+            return
+        with Image.open(source_path) as img:
+            draft_to_max_edge(img, size)
+            img = ImageOps.exif_transpose(img)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            if pil_format == 'JPEG':
+                img.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+            else:
+                img.save(buffer, format=pil_format, quality=self.quality, method=4)
+            data = buffer.getvalue()
+
+        temp_path = f"{thumb_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, thumb_path)
+
+        with self._lock:
+            self._total_size += len(data)
+            schedule_prune = self._total_size > self.max_total_size and not self._prune_pending
+            if schedule_prune:
+                self._prune_pending = True
+        if schedule_prune:
+            # 在后台清理，不阻塞当前请求
+            self.executor.submit(self._background_prune)
+
+    def _background_prune(self):
+        try:
+            self.prune()
+        except Exception as e:
+            logger.error(f"清理缩略图缓存失败: {e}")
+        finally:
+            with self._lock:
+                self._prune_pending = False
+
+    def prune(self, max_age_hours=None):
+        """按最近使用时间淘汰缩略图直到低于容量上限（宽限期内的文件除外），返回 (删除文件数, 释放字节数)"""
+        current_time = time.time()
+        with self._lock:
+            inflight = set(self._inflight)
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            if os.path.isfile(filepath) and not filename.endswith('.tmp'):
+                file_stat = os.stat(filepath)
+                entries.append((file_stat.st_mtime, file_stat.st_size, filepath))
+        entries.sort()
+
+        total_size = sum(size for _, size, _ in entries)
+        # 淘汰到容量上限的80%，避免每次生成都触发清理
+        target_size = self.max_total_size * 0.8
+
+        removed_files = 0
+        removed_size = 0
+        for mtime, size, filepath in entries:
+            if current_time - mtime < self.grace_seconds or filepath in inflight:
+                continue
+            expired = max_age_hours is not None and current_time - mtime > max_age_hours * 3600
+            if not expired and total_size <= target_size:
+                continue
+            try:
+                os.remove(filepath)
+                removed_files += 1
+                removed_size += size
+                total_size -= size
+            except OSError as e:
+                logger.error(f"删除缩略图缓存失败 {filepath}: {e}")
+
+        with self._lock:
+            self._total_size = total_size
+        return removed_files, removed_size
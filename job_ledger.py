@@ -0,0 +1,102 @@
+"""
+批处理任务账本
+用SQLite记录每个组合/图片的处理状态（已上传的文件名、task_id、结果路径等），
+批处理中断后重新运行时可以继续轮询已提交的任务并跳过已完成的工作。
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# 状态流转: uploaded -> submitted -> completed / failed
+STATUS_UPLOADED = 'uploaded'
+STATUS_SUBMITTED = 'submitted'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+
+class JobLedger:
+    """线程安全的SQLite任务账本，每条记录的附加字段以JSON保存"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_kind_status ON jobs(kind, status)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(kind, *parts):
+        """由任务类型和输入文件路径生成记录键"""
+        return '|'.join([kind] + [os.path.abspath(part) for part in parts])
+
+    def get(self, job_key):
+        """返回记录（附加字段与status/attempts合并在一个字典中），不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT status, data, attempts FROM jobs WHERE job_key = ?', (job_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[1])
+        entry['status'] = row[0]
+        entry['attempts'] = row[2]
+        return entry
+
+    def update(self, job_key, kind, status, **fields):
+        """写入状态并合并附加字段；值为None的字段会被删除"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM jobs WHERE job_key = ?', (job_key,)).fetchone()
+            data = json.loads(row[0]) if row else {}
+            for name, value in fields.items():
+                if value is None:
+                    data.pop(name, None)
+                else:
+                    data[name] = value
+            attempts_increment = 1 if status == STATUS_SUBMITTED else 0
+            self._conn.execute('''
+                INSERT INTO jobs (job_key, kind, status, data, attempts, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(job_key) DO UPDATE SET
+                    status = excluded.status,
+                    data = excluded.data,
+                    attempts = jobs.attempts + ?,
+                    updated_at = excluded.updated_at
+            ''', (job_key, kind, status, json.dumps(data, ensure_ascii=False), attempts_increment, now, now,
+                  attempts_increment))
+            self._conn.commit()
+
+    def count_by_status(self, kind=None):
+        """按状态统计记录数"""
+        query = 'SELECT status, COUNT(*) FROM jobs'
+        params = ()
+        if kind:
+            query += ' WHERE kind = ?'
+            params = (kind,)
+        query += ' GROUP BY status'
+        with self._lock:
+            return dict(self._conn.execute(query, params).fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+压测脚本
+按目标速率发起会话：创建会话 → 上传图片 → 启动处理 → 轮询到结束，
+统计吞吐量、各阶段延迟的p50/p95/p99，并从 /metrics 采样服务端线程数和内存。
+配合 fake_upstream_server.py 使用时不消耗真实API额度。
+
+用法:
+    python loadtest.py [服务地址，默认 http://127.0.0.1:5000]
+
+环境变量:
+    LOAD_TEST_RATE             每秒新建会话数，默认1
+    LOAD_TEST_DURATION         发起会话的持续时间（秒），默认60
+    LOAD_TEST_JOB              hairstyle / color / 3d，默认hairstyle
+    LOAD_TEST_ARRIVALS         poisson（默认）或 constant
+    LOAD_TEST_POLL_INTERVAL    会话状态轮询间隔（秒），默认2
+    LOAD_TEST_TIMEOUT          单个会话的最长等待时间（秒），默认900
+    LOAD_TEST_MAX_IN_FLIGHT    同时进行中的会话上限，到达时已满则记为丢弃，默认500
+    LOAD_TEST_UNIQUE_IMAGES    每个会话上传不同的图片（避免命中服务端缓存），默认true
+    LOAD_TEST_SAMPLE_INTERVAL  服务端资源采样间隔（秒），默认5
+    LOAD_TEST_REPORT           结果另存为JSON文件的路径
+    METRICS_TOKEN              服务端 /metrics 需要认证时使用
+
+端到端延迟从计划的到达时间算起（不受压测端排队影响），精度为轮询间隔。
+"""
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageDraw
+
+PROCESS_ENDPOINTS = {
+    'hairstyle': '/api/process/{session_id}',
+    'color': '/api/process-color/{session_id}',
+    '3d': '/api/process-3d/{session_id}',
+}
+TERMINAL_STATUSES = {'completed', 'failed', 'cancelled', 'expired'}
+PHASES = ('create', 'upload', 'process', 'poll', 'end_to_end')
+
+
+def percentile(sorted_values, q):
+    """最近秩分位数"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class ImageFactory:
+    """生成上传用的JPEG；unique=True时每次在图上写入不同的标记"""
+
+    def __init__(self, unique=True, size=(720, 960)):
+        self.unique = unique
+        self.base = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3))
+        self._fixed = self._encode(self.base)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(image):
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        return buffer.getvalue()
+
+    def next(self):
+        if not self.unique:
+            return self._fixed
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        image = self.base.copy()
+        # 标记画在中心：服务端入库时会居中裁剪并缩小
+        x, y = image.width // 2, image.height // 2
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((x - 120, y - 60, x + 120, y + 60), fill=(counter * 37 % 256, counter * 91 % 256, counter % 256))
+        draw.text((x - 100, y - 5), f"{counter}-{random.random():.6f}", fill=(255, 255, 255))
+        return self._encode(image)
+
+
+class ServerSampler(threading.Thread):
+    """定期抓取服务端 /metrics 中的线程数、内存和会话数"""
+
+    def __init__(self, base_url, interval=5.0, token=None):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.interval = interval
+        self.headers = {'Authorization': f'Bearer {token}'} if token else {}
+        self.samples = []
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        response = requests.get(f"{self.base_url}/metrics", headers=self.headers, timeout=10)
+        response.raise_for_status()
+        sample = {'time': time.time(), 'processing_sessions': 0}
+        for line in response.text.splitlines():
+            if line.startswith('hairstyle_process_threads '):
+                sample['threads'] = float(line.split()[-1])
+            elif line.startswith('hairstyle_process_resident_memory_bytes '):
+                sample['rss_bytes'] = float(line.split()[-1])
+            elif line.startswith('hairstyle_active_sessions{status="processing"}'):
+                sample['processing_sessions'] = float(line.split()[-1])
+        self.samples.append(sample)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception:
+                self.errors += 1
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join(timeout=self.interval + 10)
+        try:
+            self.sample()
+        except Exception:
+            self.errors += 1
+
+    def summary(self):
+        def _stats(key, scale=1.0):
+            values = [sample[key] / scale for sample in self.samples if key in sample]
+            if not values:
+                return None
+            return {'start': values[0], 'peak': max(values), 'end': values[-1]}
+        return {
+            'samples': len(self.samples),
+            'errors': self.errors,
+            'threads': _stats('threads'),
+            'rss_mb': _stats('rss_bytes', 1024 * 1024),
+            'processing_sessions': _stats('processing_sessions'),
+        }
+
+
+class LoadTest:
+    """开环压测：按到达过程发起会话，每个会话在线程池中独立完成"""
+
+    def __init__(self, base_url, rate=1.0, duration=60.0, job='hairstyle', arrivals='poisson',
+                 poll_interval=2.0, timeout=900.0, max_in_flight=500, unique_images=True,
+                 sample_interval=5.0, metrics_token=None):
+        if job not in PROCESS_ENDPOINTS:
+            raise ValueError(f"不支持的任务类型: {job}")
+        self.base_url = base_url.rstrip('/')
+        self.rate = rate
+        self.duration = duration
+        self.job = job
+        self.arrivals = arrivals
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.images = ImageFactory(unique_images)
+        self.sampler = ServerSampler(self.base_url, sample_interval, metrics_token)
+        self.latencies = {phase: [] for phase in PHASES}
+        self.outcomes = Counter()
+        self.errors = Counter()
+        self.dropped = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls, base_url):
+        return cls(
+            base_url,
+            rate=float(os.environ.get('LOAD_TEST_RATE', '1')),
+            duration=float(os.environ.get('LOAD_TEST_DURATION', '60')),
+            job=os.environ.get('LOAD_TEST_JOB', 'hairstyle').strip().lower(),
+            arrivals=os.environ.get('LOAD_TEST_ARRIVALS', 'poisson').strip().lower(),
+            poll_interval=float(os.environ.get('LOAD_TEST_POLL_INTERVAL', '2')),
+            timeout=float(os.environ.get('LOAD_TEST_TIMEOUT', '900')),
+            max_in_flight=int(os.environ.get('LOAD_TEST_MAX_IN_FLIGHT', '500')),
+            unique_images=os.environ.get('LOAD_TEST_UNIQUE_IMAGES', 'true').strip().lower() in {'1', 'true', 'yes', 'on'},
+            sample_interval=float(os.environ.get('LOAD_TEST_SAMPLE_INTERVAL', '5')),
+            metrics_token=os.environ.get('METRICS_TOKEN'),
+        )
+
+    def _http(self):
+        """每个工作线程复用一个连接池"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _record(self, phase, seconds):
+        with self._lock:
+            self.latencies[phase].append(seconds)
+
+    def _timed(self, phase, method, path, **kwargs):
+        start_time = time.monotonic()
+        response = self._http().request(method, f"{self.base_url}{path}", timeout=60, **kwargs)
+        self._record(phase, time.monotonic() - start_time)
+        response.raise_for_status()
+        return response.json()
+
+    def run_session(self, scheduled_at):
+        """完整走一遍会话流程，返回结束状态"""
+        session_id = self._timed('create', 'POST', '/api/create-session')['session_id']
+
+        image_types = ('user',) if self.job == '3d' else ('user', 'hairstyle')
+        for image_type in image_types:
+            self._timed('upload', 'POST', f'/api/upload/{session_id}/{image_type}',
+                        files={'image': (f'{image_type}.jpg', self.images.next(), 'image/jpeg')})
+
+        self._timed('process', 'POST', PROCESS_ENDPOINTS[self.job].format(session_id=session_id))
+
+        while True:
+            time.sleep(self.poll_interval)
+            status = self._timed('poll', 'GET', f'/api/session/{session_id}').get('status')
+            if status in TERMINAL_STATUSES:
+                self._record('end_to_end', time.monotonic() - scheduled_at)
+                return status
+            if time.monotonic() - scheduled_at > self.timeout:
+                return 'timeout'
+
+    def _session_worker(self, scheduled_at):
+        try:
+            outcome = self.run_session(scheduled_at)
+        except requests.HTTPError as e:
+            outcome = 'error'
+            self.errors[f'HTTP {e.response.status_code} {e.request.path_url.split("/")[2]}'] += 1
+        except Exception as e:
+            outcome = 'error'
+            self.errors[type(e).__name__] += 1
+        with self._lock:
+            self.outcomes[outcome] += 1
+            self.in_flight -= 1
+
+    def _next_gap(self):
+        if self.arrivals == 'constant':
+            return 1.0 / self.rate
+        return random.expovariate(self.rate)
+
+    def run(self):
+        self.sampler.start()
+        started_at = time.monotonic()
+        next_arrival = started_at
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='load') as executor:
+            while next_arrival - started_at < self.duration:
+                delay = next_arrival - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                with self._lock:
+                    if self.in_flight >= self.max_in_flight:
+                        self.dropped += 1
+                        accepted = False
+                    else:
+                        self.in_flight += 1
+                        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                        accepted = True
+                if accepted:
+                    executor.submit(self._session_worker, next_arrival)
+                next_arrival += self._next_gap()
+            print(f"已发起全部会话，等待进行中的 {self.in_flight} 个会话结束...")
+        elapsed = time.monotonic() - started_at
+        self.sampler.stop()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        latency = {}
+        for phase, values in self.latencies.items():
+            values = sorted(values)
+            latency[phase] = {
+                'count': len(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': values[-1] if values else None,
+            }
+        started = sum(self.outcomes.values())
+        return {
+            'target': self.base_url,
+            'job': self.job,
+            'target_rate': self.rate,
+            'elapsed_seconds': round(elapsed, 1),
+            'sessions': started,
+            'dropped': self.dropped,
+            'peak_in_flight': self.peak_in_flight,
+            'outcomes': dict(self.outcomes),
+            'errors': dict(self.errors),
+            'throughput_per_second': round(self.outcomes['completed'] / elapsed, 3) if elapsed else 0.0,
+            'latency_seconds': latency,
+            'server': self.sampler.summary(),
+        }
+
+
+def _fmt(value, digits=3):
+    return '-' if value is None else f"{value:.{digits}f}"
+
+
+def print_report(report):
+    print("=" * 60)
+    print(f"目标: {report['target']}  任务: {report['job']}  目标速率: {report['target_rate']}/秒")
+    print(f"耗时: {report['elapsed_seconds']}秒  会话: {report['sessions']}  丢弃: {report['dropped']}  "
+          f"最大并发会话: {report['peak_in_flight']}")
+    print(f"结果: {report['outcomes']}")
+    if report['errors']:
+        print(f"错误: {report['errors']}")
+    print(f"吞吐量: {report['throughput_per_second']} 个完成会话/秒")
+    print("-" * 60)
+    print(f"{'阶段':<12}{'次数':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for phase, stats in report['latency_seconds'].items():
+        print(f"{phase:<12}{stats['count']:>8}{_fmt(stats['p50']):>10}{_fmt(stats['p95']):>10}"
+              f"{_fmt(stats['p99']):>10}{_fmt(stats['max']):>10}")
+    print("-" * 60)
+    server = report['server']
+    if server['threads']:
+        print(f"服务端线程数: 开始 {server['threads']['start']:.0f}  峰值 {server['threads']['peak']:.0f}  "
+              f"结束 {server['threads']['end']:.0f}")
+    if server['rss_mb']:
+        print(f"服务端内存(MB): 开始 {server['rss_mb']['start']:.1f}  峰值 {server['rss_mb']['peak']:.1f}  "
+              f"结束 {server['rss_mb']['end']:.1f}")
+    if not server['samples']:
+        print(f"未能采样服务端 /metrics（失败 {server['errors']} 次）")
+    print("=" * 60)
+
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:5000'
+    load_test = LoadTest.from_env(base_url)
+    print(f"开始压测 {base_url}: {load_test.rate}会话/秒，持续{load_test.duration:.0f}秒，任务类型 {load_test.job}")
+    report = load_test.run()
+    print_report(report)
+
+    report_path = os.environ.get('LOAD_TEST_REPORT')
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+日志配置
+各模块使用 logging.getLogger(__name__)。日志记录由QueueHandler放入队列，QueueListener在单独线程中写到stdout，
+请求线程和后台线程不会阻塞在输出I/O上。默认每行输出一条JSON（带session_id/task_id等结构化字段）。
+
+环境变量：
+    LOG_LEVEL                  根日志级别，默认INFO
+    LOG_LEVELS                 按模块设置级别，如 "video_providers=DEBUG,werkzeug=WARNING"
+    LOG_FORMAT                 json 或 text
+    LOG_RATE_LIMIT_SECONDS     带rate_key的重复消息（如轮询状态）在该时间内只输出一条，默认30秒
+"""
+
+import os
+import sys
+import json
+import copy
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import tracing
+
+# LogRecord自带的属性，其余属性（通过extra传入）作为结构化字段输出
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', None, None))) | {'message', 'asctime'}
+_INTERNAL_FIELDS = {'rate_key'}
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _extra_fields(record):
+    return {
+        key: value for key, value in record.__dict__.items()
+        if key not in _RECORD_ATTRIBUTES and key not in _INTERNAL_FIELDS and not key.startswith('_')
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行JSON"""
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        payload.update(_extra_fields(record))
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """本地调试用的单行文本格式，结构化字段附在消息后"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        fields = _extra_fields(record)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class ContextQueueHandler(QueueHandler):
+    """在产生日志的线程中补全上下文后放入队列（监听线程中取不到当前会话的contextvars）"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if getattr(record, 'session_id', None) is None:
+            session_id = tracing.current_session()
+            if session_id:
+                record.session_id = session_id
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """带rate_key的记录，同一 (logger, rate_key, 会话/任务) 在interval秒内只输出一条，
+    期间被丢弃的条数记在下一条输出的suppressed字段中"""
+
+    def __init__(self, interval=30.0, max_keys=10000):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self._state = {}   # key -> [上次输出时间, 丢弃条数]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate_key = getattr(record, 'rate_key', None)
+        if rate_key is None or self.interval <= 0:
+            return True
+
+        scope = getattr(record, 'session_id', None) or getattr(record, 'task_id', None) or tracing.current_session()
+        key = (record.name, rate_key, scope)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                return False
+            suppressed = state[1] if state is not None else 0
+            self._state[key] = [now, 0]
+            if len(self._state) > self.max_keys:
+                self._state = {k: v for k, v in self._state.items() if now - v[0] < self.interval}
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in (spec or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(default_format='json'):
+    """配置根日志（重复调用无效），返回QueueListener"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+
+        log_format = os.environ.get('LOG_FORMAT', default_format).strip().lower()
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(TextFormatter() if log_format == 'text' else JsonFormatter())
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = ContextQueueHandler(log_queue)
+        queue_handler.addFilter(RateLimitFilter(float(os.environ.get('LOG_RATE_LIMIT_SECONDS', '30'))))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').strip().upper())
+        for name, level in _parse_levels(os.environ.get('LOG_LEVELS')).items():
+            logging.getLogger(name).setLevel(level)
+        logging.captureWarnings(True)
+
+        _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        # 退出时把队列中剩余的日志写完
+        atexit.register(_listener.stop)
+        return _listener
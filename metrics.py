@@ -0,0 +1,294 @@
+"""
+运行指标
+进程内的计数器、仪表和固定桶直方图，由 /metrics 以Prometheus文本格式输出。
+直方图按 处理阶段(stage) / 服务商(provider) / 任务类型(job_type) 分组，内存占用固定，不随请求数增长。
+"""
+
+import sys
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+import tracing
+
+# 阶段耗时的默认桶边界（秒），覆盖从连接复用的查询请求到10分钟的3D任务
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180, 300, 600)
+
+_job_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可任意设置的当前值"""
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def replace(self, values):
+        """用 {标签值元组: 数值} 整体替换当前值（抓取时重新统计的仪表）"""
+        with self._lock:
+            self._values = {tuple(str(v) for v in key): value for key, value in values.items()}
+
+
+class Histogram(_Metric):
+    """固定桶直方图"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+    def snapshot(self):
+        """{标签值元组: (次数, 总耗时)}，供管理后台展示"""
+        with self._lock:
+            return {key: (state[2], state[1]) for key, state in self._values.items()}
+
+
+class MetricsRegistry:
+    """按注册顺序输出所有指标"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'hairstyle_stage_duration_seconds',
+    'Time spent per pipeline stage (upload, submit, queue_wait, run, result_fetch, download, total)',
+    ('stage', 'provider', 'job_type'),
+)
+QUEUE_MAXED_RETRIES = REGISTRY.counter(
+    'hairstyle_queue_maxed_retries_total',
+    'Task submissions rejected with TASK_QUEUE_MAXED/TASK_INSTANCE_MAXED and retried',
+    ('provider', 'job_type'),
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    'hairstyle_cache_requests_total',
+    'Cache lookups by cache and result (hit/miss)',
+    ('cache', 'result'),
+)
+JOBS = REGISTRY.counter(
+    'hairstyle_jobs_total',
+    'Finished session jobs by job type and final status',
+    ('job_type', 'status'),
+)
+ACTIVE_SESSIONS = REGISTRY.gauge(
+    'hairstyle_active_sessions',
+    'Sessions currently held in memory by status',
+    ('status',),
+)
+PROCESS_THREADS = REGISTRY.gauge(
+    'hairstyle_process_threads',
+    'Live threads in the server process',
+)
+PROCESS_RESIDENT_MEMORY = REGISTRY.gauge(
+    'hairstyle_process_resident_memory_bytes',
+    'Resident memory of the server process',
+)
+
+
+@contextmanager
+def job_context(job_type):
+    """标记当前线程正在处理的任务类型，未显式指定job_type的指标使用它"""
+    previous = getattr(_job_local, 'job_type', None)
+    _job_local.job_type = job_type
+    try:
+        yield
+    finally:
+        _job_local.job_type = previous
+
+
+def current_job_type():
+    return getattr(_job_local, 'job_type', None) or 'unknown'
+
+
+def observe_stage(stage, provider, seconds, job_type=None):
+    STAGE_SECONDS.observe(seconds, stage=stage, provider=provider, job_type=job_type or current_job_type())
+
+
+@contextmanager
+def time_stage(stage, provider, job_type=None):
+    """记录代码块耗时（异常退出时同样记录），同时作为当前会话的一个span"""
+    job_type = job_type or current_job_type()
+    start_time = time.monotonic()
+    try:
+        with tracing.span(stage, provider=provider, job_type=job_type) as stage_span:
+            yield stage_span
+    finally:
+        observe_stage(stage, provider, time.monotonic() - start_time, job_type)
+
+
+def count_queue_maxed(provider, job_type=None):
+    QUEUE_MAXED_RETRIES.inc(provider=provider, job_type=job_type or current_job_type())
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+class TaskTimer:
+    """按轮询到的状态把任务等待时间拆成排队(queue_wait)和运行(run)两段，精度为轮询间隔
+
+    两段同时记录为当前会话的span。
+    """
+
+    QUEUED_STATUSES = {'QUEUED', 'PENDING', 'CREATED', 'SUBMITTED'}
+
+    def __init__(self, provider, job_type=None):
+        self.provider = provider
+        self.job_type = job_type or current_job_type()
+        self.started_at = time.monotonic()
+        self.started_wall = time.time()
+        self.running_at = None
+
+    def status(self, status):
+        """每次轮询后调用；第一次看到非排队状态时记录排队耗时"""
+        if self.running_at is not None or status is None or status in self.QUEUED_STATUSES:
+            return
+        self.running_at = time.monotonic()
+        queued = self.running_at - self.started_at
+        observe_stage('queue_wait', self.provider, queued, self.job_type)
+        tracing.record('queue_wait', self.started_wall, self.started_wall + queued, provider=self.provider)
+
+    def finish(self, status):
+        """任务成功结束时记录运行耗时"""
+        self.status(status)
+        if status == 'SUCCESS' and self.running_at is not None:
+            running = time.monotonic() - self.running_at
+            observe_stage('run', self.provider, running, self.job_type)
+            end_wall = time.time()
+            tracing.record('run', end_wall - running, end_wall, provider=self.provider)
+
+
+def _resident_memory_bytes():
+    """当前常驻内存；没有/proc时退化为峰值常驻内存"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def refresh_process_metrics():
+    """抓取时更新进程线程数和内存"""
+    PROCESS_THREADS.set(threading.active_count())
+    rss = _resident_memory_bytes()
+    if rss is not None:
+        PROCESS_RESIDENT_MEMORY.set(rss)
+
+
+def render():
+    """Prometheus文本格式"""
+    return REGISTRY.render()
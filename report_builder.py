@@ -0,0 +1,222 @@
+"""
+批量结果报告生成
+嵌入缩小后的JPEG副本，尺寸取自生成副本时已有的信息；Word报告可按组合数拆分为多个文档，
+也可以逐条写出HTML或ZIP报告，内存占用不随批次大小增长。
+"""
+
+import logging
+import os
+import html
+import shutil
+import hashlib
+import tempfile
+import zipfile
+from datetime import datetime
+
+from docx import Document
+from docx.shared import Inches
+from PIL import Image, ImageOps
+
+from image_utils import draft_to_max_edge
+
+logger = logging.getLogger(__name__)
+
+WORD_DPI = 96
+
+
+class ReportBuilder:
+    """把批处理结果写成Word/HTML/ZIP报告"""
+
+    def __init__(self, asset_dir=None, max_results_per_document=50, image_max_edge=1024,
+                 combined_max_edge=2400, jpeg_quality=85, title='发型换装结果'):
+        self.max_results_per_document = max_results_per_document
+        self.image_max_edge = image_max_edge
+        self.combined_max_edge = combined_max_edge
+        self.jpeg_quality = jpeg_quality
+        self.title = title
+
+        self._owns_asset_dir = asset_dir is None
+        self.asset_dir = asset_dir or tempfile.mkdtemp(prefix='report_assets_')
+        os.makedirs(self.asset_dir, exist_ok=True)
+
+        # (路径, 修改时间, 长边) -> (副本路径, 宽, 高)；只保存元数据，不保存图片
+        self._assets = {}
+
+    @classmethod
+    def from_env(cls, asset_dir=None):
+        """从环境变量读取报告配置"""
+        return cls(
+            asset_dir=asset_dir,
+            max_results_per_document=int(os.environ.get('REPORT_RESULTS_PER_DOCUMENT', '50')),
+            image_max_edge=int(os.environ.get('REPORT_IMAGE_MAX_EDGE', '1024')),
+            combined_max_edge=int(os.environ.get('REPORT_COMBINED_MAX_EDGE', '2400')),
+            jpeg_quality=int(os.environ.get('REPORT_JPEG_QUALITY', '85')),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """删除临时生成的图片副本目录"""
+        if self._owns_asset_dir and os.path.exists(self.asset_dir):
+            shutil.rmtree(self.asset_dir, ignore_errors=True)
+        self._assets.clear()
+
+    def report_image(self, image_path, max_edge):
+        """返回缩小后的JPEG副本 (路径, 宽, 高)，每张源图按尺寸只生成一次"""
+        asset_key = (image_path, os.stat(image_path).st_mtime_ns, max_edge)
+        asset = self._assets.get(asset_key)
+        if asset is not None:
+            return asset
+
+        name = hashlib.md5(repr(asset_key).encode('utf-8')).hexdigest()
+        asset_path = os.path.join(self.asset_dir, f"{name}.jpg")
+        with Image.open(image_path) as img:
+            draft_to_max_edge(img, max_edge)
+            img = ImageOps.exif_transpose(img)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            if max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            img.save(asset_path, 'JPEG', quality=self.jpeg_quality, optimize=True)
+            asset = (asset_path, img.width, img.height)
+
+        self._assets[asset_key] = asset
+        return asset
+
+    def _result_sections(self, result):
+        """按报告顺序返回一条结果的 (拼接图列表, 单独图片列表)，每项为 (标题, 路径)"""
+        combined = []
+        if result.get('combined_image'):
+            combined.append(('拼接图片 (发型参考 + 用户照片 + 生成结果)', result['combined_image']))
+        if result.get('start_image'):
+            combined.append(('拼接图片 (发色参考 + 用户照片)', result['start_image']))
+        if result.get('end_image'):
+            combined.append(('拼接图片 (发色参考 + 生成结果)', result['end_image']))
+
+        singles = [('发型参考图', result['hairstyle_image']), ('用户照片', result['user_image'])]
+        for j, result_image in enumerate(result.get('result_images', [])):
+            singles.append((f'生成结果{j + 1}', result_image))
+
+        combined = [(label, path) for label, path in combined if path and os.path.exists(path)]
+        return combined, singles
+
+    @staticmethod
+    def _result_heading(index, result):
+        return f'结果 {index + 1}: {result["gender"]} - {result["user_filename"]} + {result["hairstyle_filename"]}'
+
+    def _word_size(self, width, height, max_width):
+        """按96DPI换算为英寸，超过max_width时等比缩小"""
+        if width > max_width * WORD_DPI:
+            return max_width, max_width * height / width
+        return width / WORD_DPI, height / WORD_DPI
+
+    def _add_picture(self, run, image_path, max_edge, max_width):
+        asset_path, width, height = self.report_image(image_path, max_edge)
+        word_width, word_height = self._word_size(width, height, max_width)
+        run.add_picture(asset_path, width=Inches(word_width), height=Inches(word_height))
+
+    def _write_docx(self, results, start_index, total, output_path):
+        doc = Document()
+        doc.add_heading(self.title, 0)
+        doc.add_paragraph(f'生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+        doc.add_paragraph(f'总共处理: {total} 个组合')
+
+        for offset, result in enumerate(results):
+            doc.add_heading(self._result_heading(start_index + offset, result), level=1)
+            combined, singles = self._result_sections(result)
+
+            for label, path in combined:
+                doc.add_paragraph(f'{label}:')
+                self._add_picture(doc.add_paragraph().add_run(), path, self.combined_max_edge, 6.0)
+                doc.add_paragraph()
+
+            doc.add_paragraph('单独图片:')
+            table = doc.add_table(rows=2, cols=len(singles))
+            table.style = 'Table Grid'
+            for j, (label, path) in enumerate(singles):
+                table.rows[0].cells[j].text = label
+                if os.path.exists(path):
+                    paragraph = table.rows[1].cells[j].paragraphs[0]
+                    run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
+                    self._add_picture(run, path, self.image_max_edge, 2.5)
+
+            doc.add_page_break()
+
+        doc.save(output_path)
+
+    def write_docx(self, results, output_path):
+        """写Word报告，超过每个文档的组合数上限时拆分为多个文档，返回文档路径列表"""
+        per_document = self.max_results_per_document or len(results) or 1
+        chunks = [results[i:i + per_document] for i in range(0, len(results), per_document)] or [[]]
+        stem, ext = os.path.splitext(output_path)
+
+        paths = []
+        for part, chunk in enumerate(chunks):
+            path = output_path if len(chunks) == 1 else f"{stem}_part{part + 1}{ext or '.docx'}"
+            self._write_docx(chunk, part * per_document, len(results), path)
+            paths.append(path)
+            logger.info(f"Word document saved: {path}")
+        return paths
+
+    def iter_html(self, results, image_src):
+        """逐条生成HTML片段；image_src(副本路径) 返回页面中使用的图片地址"""
+        yield ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+               f'<title>{html.escape(self.title)}</title>'
+               '<style>body{font-family:sans-serif;margin:24px}img{max-width:100%}'
+               'table{border-collapse:collapse}td,th{border:1px solid #ccc;padding:4px;vertical-align:top}'
+               'td img{width:240px}</style></head><body>')
+        yield f'<h1>{html.escape(self.title)}</h1>'
+        yield f'<p>生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>'
+        yield f'<p>总共处理: {len(results)} 个组合</p>'
+
+        for index, result in enumerate(results):
+            parts = [f'<h2>{html.escape(self._result_heading(index, result))}</h2>']
+            combined, singles = self._result_sections(result)
+            for label, path in combined:
+                asset_path, width, height = self.report_image(path, self.combined_max_edge)
+                parts.append(f'<p>{html.escape(label)}:</p>'
+                             f'<img src="{html.escape(image_src(asset_path))}" width="{width}" height="{height}" loading="lazy">')
+
+            parts.append('<p>单独图片:</p><table><tr>')
+            parts.extend(f'<th>{html.escape(label)}</th>' for label, _ in singles)
+            parts.append('</tr><tr>')
+            for label, path in singles:
+                if os.path.exists(path):
+                    asset_path, width, height = self.report_image(path, self.image_max_edge)
+                    parts.append(f'<td><img src="{html.escape(image_src(asset_path))}" loading="lazy"></td>')
+                else:
+                    parts.append('<td></td>')
+            parts.append('</tr></table>')
+            yield ''.join(parts)
+
+        yield '</body></html>'
+
+    def write_zip(self, results, output_path):
+        """写ZIP报告（index.html + images/），图片副本逐个写入，返回ZIP路径"""
+        written = set()
+
+        with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+            def image_src(asset_path):
+                arcname = f"images/{os.path.basename(asset_path)}"
+                if arcname not in written:
+                    # JPEG已压缩，直接存储
+                    zf.write(asset_path, arcname)
+                    written.add(arcname)
+                return arcname
+
+            # HTML先写到临时文件，避免与图片条目同时打开写入
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.html', delete=False) as html_file:
+                html_path = html_file.name
+                for chunk in self.iter_html(results, image_src):
+                    html_file.write(chunk)
+            try:
+                zf.write(html_path, 'index.html', compress_type=zipfile.ZIP_DEFLATED)
+            finally:
+                os.remove(html_path)
+
+        logger.info(f"ZIP report saved: {output_path}")
+        return output_path
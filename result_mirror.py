@@ -0,0 +1,160 @@
+"""
+生成结果镜像
+任务完成后在后台把服务商返回的图片/视频流式下载到本地，按内容哈希存储，
+之后由本服务直接提供访问，避免平板重复从远端下载以及远端链接过期。
+"""
+
+import logging
+import os
+import time
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlparse
+
+from download_manager import get_download_manager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ResultMirror:
+    """把远端结果文件镜像到本地，按sha256内容寻址存储"""
+
+    def __init__(self, data_dir, max_workers=4):
+        self.cache_dir = os.path.join(data_dir, "result_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="result-mirror")
+        self._entries = {}   # url -> 本地文件信息
+        self._inflight = {}  # url -> Future
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.downloaded_bytes = 0
+
+    def get(self, url):
+        """返回已镜像的文件信息，未完成时返回None"""
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry and os.path.exists(entry['path']):
+            self.hits += 1
+            metrics.count_cache('result_mirror', True)
+            return entry
+        if entry:
+            # 本地文件已被清理，需要重新下载
+            with self._lock:
+                self._entries.pop(url, None)
+        self.misses += 1
+        metrics.count_cache('result_mirror', False)
+        return None
+
+    def mirror(self, url, provider='unknown', job_type=None):
+        """在后台镜像url，同一url只下载一次，返回Future；provider/job_type用于下载耗时指标"""
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is not None:
+                return future
+            entry = self._entries.get(url)
+            if entry and os.path.exists(entry['path']):
+                future = Future()
+                future.set_result(entry)
+                return future
+            future = self.executor.submit(self._download, url, provider, job_type)
+            self._inflight[url] = future
+
+        def _done(done_future):
+            with self._lock:
+                self._inflight.pop(url, None)
+
+        future.add_done_callback(_done)
+        return future
+
+    def mirror_all(self, urls, provider='unknown', job_type=None):
+        """镜像一组url"""
+        return [self.mirror(url, provider, job_type) for url in urls if url]
+
+    def _guess_extension(self, url, content_type):
+        ext = os.path.splitext(urlparse(url).path)[1].lower()
+        if ext and len(ext) <= 6:
+            return ext
+        if content_type:
+            return mimetypes.guess_extension(content_type.split(';')[0].strip()) or ''
+        return ''
+
+    def _download(self, url, provider='unknown', job_type=None):
+        """流式下载到临时文件（共享下载管理器，支持续传），完成后原子重命名到内容寻址路径"""
+        start_time = time.time()
+        temp_path = os.path.join(self.cache_dir, f".{threading.get_ident()}_{time.time_ns()}.download")
+
+        try:
+            downloaded = get_download_manager().download(url, temp_path)
+            if downloaded is None:
+                raise IOError("下载失败")
+            metrics.observe_stage('download', provider, time.time() - start_time, job_type)
+            digest = downloaded['sha256']
+            size = downloaded['size']
+            content_type = downloaded['content_type']
+            ext = self._guess_extension(url, content_type)
+            if not content_type or content_type.startswith('application/octet-stream'):
+                content_type = mimetypes.guess_type(f"file{ext}")[0] or 'application/octet-stream'
+
+            shard_dir = os.path.join(self.cache_dir, digest[:2])
+            os.makedirs(shard_dir, exist_ok=True)
+            final_path = os.path.join(shard_dir, f"{digest}{ext}")
+            if os.path.exists(final_path):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, final_path)
+
+            entry = {
+                'url': url,
+                'sha256': digest,
+                'path': final_path,
+                'content_type': content_type,
+                'size': size,
+                'mirrored_at': time.time(),
+            }
+            with self._lock:
+                self._entries[url] = entry
+
+            self.downloaded_bytes += size
+            logger.info(f"结果镜像完成: {os.path.basename(final_path)} ({size / 1024:.1f}KB, 耗时{time.time() - start_time:.2f}秒)")
+            return entry
+
+        except Exception as e:
+            logger.error(f"结果镜像失败 {url}: {e}")
+            try:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            except OSError:
+                pass
+            return None
+
+    def prune(self, max_age_hours=72):
+        """删除超过保存时间的镜像文件，返回 (删除文件数, 释放字节数)"""
+        current_time = time.time()
+        removed_files = 0
+        removed_size = 0
+
+        for root, dirs, files in os.walk(self.cache_dir):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                try:
+                    file_stat = os.stat(filepath)
+                    if current_time - file_stat.st_mtime > max_age_hours * 3600:
+                        os.remove(filepath)
+                        removed_files += 1
+                        removed_size += file_stat.st_size
+                except OSError as e:
+                    logger.error(f"删除结果镜像文件失败 {filepath}: {e}")
+
+        if removed_files:
+            with self._lock:
+                self._entries = {
+                    url: entry for url, entry in self._entries.items() if os.path.exists(entry['path'])
+                }
+
+        return removed_files, removed_size
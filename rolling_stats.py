@@ -0,0 +1,146 @@
+"""
+流式耗时统计
+替代只增不减的耗时列表：最近样本放在固定长度的环形缓冲区，
+总体均值/方差用Welford算法累计，分位数用P²算法估计，内存占用固定，查询为O(1)。
+"""
+
+import math
+import threading
+from collections import deque
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+class P2Quantile:
+    """P²算法（Jain & Chlamtac）单个分位数的流式估计，只保存5个标记点"""
+
+    def __init__(self, p):
+        self.p = p
+        self._initial = []
+        self._heights = None
+        self._positions = None
+        self._desired = None
+        self._increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+
+    def add(self, x):
+        if self._heights is None:
+            self._initial.append(x)
+            if len(self._initial) == 5:
+                self._heights = sorted(self._initial)
+                self._positions = [0, 1, 2, 3, 4]
+                p = self.p
+                self._desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+            return
+
+        q = self._heights
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # 调整中间3个标记点的位置和高度
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q = self._heights
+        n = self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        if self._heights is not None:
+            return self._heights[2]
+        if not self._initial:
+            return None
+        samples = sorted(self._initial)
+        return samples[min(len(samples) - 1, int(self.p * len(samples)))]
+
+
+class RollingStats:
+    """线程安全的耗时统计；append/len 与原来的列表用法兼容"""
+
+    def __init__(self, window=256, quantiles=DEFAULT_QUANTILES):
+        self._recent = deque(maxlen=window)
+        self._quantiles = {q: P2Quantile(q) for q in quantiles}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def append(self, value):
+        value = float(value)
+        with self._lock:
+            self._recent.append(value)
+            self.count += 1
+            self.total += value
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (value - self.mean)
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            for estimator in self._quantiles.values():
+                estimator.add(value)
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    @property
+    def variance(self):
+        """样本方差，少于2个样本时为0"""
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    def quantile(self, q):
+        """估计的分位数，q需在构造时的quantiles中；没有样本时返回None"""
+        with self._lock:
+            return self._quantiles[q].value()
+
+    def recent(self):
+        """环形缓冲区中最近的样本（按时间顺序）"""
+        with self._lock:
+            return list(self._recent)
+
+    def snapshot(self):
+        with self._lock:
+            result = {
+                'count': self.count,
+                'total': round(self.total, 3),
+                'mean': round(self.mean, 3),
+                'stddev': round(math.sqrt(self._m2 / (self.count - 1)), 3) if self.count > 1 else 0.0,
+                'min': self.min,
+                'max': self.max,
+            }
+            for q, estimator in self._quantiles.items():
+                value = estimator.value()
+                result[f'p{q * 100:g}'] = round(value, 3) if value is not None else None
+            return result
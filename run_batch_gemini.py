@@ -48,7 +48,7 @@ def main():
     
     # 导入并运行主处理器
     try:
-        from batch_gemini_processor import BatchGeminiProcessor
+        from batch_gemini_processor import BatchGeminiProcessor, DEFAULT_MAX_CONCURRENCY
         
         # 配置参数
         base_directories = [
@@ -56,11 +56,16 @@ def main():
             "/Users/alex_wu/work/hair/woman"
         ]
         
-        max_workers = 5  # 可以根据需要调整
+        max_workers = 5  # 可以根据需要调整（线程模式）
+        use_async = True  # 使用原生asyncio模式
+        max_concurrency = DEFAULT_MAX_CONCURRENCY  # asyncio模式下的最大并发请求数（GEMINI_BATCH_MAX_CONCURRENCY）
         output_dir = "outputs"
         
         print(f"配置信息:")
-        print(f"  并发线程数: {max_workers}")
+        if use_async:
+            print(f"  asyncio最大并发: {max_concurrency}")
+        else:
+            print(f"  并发线程数: {max_workers}")
         print(f"  输出目录: {output_dir}")
         print(f"  处理目录: {len(base_directories)}个")
         for i, directory in enumerate(base_directories, 1):
@@ -76,7 +81,9 @@ def main():
         # 创建处理器
         processor = BatchGeminiProcessor(
             max_workers=max_workers, 
-            output_base_dir=output_dir
+            output_base_dir=output_dir,
+            use_async=use_async,
+            max_concurrency=max_concurrency
         )
         
         # 处理每个目录
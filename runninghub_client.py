@@ -0,0 +1,286 @@
+"""
+RunningHub HTTP客户端
+通过requests.Session复用连接；每次请求都有时间预算，并受当前线程上的会话截止时间约束。
+幂等的轻量请求（状态/结果查询）超过近期p95耗时仍未返回时再发一个对冲请求，先成功返回的结果生效；
+提交任务（ai-app/run）不是幂等的，不做对冲；图片上传体积大，也不做对冲。
+对冲请求数量受比例预算和并发上限约束；线程池没有空闲线程时请求直接在调用线程发送，不排队也不对冲。
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import tracing
+
+# 各类请求的默认时间预算（秒），可用 RUNNINGHUB_TIMEOUT_<OPERATION> 覆盖
+DEFAULT_TIMEOUTS = {
+    'run': 60,
+    'upload': 120,
+    'status': 20,
+    'outputs': 30,
+    'cancel': 20,
+}
+
+_deadline_local = threading.local()
+
+
+class DeadlineExceeded(TimeoutError):
+    """会话截止时间已到，不再发起请求"""
+
+
+@contextmanager
+def request_deadline(seconds):
+    """为当前线程内的RunningHub请求设置截止时间，嵌套时取更早的一个"""
+    previous = getattr(_deadline_local, 'deadline', None)
+    deadline = time.monotonic() + seconds
+    if previous is not None:
+        deadline = min(deadline, previous)
+    _deadline_local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _deadline_local.deadline = previous
+
+
+def request_not_sent(error):
+    """请求确定没有发到服务端（连接未建立）；非幂等请求只有这种情况可以安全重试"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def current_deadline():
+    """当前线程的截止时间（time.monotonic()时刻），没有设置时返回None；用于传给其他线程上的任务"""
+    return getattr(_deadline_local, 'deadline', None)
+
+
+def remaining_time():
+    """当前线程截止时间前的剩余秒数，没有设置截止时间时返回None"""
+    deadline = getattr(_deadline_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class LatencyTracker:
+    """按请求类型记录最近的耗时，用于计算对冲延迟"""
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            samples = self._samples.get(operation)
+            if samples is None:
+                samples = self._samples[operation] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def quantile(self, operation, q):
+        """样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._samples.get(operation, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class RunningHubClient:
+    """RunningHub OpenAPI 请求（连接池 + 时间预算 + 对冲）"""
+
+    def __init__(self, base_url='https://www.runninghub.cn', timeouts=None, connect_timeout=10,
+                 pool_size=32, hedge_enabled=True, hedge_quantile=0.95, hedge_default_delay=2.0,
+                 hedge_min_delay=0.3, hedge_max_delay=10.0, max_workers=16, hedge_budget_ratio=0.1,
+                 hedge_max_inflight=4):
+        self.base_url = base_url.rstrip('/')
+        self.host = urlparse(self.base_url).netloc
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.connect_timeout = connect_timeout
+
+        self.hedge_enabled = hedge_enabled
+        self.hedge_quantile = hedge_quantile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        # 对冲请求最多占总请求数的hedge_budget_ratio，同时进行的对冲请求不超过hedge_max_inflight
+        self.hedge_budget_ratio = hedge_budget_ratio
+        self._hedge_slots = threading.BoundedSemaphore(hedge_max_inflight)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.latency = LatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='runninghub-hedge')
+        # 每个提交到线程池的请求先占一个空闲线程名额，保证请求不会在线程池队列里等待
+        self._worker_slots = threading.BoundedSemaphore(max_workers)
+        self._stats_lock = threading.Lock()
+
+        # 统计信息
+        self.request_count = 0
+        self.hedged_count = 0
+        self.hedge_win_count = 0
+        self.hedge_skipped_count = 0
+        self.deadline_exceeded_count = 0
+
+    @classmethod
+    def from_env(cls):
+        timeouts = {}
+        for operation in DEFAULT_TIMEOUTS:
+            value = os.environ.get(f'RUNNINGHUB_TIMEOUT_{operation.upper()}')
+            if value:
+                timeouts[operation] = float(value)
+        return cls(
+            base_url=os.environ.get('RUNNINGHUB_BASE_URL', 'https://www.runninghub.cn'),
+            timeouts=timeouts,
+            connect_timeout=float(os.environ.get('RUNNINGHUB_CONNECT_TIMEOUT', '10')),
+            pool_size=int(os.environ.get('RUNNINGHUB_POOL_SIZE', '32')),
+            hedge_enabled=os.environ.get('RUNNINGHUB_HEDGE', 'true').strip().lower() in {'1', 'true', 'yes', 'on'},
+            hedge_default_delay=float(os.environ.get('RUNNINGHUB_HEDGE_DELAY', '2')),
+            hedge_max_delay=float(os.environ.get('RUNNINGHUB_HEDGE_MAX_DELAY', '10')),
+        )
+
+    def _call_timeout(self, operation):
+        """本次请求的时间预算：请求类型的默认预算与会话剩余时间取较小值"""
+        budget = self.timeouts.get(operation, 60)
+        remaining = remaining_time()
+        if remaining is not None:
+            if remaining <= 0:
+                self.deadline_exceeded_count += 1
+                raise DeadlineExceeded(f"RunningHub {operation} 请求超出会话截止时间")
+            budget = min(budget, remaining)
+        return budget
+
+    def hedge_delay(self, operation):
+        """发出对冲请求前的等待时间：近期耗时的p95，样本不足时用默认值"""
+        delay = self.latency.quantile(operation, self.hedge_quantile)
+        if delay is None:
+            delay = self.hedge_default_delay
+        return max(self.hedge_min_delay, min(delay, self.hedge_max_delay))
+
+    def _submit(self, operation, path, body, headers, timeout):
+        """有空闲线程时在线程池中发送请求并返回Future，否则返回None"""
+        if not self._worker_slots.acquire(blocking=False):
+            return None
+        try:
+            future = self._executor.submit(self._send, operation, path, body, headers, timeout)
+        except Exception:
+            self._worker_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._worker_slots.release())
+        return future
+
+    def _acquire_hedge(self):
+        """对冲预算内且未超过并发上限时占用一个对冲名额"""
+        with self._stats_lock:
+            if self.hedged_count + 1 > self.hedge_budget_ratio * self.request_count:
+                return False
+        return self._hedge_slots.acquire(blocking=False)
+
+    def _send(self, operation, path, body, headers, timeout):
+        start_time = time.monotonic()
+        response = self.session.post(
+            f"{self.base_url}{path}", data=body, headers=headers,
+            timeout=(min(self.connect_timeout, timeout), timeout)
+        )
+        response.raise_for_status()
+        result = response.json()
+        self.latency.record(operation, time.monotonic() - start_time)
+        return result
+
+    def post(self, path, body, headers=None, operation=None, idempotent=False):
+        """POST请求并返回解析后的JSON；idempotent=True时允许对冲"""
+        operation = operation or path.rstrip('/').rsplit('/', 1)[-1]
+        with tracing.span(f'runninghub.{operation}') as request_span:
+            result = self._post(path, body, headers, operation, idempotent, request_span)
+            if isinstance(result, dict):
+                request_span.set('code', result.get('code'))
+                if result.get('code') != 0 and result.get('msg'):
+                    request_span.set('msg', result.get('msg'))
+            return result
+
+    def _post(self, path, body, headers, operation, idempotent, request_span):
+        headers = headers or {'Content-Type': 'application/json'}
+        timeout = self._call_timeout(operation)
+        with self._stats_lock:
+            self.request_count += 1
+
+        delay = self.hedge_delay(operation)
+        if not (idempotent and self.hedge_enabled) or delay >= timeout:
+            return self._send(operation, path, body, headers, timeout)
+
+        # 主请求只在有空闲线程时进入线程池，线程池被占满时直接在调用线程发送（不排队、不对冲），
+        # 因此对冲延迟从请求真正发出时开始计算
+        started_at = time.monotonic()
+        primary = self._submit(operation, path, body, headers, timeout)
+        if primary is None:
+            return self._send(operation, path, body, headers, timeout)
+
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        # 主请求超过p95仍未返回，在预算内发出对冲请求
+        hedge = None
+        remaining = timeout - (time.monotonic() - started_at)
+        if self._acquire_hedge():
+            try:
+                hedge = self._submit(operation, path, body, headers, max(remaining, 0.1))
+            finally:
+                if hedge is None:
+                    self._hedge_slots.release()
+                else:
+                    hedge.add_done_callback(lambda _: self._hedge_slots.release())
+        if hedge is None:
+            with self._stats_lock:
+                self.hedge_skipped_count += 1
+            pending = {primary}
+        else:
+            with self._stats_lock:
+                self.hedged_count += 1
+            request_span.set('hedged', True)
+            pending = {primary, hedge}
+        error = None
+        deadline = started_at + timeout
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    with self._stats_lock:
+                        self.hedge_win_count += 1
+                    request_span.set('hedge_won', True)
+                return result
+        if error is not None:
+            raise error
+        raise TimeoutError(f"RunningHub {operation} 请求超时 ({timeout:.1f}秒)")
+
+    def stats(self):
+        return {
+            'requests': self.request_count,
+            'hedged': self.hedged_count,
+            'hedge_wins': self.hedge_win_count,
+            'hedge_skipped': self.hedge_skipped_count,
+            'deadline_exceeded': self.deadline_exceeded_count,
+            'p95': {operation: self.latency.quantile(operation, 0.95) for operation in DEFAULT_TIMEOUTS},
+        }
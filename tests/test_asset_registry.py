@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from asset_registry import AssetRegistry, InvalidAssetError, is_invalid_asset_error
+from hairstyle_processor_v2 import HairstyleProcessor
+
+
+def make_image(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def fake_processor(registry, uploads):
+    """只带登记表和上传函数的处理器替身，上传依次返回uploads中的fileName"""
+    uploads = iter(uploads)
+    processor = SimpleNamespace(asset_registry=registry, upload_count=0)
+
+    def upload_image(path):
+        processor.upload_count += 1
+        return registry.get_or_upload('runninghub', path, lambda _: next(uploads))
+
+    processor.upload_image = upload_image
+    return processor
+
+
+def test_is_invalid_asset_error():
+    assert is_invalid_asset_error('PARAMS_INVALID')
+    assert is_invalid_asset_error('invalid parameter')
+    assert is_invalid_asset_error('file not exist')
+    assert not is_invalid_asset_error('TASK_QUEUE_MAXED')
+    assert not is_invalid_asset_error(None)
+
+
+def test_rejected_asset_is_forgotten_and_reuploaded(tmp_path):
+    registry = AssetRegistry()
+    path = make_image(tmp_path, 'user.jpg', b'user')
+    registry.put('runninghub', path, 'stale.png')
+    processor = fake_processor(registry, ['fresh.png'])
+    submitted = []
+
+    def submit(file_name):
+        submitted.append(file_name)
+        if file_name == 'stale.png':
+            raise InvalidAssetError('PARAMS_INVALID')
+        return 'task-1'
+
+    task_id = HairstyleProcessor.submit_with_asset_retry(processor, [path], ['stale.png'], submit)
+
+    assert task_id == 'task-1'
+    assert submitted == ['stale.png', 'fresh.png']
+    assert registry.get('runninghub', path) == 'fresh.png'
+
+
+def test_second_rejection_gives_up(tmp_path):
+    registry = AssetRegistry()
+    path = make_image(tmp_path, 'user.jpg', b'user')
+    processor = fake_processor(registry, ['fresh.png'])
+
+    def submit(file_name):
+        raise InvalidAssetError('PARAMS_INVALID')
+
+    assert HairstyleProcessor.submit_with_asset_retry(processor, [path], ['stale.png'], submit) is None
+    assert processor.upload_count == 1
+
+
+def test_successful_submit_does_not_reupload(tmp_path):
+    registry = AssetRegistry()
+    path = make_image(tmp_path, 'user.jpg', b'user')
+    processor = fake_processor(registry, [])
+
+    assert HairstyleProcessor.submit_with_asset_retry(processor, [path], ['ok.png'], lambda name: 'task-1') == 'task-1'
+    assert processor.upload_count == 0
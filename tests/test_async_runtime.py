@@ -0,0 +1,45 @@
+import asyncio
+
+from async_runtime import SingleFlight
+
+
+def test_concurrent_calls_share_one_factory_call():
+    flights = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def main():
+        return await asyncio.gather(flights.do('key', work), flights.do('key', work))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(results, key=lambda r: r[1]) == [('result', False), ('result', True)]
+    assert len(flights) == 0
+
+
+def test_cancelled_waiter_does_not_cancel_shared_task():
+    flights = SingleFlight()
+    release = None
+
+    async def work():
+        await release.wait()
+        return 'done'
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        leader = asyncio.ensure_future(flights.do('key', work))
+        waiter = asyncio.ensure_future(flights.do('key', work))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return waiter, await leader
+
+    waiter, leader_result = asyncio.run(main())
+    assert waiter.cancelled()
+    assert leader_result == ('done', False)
@@ -0,0 +1,33 @@
+import compositor
+from compositor import Compositor
+
+
+def _worker_decode_cache_bytes():
+    return compositor._decoded_cache.max_bytes
+
+
+def test_decode_cache_budget_is_split_across_workers():
+    instance = Compositor(max_workers=2, decode_cache_mb=64)
+    try:
+        assert instance.worker_decode_cache_bytes == 32 * 1024 * 1024
+        budget = instance._get_executor().submit(_worker_decode_cache_bytes).result(timeout=60)
+        assert budget == 32 * 1024 * 1024
+    finally:
+        instance.shutdown()
+
+
+def test_compose_in_process_when_workers_disabled(tmp_path):
+    from PIL import Image
+
+    paths = []
+    for i, size in enumerate(((600, 800), (300, 600))):
+        path = str(tmp_path / f"image{i}.png")
+        Image.new('RGB', size, (i * 100, 0, 0)).save(path)
+        paths.append(path)
+
+    output_path = Compositor(max_workers=0).compose(paths, str(tmp_path / 'combined.png'))
+
+    assert output_path.endswith('combined.jpg')
+    with Image.open(output_path) as img:
+        # 统一到最小高度600：600×800缩放为450宽，300×600保持不变
+        assert img.size == (450 + 300, 600)
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from download_manager import DownloadManager
+
+CONTENT = bytes(range(256)) * 64
+
+
+class FileServer(ThreadingHTTPServer):
+    """按Range/If-Range提供一个文件；modes按请求顺序指定异常行为"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.content = CONTENT
+        self.etag = '"v1"'
+        self.modes = []
+        self.requests = []
+        # 首个请求之后切换到的新版本 (内容, ETag)
+        self.next_version = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/file.png"
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append({'range': self.headers.get('Range'), 'if_range': self.headers.get('If-Range')})
+        mode = server.modes.pop(0) if server.modes else None
+        content = server.content
+
+        if mode == '416':
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') in (None, server.etag):
+            start = int(range_header.split('=')[1].split('-')[0])
+        if mode == 'wrong-range':
+            start = 0
+        body = content[start:]
+
+        if start or mode == 'wrong-range':
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(content) - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if mode == 'truncate':
+            # 只发送一半后断开连接
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+        if server.next_version:
+            (server.content, server.etag), server.next_version = server.next_version, None
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def manager():
+    manager = DownloadManager(max_workers=1, max_retries=2, retry_delay=0, chunk_size=1024)
+    yield manager
+    manager.executor.shutdown()
+
+
+def test_interrupted_download_resumes_with_if_range(tmp_path, server, manager):
+    server.modes = ['truncate']
+    save_path = str(tmp_path / 'result.png')
+
+    info = manager.download(server.url, save_path, expected_sha256=hashlib.sha256(CONTENT).hexdigest())
+
+    assert info['size'] == len(CONTENT)
+    assert open(save_path, 'rb').read() == CONTENT
+    assert manager.resumed_count == 1
+    assert server.requests[1] == {'range': f"bytes={len(CONTENT) // 2}-", 'if_range': '"v1"'}
+    assert not os.path.exists(f"{save_path}.part")
+
+
+def test_changed_resource_is_downloaded_again_in_full(tmp_path, server, manager):
+    server.modes = ['truncate']
+    server.next_version = (b'new-version' * 100, '"v2"')
+    save_path = str(tmp_path / 'result.png')
+
+    info = manager.download(server.url, save_path)
+
+    # If-Range不匹配，服务器返回完整的新版本，不与旧的部分文件拼接
+    assert open(save_path, 'rb').read() == b'new-version' * 100
+    assert info['size'] == 1100
+    assert manager.resumed_count == 0
+    assert server.requests[1]['if_range'] == '"v1"'
+
+
+def test_mismatched_content_range_restarts(tmp_path, server, manager):
+    server.modes = ['truncate', 'wrong-range']
+    save_path = str(tmp_path / 'result.png')
+
+    manager.download(server.url, save_path)
+
+    assert open(save_path, 'rb').read() == CONTENT
+    assert server.requests[2] == {'range': None, 'if_range': None}
+
+
+def test_416_restarts_from_scratch(tmp_path, server, manager):
+    server.modes = ['truncate', '416']
+    save_path = str(tmp_path / 'result.png')
+
+    manager.download(server.url, save_path)
+
+    assert open(save_path, 'rb').read() == CONTENT
+    assert [request['range'] is not None for request in server.requests] == [False, True, False]
+
+
+def test_stale_part_file_without_validator_is_not_resumed(tmp_path, server, manager):
+    save_path = str(tmp_path / 'result.png')
+    with open(f"{save_path}.part", 'wb') as f:
+        f.write(b'stale bytes from another version')
+
+    manager.download(server.url, save_path)
+
+    assert open(save_path, 'rb').read() == CONTENT
+    assert server.requests == [{'range': None, 'if_range': None}]
+
+
+def test_oversize_download_aborts_without_retry(tmp_path, server):
+    manager = DownloadManager(max_retries=2, retry_delay=0, max_bytes=1024)
+    save_path = str(tmp_path / 'result.png')
+
+    assert manager.download(server.url, save_path) is None
+    assert len(server.requests) == 1
+    assert manager.failed_count == 1
+    assert not os.path.exists(save_path) and not os.path.exists(f"{save_path}.part")
+    manager.executor.shutdown()
+
+
+def test_checksum_mismatch_discards_the_download(tmp_path, server, manager):
+    save_path = str(tmp_path / 'result.png')
+
+    assert manager.download(server.url, save_path, expected_sha256='0' * 64) is None
+    # 校验失败的数据不用于续传，每次都从头下载
+    assert [request['range'] for request in server.requests] == [None, None, None]
+    assert not os.path.exists(save_path) and not os.path.exists(f"{save_path}.part")
@@ -0,0 +1,199 @@
+import base64
+import io
+import os
+import time
+
+from PIL import Image
+
+from image_utils import (
+    EXIF_ORIENTATION_TAG, DecodedImageCache, ThumbnailCache, UploadImageTransformer, file_content_hash,
+)
+
+
+def noise_image(width, height):
+    """随机像素图，压缩率低，便于测试字节预算"""
+    return Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+
+
+def save_image(img, path, image_format='JPEG', **kwargs):
+    img.save(path, format=image_format, **kwargs)
+    return str(path)
+
+
+def test_output_fits_byte_budget(tmp_path):
+    source = save_image(noise_image(1200, 900), tmp_path / 'big.jpg', quality=95)
+    transformer = UploadImageTransformer(str(tmp_path / 'cache'), max_edge=1024, max_bytes=60 * 1024)
+
+    upload_path = transformer.prepare(source)
+
+    assert upload_path != source
+    assert os.path.getsize(upload_path) <= 60 * 1024
+    with Image.open(upload_path) as img:
+        assert img.format == 'JPEG'
+        assert max(img.size) <= 1024
+
+
+def test_exif_orientation_is_applied(tmp_path):
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION_TAG] = 6  # 顺时针旋转90度显示
+    source = save_image(noise_image(400, 200), tmp_path / 'rotated.jpg', exif=exif.tobytes())
+    transformer = UploadImageTransformer(str(tmp_path / 'cache'))
+
+    upload_path = transformer.prepare(source)
+
+    assert upload_path != source
+    with Image.open(upload_path) as img:
+        assert img.size == (200, 400)
+        assert img.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1
+
+
+def test_data_url_mime_matches_encoded_bytes(tmp_path):
+    png_source = save_image(noise_image(300, 200), tmp_path / 'user.png', image_format='PNG')
+    transformer = UploadImageTransformer(str(tmp_path / 'cache'), image_format='webp')
+
+    header, payload = transformer.encode_data_url(png_source).split(',', 1)
+    assert header == 'data:image/webp;base64'
+    with Image.open(io.BytesIO(base64.b64decode(payload))) as img:
+        assert img.format == 'WEBP'
+
+    # 原图已满足要求时按原图标注
+    jpeg_source = save_image(noise_image(300, 200), tmp_path / 'ready.jpg')
+    header, payload = UploadImageTransformer(str(tmp_path / 'cache')).encode_data_url(jpeg_source).split(',', 1)
+    assert header == 'data:image/jpeg;base64'
+    with Image.open(io.BytesIO(base64.b64decode(payload))) as img:
+        assert img.format == 'JPEG'
+
+
+def test_upload_ready_file_passes_through_and_is_memoized(tmp_path, monkeypatch):
+    source = save_image(noise_image(300, 200), tmp_path / 'ready.jpg')
+    transformer = UploadImageTransformer(str(tmp_path / 'cache'), max_edge=1024)
+
+    assert transformer.prepare(source) == source
+    assert os.listdir(transformer.cache_dir) == []
+    assert transformer.cache_misses == 1
+
+    # 第二次不再打开文件判定
+    def fail(*args, **kwargs):
+        raise AssertionError('ready file should not be re-examined')
+
+    monkeypatch.setattr(transformer, '_transform', fail)
+    assert transformer.prepare(source) == source
+    assert transformer.cache_hits == 1
+
+
+def fill_cache(cache_dir, count, size, age_seconds):
+    """写入count个指定大小、修改时间为age_seconds之前的缓存文件"""
+    paths = []
+    for i in range(count):
+        path = os.path.join(cache_dir, f"old{i}_128.webp")
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        mtime = time.time() - age_seconds + i
+        os.utime(path, (mtime, mtime))
+        paths.append(path)
+    return paths
+
+
+def test_thumbnail_is_cached_by_content_hash_and_size(tmp_path):
+    source = save_image(noise_image(600, 400), tmp_path / 'user.jpg')
+    cache = ThumbnailCache(str(tmp_path / 'thumbs'))
+
+    thumb_path, mime_type, etag = cache.get(source, 256, 'webp')
+    content_hash = file_content_hash(source)
+    assert os.path.basename(thumb_path) == f"{content_hash}_256.webp"
+    assert mime_type == 'image/webp'
+    assert etag == f"{content_hash}-256-webp"
+    with Image.open(thumb_path) as img:
+        assert max(img.size) == 256
+
+    assert cache.get(source, 256, 'webp')[0] == thumb_path
+    assert cache.get(source, 128, 'jpeg')[0].endswith(f"{content_hash}_128.jpg")
+    assert (cache.cache_hits, cache.cache_misses) == (1, 2)
+
+
+def test_prune_evicts_least_recently_used_but_keeps_recent_files(tmp_path):
+    cache_dir = str(tmp_path / 'thumbs')
+    os.makedirs(cache_dir)
+    old = fill_cache(cache_dir, 4, 300 * 1024, age_seconds=3600)
+    cache = ThumbnailCache(cache_dir, max_total_size_mb=1, grace_seconds=60)
+    recent = os.path.join(cache_dir, 'recent_128.webp')
+    with open(recent, 'wb') as f:
+        f.write(b'x' * 300 * 1024)
+
+    removed_files, removed_size = cache.prune()
+
+    # 淘汰到容量上限的80%以下，最旧的先删；宽限期内的文件即使超出容量也保留
+    assert removed_files == 3
+    assert removed_size == 3 * 300 * 1024
+    assert [os.path.exists(path) for path in old] == [False, False, False, True]
+    assert os.path.exists(recent)
+
+
+def test_over_budget_generation_prunes_in_background(tmp_path):
+    cache_dir = str(tmp_path / 'thumbs')
+    os.makedirs(cache_dir)
+    old = fill_cache(cache_dir, 4, 300 * 1024, age_seconds=3600)
+    cache = ThumbnailCache(cache_dir, max_total_size_mb=1, max_workers=1)
+    source = save_image(noise_image(600, 400), tmp_path / 'user.jpg')
+
+    thumb_path, _, _ = cache.get(source, 128)
+    cache.executor.submit(lambda: None).result()
+
+    assert os.path.exists(thumb_path)
+    assert not os.path.exists(old[0])
+    assert not cache._prune_pending
+
+
+def make_files(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"image{i}.jpg"
+        path.write_bytes(b'image')
+        paths.append(str(path))
+    return paths
+
+
+def gray_loader(size):
+    """返回size×size灰度图的解码函数，并记录被调用的路径"""
+    loaded = []
+
+    def loader(image_path, target_height):
+        loaded.append(image_path)
+        return Image.new('L', (size, size))
+
+    return loader, loaded
+
+
+def test_decoded_cache_accounts_bytes_and_evicts_least_recently_used(tmp_path):
+    a, b, c = make_files(tmp_path, 3)
+    cache = DecodedImageCache(max_bytes=2 * 100 * 100)
+    loader, loaded = gray_loader(100)
+
+    cache.get_or_load(a, 512, loader)
+    cache.get_or_load(b, 512, loader)
+    assert cache._total_bytes == 2 * 100 * 100
+    cache.get_or_load(a, 512, loader)  # a变为最近使用
+    cache.get_or_load(c, 512, loader)  # 超出预算，淘汰b
+
+    assert cache.evictions == 1
+    assert cache._total_bytes == 2 * 100 * 100
+    assert [key[0] for key in cache._entries] == [a, c]
+    cache.get_or_load(b, 512, loader)
+    assert loaded == [a, b, c, b]
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+def test_decoded_cache_keys_by_target_height_and_skips_oversized_images(tmp_path):
+    (path,) = make_files(tmp_path, 1)
+    cache = DecodedImageCache(max_bytes=100 * 100)
+    loader, loaded = gray_loader(100)
+
+    cache.get_or_load(path, 512, loader)
+    cache.get_or_load(path, 1024, loader)
+    assert loaded == [path, path]
+    assert cache.evictions == 1
+
+    big_loader, _ = gray_loader(200)
+    cache.get_or_load(path, 2048, big_loader)
+    assert len(cache._entries) == 1
+    assert cache._total_bytes == 100 * 100
@@ -0,0 +1,181 @@
+import asyncio
+import os
+
+import pytest
+
+from job_ledger import JobLedger, STATUS_COMPLETED, STATUS_FAILED, STATUS_SUBMITTED
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = JobLedger(str(tmp_path / 'ledger.db'))
+    yield ledger
+    ledger.close()
+
+
+def test_update_merges_fields_and_counts_attempts(ledger):
+    key = JobLedger.make_key('color', 'a.jpg', 'b.jpg')
+    ledger.update(key, 'color', STATUS_SUBMITTED, task_id='t1', file_name='f1')
+    ledger.update(key, 'color', STATUS_SUBMITTED, task_id='t2')
+    ledger.update(key, 'color', STATUS_FAILED, task_id=None, last_error='poll timeout')
+
+    entry = ledger.get(key)
+    assert entry['status'] == STATUS_FAILED
+    assert entry['attempts'] == 2
+    assert entry['file_name'] == 'f1'
+    assert entry['last_error'] == 'poll timeout'
+    assert 'task_id' not in entry
+    assert ledger.count_by_status('color') == {STATUS_FAILED: 1}
+    assert ledger.get('missing') is None
+
+
+class _GeminiStub:
+    """记录Gemini调用次数，返回写到输出目录的处理结果"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.calls = 0
+
+    async def __call__(self, image_path, image_type, file_hash, thread_name):
+        self.calls += 1
+        processed_path = os.path.join(self.output_dir, f"{file_hash}_{self.calls}.png")
+        with open(processed_path, 'wb') as f:
+            f.write(b'processed')
+        return processed_path
+
+
+@pytest.fixture
+def make_processor(tmp_path, monkeypatch):
+    from batch_gemini_processor import BatchGeminiProcessor
+
+    monkeypatch.setenv('OPENROUTER_API_KEY', 'test')
+    monkeypatch.setenv('JOB_LEDGER_ENABLED', 'true')
+    monkeypatch.setenv('JOB_LEDGER_PATH', str(tmp_path / 'job_ledger.db'))
+    monkeypatch.setenv('UPLOAD_TRANSFORM_ENABLED', 'false')
+    output_dir = str(tmp_path / 'outputs')
+    gemini = _GeminiStub(str(tmp_path))
+    processors = []
+
+    def _make():
+        # 每次新建处理器，相当于批处理中断后重新运行
+        processor = BatchGeminiProcessor(output_base_dir=output_dir)
+        processor.get_cached_processed_path = lambda image_path, image_type: None
+        processor._run_gemini_preprocess = gemini
+        processors.append(processor)
+        return processor
+
+    yield _make, gemini
+    for processor in processors:
+        processor.ledger.close()
+
+
+def _preprocess(processor, image_path):
+    return asyncio.run(processor.preprocess_image_with_gemini(image_path, 'user'))
+
+
+def test_ledger_resume_skips_completed_images(tmp_path, make_processor):
+    make, gemini = make_processor
+    image_path = str(tmp_path / 'user.jpg')
+    with open(image_path, 'wb') as f:
+        f.write(b'image-v1')
+
+    first = _preprocess(make(), image_path)
+    resumed_processor = make()
+    resumed = _preprocess(resumed_processor, image_path)
+
+    assert gemini.calls == 1
+    assert resumed == first
+    assert resumed_processor.cached_count == 1
+    entry = resumed_processor.ledger.get(JobLedger.make_key('gemini', image_path))
+    assert entry['status'] == STATUS_COMPLETED and entry['processed_path'] == first
+
+
+def test_fingerprint_change_reruns_image(tmp_path, make_processor, monkeypatch):
+    make, gemini = make_processor
+    image_path = str(tmp_path / 'user.jpg')
+    with open(image_path, 'wb') as f:
+        f.write(b'image-v1')
+    _preprocess(make(), image_path)
+
+    # 源文件内容变化
+    with open(image_path, 'wb') as f:
+        f.write(b'image-v2-changed')
+    _preprocess(make(), image_path)
+    assert gemini.calls == 2
+
+    # 提示词版本变化
+    monkeypatch.setenv('GEMINI_PROMPT_VERSION', 'v2')
+    _preprocess(make(), image_path)
+    assert gemini.calls == 3
+
+    # 指纹未变时不再重复处理
+    _preprocess(make(), image_path)
+    assert gemini.calls == 3
+
+
+def test_missing_result_file_reruns_image(tmp_path, make_processor):
+    make, gemini = make_processor
+    image_path = str(tmp_path / 'user.jpg')
+    with open(image_path, 'wb') as f:
+        f.write(b'image-v1')
+
+    os.remove(_preprocess(make(), image_path))
+    _preprocess(make(), image_path)
+    assert gemini.calls == 2
+
+
+@pytest.fixture
+def hairstyle_processor(tmp_path, monkeypatch):
+    from hairstyle_processor_v2 import HairstyleProcessor
+
+    monkeypatch.setenv('RUNNINGHUB_API_KEY', 'test')
+    monkeypatch.setenv('RAILWAY_VOLUME_MOUNT_PATH', str(tmp_path / 'data'))
+    monkeypatch.setenv('JOB_LEDGER_ENABLED', 'true')
+    processor = HairstyleProcessor()
+    processor.open_job_ledger()
+    yield processor
+    processor.ledger.close()
+
+
+def test_submitted_task_is_polled_instead_of_resubmitted(tmp_path, hairstyle_processor, monkeypatch):
+    processor = hairstyle_processor
+    user_path, hairstyle_path = str(tmp_path / 'user.jpg'), str(tmp_path / 'hair.jpg')
+    key = JobLedger.make_key('hairstyle', user_path, hairstyle_path)
+    processor.ledger.update(key, 'hairstyle', STATUS_SUBMITTED, task_id='t1')
+    results_dir = processor._results_dir('man')
+    polled = []
+
+    def fail(*args, **kwargs):
+        raise AssertionError('resumed task must not be resubmitted')
+
+    def download_results(results, target_dir, pattern):
+        path = os.path.join(target_dir, pattern.format(i=0))
+        with open(path, 'wb') as f:
+            f.write(b'result')
+        return [path], [os.path.basename(path)]
+
+    monkeypatch.setattr(processor, 'upload_image', fail)
+    monkeypatch.setattr(processor, 'run_hairstyle_task', fail)
+    monkeypatch.setattr(processor, 'check_task_status', lambda task_id: polled.append(task_id) or 'SUCCESS')
+    monkeypatch.setattr(processor, 'get_task_results', lambda task_id: [{'fileUrl': 'http://result.test/0.png'}])
+    monkeypatch.setattr(processor, 'download_results', download_results)
+    monkeypatch.setattr(processor, 'create_combined_image', lambda *args: None)
+
+    task_info = (user_path, hairstyle_path, 'user.jpg', 'hair.jpg', 'man', results_dir)
+    assert processor.process_single_combination(task_info) is True
+    assert polled == ['t1']
+    entry = processor.ledger.get(key)
+    assert entry['status'] == STATUS_COMPLETED
+    assert entry['result']['result_images'] == [os.path.join(results_dir, 'man_user.jpg_hair.jpg_result_0.png')]
+
+
+def test_results_dir_keeps_date_unless_resume_requested(hairstyle_processor, monkeypatch):
+    processor = hairstyle_processor
+    previous = os.path.join(processor.data_dir, 'results_man_0000_')
+    os.makedirs(previous)
+    today = processor._results_dir('man')
+    assert today != previous and os.path.basename(today).startswith('results_man_')
+
+    os.rmdir(today)
+    monkeypatch.setenv('BATCH_RESUME', 'true')
+    assert processor._results_dir('man') == previous
@@ -0,0 +1,89 @@
+import os
+import re
+import zipfile
+
+import pytest
+from docx import Document
+from PIL import Image
+
+from report_builder import ReportBuilder
+
+
+@pytest.fixture
+def builder(tmp_path):
+    with ReportBuilder(asset_dir=str(tmp_path / 'assets'), max_results_per_document=2,
+                       image_max_edge=64, combined_max_edge=128) as builder:
+        yield builder
+
+
+def save_image(path, size, color=(200, 100, 50)):
+    Image.new('RGB', size, color).save(path)
+    return str(path)
+
+
+def make_results(tmp_path, count):
+    """count条结果共用同一张发型参考图，每条有自己的用户图、结果图和拼接图"""
+    hairstyle = save_image(tmp_path / 'hair.png', (300, 400))
+    results = []
+    for i in range(count):
+        results.append({
+            'gender': 'man',
+            'user_filename': f'user{i}.jpg',
+            'hairstyle_filename': 'hair.png',
+            'hairstyle_image': hairstyle,
+            'user_image': save_image(tmp_path / f'user{i}.jpg', (200, 300)),
+            'result_images': [save_image(tmp_path / f'result{i}.png', (200, 300))],
+            'combined_image': save_image(tmp_path / f'combined{i}.jpg', (700, 300)),
+        })
+    return results
+
+
+def test_report_image_is_downscaled_once(tmp_path, builder):
+    source = save_image(tmp_path / 'big.png', (800, 400))
+
+    asset = builder.report_image(source, 128)
+    asset_path, width, height = asset
+
+    assert (width, height) == (128, 64)
+    with Image.open(asset_path) as img:
+        assert img.format == 'JPEG' and img.size == (width, height)
+    assert builder.report_image(source, 128) == asset
+
+
+def test_write_docx_splits_by_results_per_document(tmp_path, builder):
+    results = make_results(tmp_path, 5)
+
+    paths = builder.write_docx(results, str(tmp_path / 'report.docx'))
+
+    assert [os.path.basename(p) for p in paths] == ['report_part1.docx', 'report_part2.docx', 'report_part3.docx']
+    headings = []
+    for path in paths:
+        document = Document(path)
+        headings.append([p.text.split(':')[0] for p in document.paragraphs if p.style.name == 'Heading 1'])
+        assert any(p.text == '总共处理: 5 个组合' for p in document.paragraphs)
+    assert headings == [['结果 1', '结果 2'], ['结果 3', '结果 4'], ['结果 5']]
+    # 每条结果：拼接图 + 发型参考图 + 用户照片 + 生成结果
+    assert len(Document(paths[0]).inline_shapes) == 2 * 4
+
+
+def test_small_batch_writes_a_single_document(tmp_path, builder):
+    path = str(tmp_path / 'report.docx')
+    assert builder.write_docx(make_results(tmp_path, 2), path) == [path]
+
+
+def test_write_zip_contains_index_and_each_image_once(tmp_path, builder):
+    results = make_results(tmp_path, 3)
+
+    output_path = builder.write_zip(results, str(tmp_path / 'report.zip'))
+
+    with zipfile.ZipFile(output_path) as zf:
+        names = zf.namelist()
+        index = zf.read('index.html').decode('utf-8')
+        image_names = [name for name in names if name.startswith('images/')]
+        # 3条结果 × (拼接图 + 用户照片 + 生成结果) + 共用的发型参考图
+        assert len(image_names) == len(set(image_names)) == 3 * 3 + 1
+        assert set(re.findall(r'src="(images/[^"]+)"', index)) == set(image_names)
+        for name in image_names:
+            assert zf.read(name)[:3] == b'\xff\xd8\xff'
+    assert index.count('<h2>') == 3
+    assert 'width="128" height="55"' in index
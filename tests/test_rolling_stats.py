@@ -0,0 +1,41 @@
+import random
+import statistics
+
+import pytest
+
+from rolling_stats import P2Quantile, RollingStats
+
+
+@pytest.mark.parametrize('p', [0.5, 0.9, 0.95, 0.99])
+def test_p2_quantile_tracks_exact_quantile(p):
+    rng = random.Random(42)
+    samples = [rng.expovariate(1.0) for _ in range(20000)]
+    estimator = P2Quantile(p)
+    for value in samples:
+        estimator.add(value)
+
+    exact = sorted(samples)[int(p * len(samples))]
+    assert estimator.value() == pytest.approx(exact, rel=0.05)
+
+
+def test_p2_quantile_with_few_samples():
+    estimator = P2Quantile(0.5)
+    assert estimator.value() is None
+    for value in (3, 1, 2):
+        estimator.add(value)
+    assert estimator.value() == 2
+
+
+def test_rolling_stats_summary():
+    rng = random.Random(7)
+    samples = [rng.uniform(1, 10) for _ in range(5000)]
+    stats = RollingStats(window=100)
+    for value in samples:
+        stats.append(value)
+
+    assert len(stats) == len(samples)
+    assert stats.mean == pytest.approx(statistics.mean(samples))
+    assert stats.stddev == pytest.approx(statistics.stdev(samples))
+    assert stats.min == min(samples) and stats.max == max(samples)
+    assert stats.recent() == samples[-100:]
+    assert stats.quantile(0.5) == pytest.approx(statistics.median(samples), rel=0.05)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+from runninghub_client import DeadlineExceeded, RunningHubClient, request_deadline
+
+
+class StubClient(RunningHubClient):
+    """按调用顺序返回预设耗时的响应，不发出真实请求"""
+
+    def __init__(self, delays, **kwargs):
+        kwargs.setdefault('hedge_default_delay', 0.05)
+        kwargs.setdefault('hedge_min_delay', 0.01)
+        super().__init__(base_url='http://runninghub.test', **kwargs)
+        self.delays = list(delays)
+        self.calls = []
+        self._calls_lock = threading.Lock()
+
+    def _send(self, operation, path, body, headers, timeout):
+        with self._calls_lock:
+            index = len(self.calls)
+            self.calls.append((threading.current_thread().name, timeout))
+        delay = self.delays[index] if index < len(self.delays) else 0
+        time.sleep(min(delay, timeout))
+        if delay > timeout:
+            raise TimeoutError('stub timeout')
+        return {'code': 0, 'call': index}
+
+
+def warm(client, count=20):
+    """先累计足够的请求数，使对冲预算允许发出对冲"""
+    client.request_count = count
+
+
+def test_fast_primary_is_not_hedged():
+    client = StubClient([0])
+    warm(client)
+    assert client.post('/task/openapi/status', {}, operation='status', idempotent=True) == {'code': 0, 'call': 0}
+    assert client.hedged_count == 0
+    assert len(client.calls) == 1
+
+
+def test_slow_primary_is_hedged_and_hedge_wins():
+    client = StubClient([1.0, 0])
+    warm(client)
+    result = client.post('/task/openapi/status', {}, operation='status', idempotent=True)
+    assert result == {'code': 0, 'call': 1}
+    assert client.hedged_count == 1
+    assert client.hedge_win_count == 1
+
+
+def test_non_idempotent_request_runs_on_caller_thread_without_hedge():
+    client = StubClient([0.2])
+    warm(client)
+    client.post('/task/openapi/ai-app/run', {}, operation='run')
+    assert client.hedged_count == 0
+    assert client.calls == [(threading.current_thread().name, pytest.approx(60))]
+
+
+def test_hedge_budget_limits_hedges():
+    client = StubClient([0.2], hedge_budget_ratio=0.1)
+    client.request_count = 0
+    result = client.post('/task/openapi/status', {}, operation='status', idempotent=True)
+    assert result == {'code': 0, 'call': 0}
+    assert client.hedged_count == 0
+    assert client.hedge_skipped_count == 1
+    assert len(client.calls) == 1
+
+
+def test_saturated_pool_sends_on_caller_thread():
+    client = StubClient([0], max_workers=1)
+    warm(client)
+    assert client._worker_slots.acquire(blocking=False)
+    try:
+        client.post('/task/openapi/status', {}, operation='status', idempotent=True)
+    finally:
+        client._worker_slots.release()
+    assert client.calls[0][0] == threading.current_thread().name
+    assert client.hedged_count == 0
+
+
+def test_expired_deadline_raises_before_sending():
+    client = StubClient([0])
+    with request_deadline(0):
+        with pytest.raises(DeadlineExceeded):
+            client.post('/task/openapi/status', {}, operation='status', idempotent=True)
+    assert client.calls == []
+    assert client.deadline_exceeded_count == 1
+
+
+def test_session_deadline_bounds_hedged_request():
+    client = StubClient([5.0, 5.0])
+    warm(client)
+    start = time.monotonic()
+    with request_deadline(0.3):
+        with pytest.raises(TimeoutError):
+            client.post('/task/openapi/status', {}, operation='status', idempotent=True)
+    assert time.monotonic() - start < 1.0
+    assert all(timeout <= 0.3 for _, timeout in client.calls)
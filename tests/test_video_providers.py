@@ -0,0 +1,188 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+
+from video_providers import (
+    ProviderHealth, ProviderUnavailable, RunningHubVideoProvider, TaskPoll, VideoTaskEngine, is_provider_fault,
+)
+
+
+def make_runninghub_provider(responses):
+    processor = SimpleNamespace(webapp_3d_id='3d-app', api_key='key', task_times=[], task_count=0)
+    provider = RunningHubVideoProvider(processor, http_client=None)
+    provider.posts = 0
+
+    async def _post(path, payload):
+        provider.posts += 1
+        return responses[min(provider.posts, len(responses)) - 1]
+
+    provider._post = _post
+    return provider
+
+
+def test_queue_maxed_submit_stops_at_session_deadline():
+    provider = make_runninghub_provider([{'code': 421, 'msg': 'TASK_QUEUE_MAXED'}])
+    start = time.monotonic()
+    task_id = asyncio.run(provider.submit('file.png', max_retries=10, retry_delay=20, deadline=start + 5))
+    assert task_id is None
+    assert provider.posts == 1
+    assert time.monotonic() - start < 2
+
+
+def test_submit_after_deadline_sends_nothing():
+    provider = make_runninghub_provider([{'code': 0, 'data': {'taskId': 't1'}}])
+    assert asyncio.run(provider.submit('file.png', deadline=time.monotonic() - 1)) is None
+    assert provider.posts == 0
+
+
+def test_queue_maxed_submit_retries_within_deadline():
+    provider = make_runninghub_provider([
+        {'code': 421, 'msg': 'TASK_QUEUE_MAXED'},
+        {'code': 0, 'data': {'taskId': 't1'}},
+    ])
+    task_id = asyncio.run(provider.submit('file.png', retry_delay=1, deadline=time.monotonic() + 30))
+    assert task_id == 't1'
+    assert provider.posts == 2
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeProvider:
+    """只提供引擎需要的属性的服务商替身"""
+
+    def __init__(self, name, expected_seconds=60, submit_result='task-1', poll_status='SUCCESS'):
+        self.name = name
+        self.expected_seconds = expected_seconds
+        self.submit_result = submit_result
+        self.poll_status = poll_status
+
+    def observe_duration(self, seconds):
+        self.expected_seconds = seconds
+
+    async def submit(self, image_input, cancel_check_func=None, callback_url=None):
+        if isinstance(self.submit_result, Exception):
+            raise self.submit_result
+        return self.submit_result
+
+    async def poll(self, task_id):
+        return TaskPoll(self.poll_status)
+
+
+def make_engine(*providers, **kwargs):
+    kwargs.setdefault('min_interval', 0.01)
+    kwargs.setdefault('max_interval', 0.01)
+    engine = VideoTaskEngine(SimpleNamespace(), **kwargs)
+    for provider in providers:
+        engine._providers[provider.name] = provider
+    return engine
+
+
+def test_breaker_opens_after_consecutive_failures_and_half_opens_after_cooldown():
+    clock = FakeClock()
+    health = ProviderHealth('p', open_seconds=120, clock=clock)
+    for _ in range(3):
+        assert health.acquire()
+        health.record_failure()
+    assert health.state == ProviderHealth.OPEN
+    assert not health.available()
+
+    clock.now += 119
+    assert not health.acquire()
+    clock.now += 1
+    assert health.available()
+    assert health.acquire()
+    # 半开状态只放行一个试探任务
+    assert not health.acquire()
+    assert not health.available()
+
+    health.record_success()
+    assert health.state == ProviderHealth.CLOSED
+    assert health.acquire()
+
+
+def test_failed_half_open_trial_reopens_the_breaker():
+    clock = FakeClock()
+    health = ProviderHealth('p', open_seconds=10, clock=clock)
+    for _ in range(3):
+        health.record_failure()
+    clock.now += 10
+    assert health.acquire()
+    health.record_failure()
+    assert health.state == ProviderHealth.OPEN
+    assert health.opened_at == clock.now
+
+
+def test_release_returns_the_half_open_trial():
+    clock = FakeClock()
+    health = ProviderHealth('p', open_seconds=10, clock=clock)
+    for _ in range(3):
+        health.record_failure()
+    clock.now += 10
+    assert health.acquire()
+    health.release()
+    assert health.state == ProviderHealth.HALF_OPEN
+    assert health.acquire()
+
+
+def test_error_rate_opens_the_breaker():
+    health = ProviderHealth('p', min_samples=4, error_threshold=0.5, clock=FakeClock())
+    for ok in (True, False, True, False):
+        if ok:
+            health.record_success()
+        else:
+            health.record_failure()
+    assert health.state == ProviderHealth.OPEN
+
+
+def test_rank_providers_orders_by_latency_and_skips_open_breakers():
+    clock = FakeClock()
+    engine = make_engine(FakeProvider('slow', 200), FakeProvider('fast', 50), FakeProvider('mid', 100), clock=clock)
+    assert engine.rank_providers(['slow', 'fast', 'mid']) == ['fast', 'mid', 'slow']
+    assert engine.rank_providers(['slow', 'fast', 'mid'], preferred='slow') == ['slow', 'fast', 'mid']
+
+    for _ in range(3):
+        engine.health('fast').record_failure()
+    assert engine.rank_providers(['slow', 'fast', 'mid']) == ['mid', 'slow']
+    clock.now += engine.breaker_open_seconds
+    assert engine.rank_providers(['slow', 'fast', 'mid']) == ['fast', 'mid', 'slow']
+
+
+def test_failed_task_does_not_count_against_the_breaker():
+    engine = make_engine(FakeProvider('p', poll_status='FAILED'))
+    for _ in range(5):
+        assert asyncio.run(engine.wait('p', 'task-1', timeout=5)) == 'FAILED'
+    assert engine.health('p').state == ProviderHealth.CLOSED
+    assert engine.health('p').consecutive_failures == 0
+
+
+def test_rejected_submit_does_not_count_against_the_breaker():
+    engine = make_engine(FakeProvider('p', submit_result=None))
+    for _ in range(5):
+        assert asyncio.run(engine.submit('p', 'image')) is None
+    assert engine.health('p').state == ProviderHealth.CLOSED
+
+
+def test_provider_fault_on_submit_opens_the_breaker():
+    engine = make_engine(FakeProvider('p', submit_result=ProviderUnavailable('503')))
+    for _ in range(3):
+        assert asyncio.run(engine.submit('p', 'image')) is None
+    assert engine.health('p').state == ProviderHealth.OPEN
+    assert asyncio.run(engine.submit('p', 'image')) is None
+
+
+def test_is_provider_fault():
+    request = httpx.Request('POST', 'http://provider.test')
+    assert is_provider_fault(httpx.ConnectError('boom', request=request))
+    assert is_provider_fault(httpx.ReadTimeout('slow', request=request))
+    for status, expected in ((500, True), (503, True), (429, True), (400, False), (404, False)):
+        error = httpx.HTTPStatusError('status', request=request, response=httpx.Response(status, request=request))
+        assert is_provider_fault(error) is expected
+    assert not is_provider_fault(ValueError('bad input'))
@@ -0,0 +1,252 @@
+"""
+会话追踪
+按会话记录处理过程中的span（图片接收、入库、上传、任务提交及每次排队重试、状态轮询、结果获取等），
+每个会话保留最近的span（环形缓冲区），会话数按LRU淘汰；可选把span以OTLP JSON逐行导出到本地文件。
+当前会话和父span通过contextvars传递，在线程池和共享事件循环中执行的代码需用 wrap()/bind() 带上上下文。
+"""
+
+import logging
+import os
+import json
+import time
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current_session = contextvars.ContextVar('trace_session', default=None)
+_current_span = contextvars.ContextVar('trace_span', default=None)
+
+
+class Span:
+    """一次操作的起止时间、属性和结果"""
+
+    def __init__(self, session_id, name, parent_id=None, attributes=None, start_time=None):
+        self.session_id = session_id
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time = start_time if start_time is not None else time.time()
+        self.end_time = None
+        self.error = None
+        self._started = time.monotonic()
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def fail(self, error):
+        """标记为失败（异常已被调用方处理、没有抛出span时使用）"""
+        self.error = str(error)
+
+    def finish(self, end_time=None):
+        if end_time is None:
+            end_time = self.start_time + (time.monotonic() - self._started)
+        self.end_time = end_time
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration_ms': round((self.end_time - self.start_time) * 1000, 1),
+            'status': 'ERROR' if self.error else 'OK',
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+    def to_otlp(self):
+        status = {'code': 2, 'message': self.error} if self.error else {'code': 1}
+        return {
+            'traceId': hashlib.sha256(self.session_id.encode('utf-8')).hexdigest()[:32],
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(self.start_time * 1e9)),
+            'endTimeUnixNano': str(int(self.end_time * 1e9)),
+            'attributes': [_otlp_attribute('session.id', self.session_id)]
+                          + [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            'status': status,
+        }
+
+
+class _NoopSpan:
+    """不在会话上下文中时使用，不记录任何内容"""
+
+    def set(self, key, value):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+class Tracer:
+    """按会话保存span的内存追踪器"""
+
+    def __init__(self, enabled=True, max_sessions=500, max_spans=500, export_path=None,
+                 service_name='hairstyle-proxy'):
+        self.enabled = enabled
+        self.max_sessions = max_sessions
+        self.max_spans = max_spans
+        self.export_path = export_path
+        self.service_name = service_name
+        self._sessions = OrderedDict()   # session_id -> deque[Span]
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self.export_errors = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get('TRACE_ENABLED', 'true').strip().lower() in {'1', 'true', 'yes', 'on'},
+            max_sessions=int(os.environ.get('TRACE_MAX_SESSIONS', '500')),
+            max_spans=int(os.environ.get('TRACE_MAX_SPANS', '500')),
+            export_path=os.environ.get('TRACE_OTLP_EXPORT_PATH') or None,
+            service_name=os.environ.get('OTEL_SERVICE_NAME', 'hairstyle-proxy'),
+        )
+
+    def record(self, span):
+        with self._lock:
+            spans = self._sessions.get(span.session_id)
+            if spans is None:
+                spans = self._sessions[span.session_id] = deque(maxlen=self.max_spans)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(span.session_id)
+            spans.append(span)
+        if self.export_path:
+            self._export(span)
+
+    def _export(self, span):
+        """追加一行OTLP JSON（ExportTraceServiceRequest格式）"""
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', self.service_name)]},
+                'scopeSpans': [{'scope': {'name': 'hairstyle.tracing'}, 'spans': [span.to_otlp()]}],
+            }]
+        }
+        line = json.dumps(payload, ensure_ascii=False)
+        try:
+            with self._export_lock:
+                with open(self.export_path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+        except OSError as e:
+            self.export_errors += 1
+            if self.export_errors == 1:
+                logger.error(f"追踪导出失败 {self.export_path}: {e}")
+
+    def get_trace(self, session_id):
+        """会话的span列表（按开始时间排序），没有记录时返回None"""
+        with self._lock:
+            spans = self._sessions.get(session_id)
+            if spans is None:
+                return None
+            spans = list(spans)
+        return [span.to_dict() for span in sorted(spans, key=lambda span: span.start_time)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'sessions': len(self._sessions),
+                'export_path': self.export_path,
+                'export_errors': self.export_errors,
+            }
+
+
+tracer = Tracer.from_env()
+
+
+@contextmanager
+def session_trace(session_id):
+    """之后创建的span记录到该会话"""
+    session_token = _current_session.set(session_id)
+    span_token = _current_span.set(None)
+    try:
+        yield
+    finally:
+        _current_span.reset(span_token)
+        _current_session.reset(session_token)
+
+
+def current_session():
+    return _current_session.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """记录代码块的span；不在会话上下文中时不记录"""
+    session_id = _current_session.get()
+    if session_id is None or not tracer.enabled:
+        yield _NOOP_SPAN
+        return
+
+    current = Span(session_id, name, _current_span.get(), attributes)
+    token = _current_span.set(current.span_id)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish()
+        tracer.record(current)
+
+
+def record(name, start_time, end_time, **attributes):
+    """记录已知起止时间（time.time()）的span，如按轮询状态推算的排队/运行阶段"""
+    session_id = _current_session.get()
+    if session_id is None or not tracer.enabled:
+        return
+    completed = Span(session_id, name, _current_span.get(), attributes, start_time=start_time)
+    completed.finish(end_time)
+    tracer.record(completed)
+
+
+def event(name, **attributes):
+    """记录瞬时事件（耗时为0的span）"""
+    now = time.time()
+    record(name, now, now, **attributes)
+
+
+def wrap(func):
+    """把当前上下文带到线程池中执行的函数"""
+    context = contextvars.copy_context()
+
+    def _run(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+    return _run
+
+
+def bind(coro):
+    """把当前会话和父span带到共享事件循环中执行的协程"""
+    session_id = _current_session.get()
+    parent_id = _current_span.get()
+
+    async def _bound():
+        _current_session.set(session_id)
+        _current_span.set(parent_id)
+        return await coro
+    return _bound()
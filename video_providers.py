@@ -0,0 +1,921 @@
+"""
+3D视频生成服务商（RunningHub / 火山引擎 / 拍我AI）
+统一的异步接口，运行在共享事件循环上并共用httpx连接池；
+任务轮询间隔按服务商的预计耗时（响应中的ETA或历史平均耗时）调度，
+服务商支持回调时由回调提前唤醒，轮询只作为兜底。
+"""
+
+import logging
+import os
+import time
+import asyncio
+import mimetypes
+import threading
+from collections import deque
+
+import httpx
+
+from async_runtime import get_async_runtime
+from asset_registry import InvalidAssetError, is_invalid_asset_error
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# 轮询结束时的状态（除服务商状态外）
+STATUS_TIMEOUT = 'TIMEOUT'
+STATUS_CANCEL_REQUESTED = 'CANCEL_REQUESTED'
+
+_ETA_KEYS = ('eta', 'estimated_time', 'estimatedTime', 'remaining_time', 'remainingTime', 'wait_time')
+
+
+def _find_eta(payload):
+    """从响应中查找剩余时间提示（秒），没有时返回None"""
+    if not isinstance(payload, dict):
+        return None
+    for container in (payload, payload.get('data'), payload.get('Resp')):
+        if not isinstance(container, dict):
+            continue
+        for key in _ETA_KEYS:
+            value = container.get(key)
+            try:
+                if value is not None and float(value) >= 0:
+                    return float(value)
+            except (TypeError, ValueError):
+                continue
+    return None
+
+
+class TaskPoll:
+    """一次状态查询的结果"""
+
+    __slots__ = ('status', 'payload', 'eta')
+
+    def __init__(self, status, payload=None, eta=None):
+        self.status = status
+        self.payload = payload
+        self.eta = eta
+
+
+class ProviderUnavailable(Exception):
+    """服务商侧故障（网络错误、超时、5xx、限流或队列已满），计入熔断"""
+
+
+def is_provider_fault(error):
+    """请求异常是否是服务商侧的问题（而不是输入被拒绝等调用方的问题）"""
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return False
+
+
+class VideoProvider:
+    """3D视频服务商基类，配置和响应解析复用HairstyleProcessor上的字段与方法"""
+
+    name = None
+    supports_callback = False
+    # 没有历史数据和ETA提示时假定的任务耗时（秒）
+    default_expected_seconds = 120
+
+    def __init__(self, processor, http_client):
+        self.processor = processor
+        self.http = http_client
+        self.expected_seconds = float(
+            os.environ.get(f'VIDEO_3D_EXPECTED_SECONDS_{self.name.upper()}', self.default_expected_seconds)
+        )
+
+        # 终态查询响应的短期缓存: task_id -> (过期时间, 响应)
+        # 状态和结果是同一个接口的服务商，get_results直接复用最后一次状态查询的响应
+        self.response_ttl = float(os.environ.get('VIDEO_3D_RESPONSE_TTL', '60'))
+        self._responses = {}
+        self.response_hits = 0
+
+    def remember_response(self, task_id, payload):
+        """缓存任务终态的查询响应"""
+        now = time.monotonic()
+        for stale_id in [key for key, (expires_at, _) in self._responses.items() if expires_at <= now]:
+            del self._responses[stale_id]
+        self._responses[task_id] = (now + self.response_ttl, payload)
+
+    def recall_response(self, task_id):
+        """返回未过期的缓存响应，没有时返回None"""
+        cached = self._responses.get(task_id)
+        if cached is not None and cached[0] <= time.monotonic():
+            self._responses.pop(task_id, None)
+            cached = None
+        metrics.count_cache('video_response', cached is not None)
+        if cached is None:
+            return None
+        self.response_hits += 1
+        return cached[1]
+
+    def observe_duration(self, seconds):
+        """用实际耗时更新预计耗时（指数滑动平均）"""
+        self.expected_seconds = 0.7 * self.expected_seconds + 0.3 * seconds
+
+    async def submit(self, image_input, cancel_check_func=None, callback_url=None):
+        raise NotImplementedError
+
+    async def poll(self, task_id):
+        raise NotImplementedError
+
+    async def get_results(self, task_id):
+        raise NotImplementedError
+
+    async def cancel(self, task_id):
+        logger.info(f"{self.name} 3D task cancellation is not implemented for task: {task_id}", extra={'task_id': task_id})
+        return False
+
+
+class RunningHubVideoProvider(VideoProvider):
+    name = 'runninghub'
+    supports_callback = True
+    default_expected_seconds = 180
+
+    def _url(self, path):
+        return f"{self.processor.runninghub.base_url}{path}"
+
+    async def _post(self, path, payload):
+        with tracing.span(f"runninghub.{path.rsplit('/', 1)[-1]}"):
+            response = await self.http.post(self._url(path), json=payload)
+            response.raise_for_status()
+            return response.json()
+
+    async def submit(self, image_input, cancel_check_func=None, callback_url=None, max_retries=10, retry_delay=20,
+                     deadline=None):
+        """提交任务；队列已满时重试，deadline（time.monotonic()时刻）之前等不到下一次重试就放弃"""
+        processor = self.processor
+        if not processor.webapp_3d_id:
+            raise ValueError("3D webapp ID is required. Set RUNNINGHUB_3D_WEBAPP_ID environment variable.")
+
+        payload = {
+            "webappId": processor.webapp_3d_id,
+            "apiKey": processor.api_key,
+            "nodeInfoList": [
+                {
+                    "nodeId": "146",
+                    "fieldName": "image",
+                    "fieldValue": image_input,
+                    "description": "user"
+                }
+            ],
+            "instanceType": "plus",
+            "usePersonalQueue": "true"
+        }
+        if callback_url:
+            payload["webhookUrl"] = callback_url
+
+        start_time = time.time()
+        for attempt in range(max_retries):
+            if cancel_check_func and cancel_check_func():
+                logger.info(f"3D任务在排队阶段被取消 (attempt {attempt + 1}/{max_retries})")
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("3D任务提交超出会话截止时间，停止重试")
+                return None
+
+            try:
+                result = await self._post("/task/openapi/ai-app/run", payload)
+            except Exception as e:
+                logger.error(f"Error running 3D task (attempt {attempt + 1}/{max_retries}): {e}")
+                # 只有连接未建立时才重试，否则可能重复创建（并计费）任务
+                if (attempt < max_retries - 1 and isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                        and (deadline is None or time.monotonic() + retry_delay < deadline)):
+                    await asyncio.sleep(retry_delay)
+                    continue
+                if is_provider_fault(e):
+                    raise ProviderUnavailable(str(e)) from e
+                return None
+
+            elapsed_time = time.time() - start_time
+            if result.get("code") == 0:
+                processor.task_times.append(elapsed_time)
+                processor.task_count += 1
+                logger.info(f"3D task started successfully: {result['data']['taskId']} (耗时: {elapsed_time:.2f}秒)")
+                return result["data"]["taskId"]
+
+            if result.get("msg") in ["TASK_QUEUE_MAXED", "TASK_INSTANCE_MAXED"]:
+                metrics.count_queue_maxed(self.name, '3d')
+                tracing.event('task.queue_maxed', provider=self.name, attempt=attempt + 1)
+                if deadline is not None and time.monotonic() + retry_delay >= deadline:
+                    logger.warning("3D task queue is full and the session deadline is before the next retry, giving up")
+                    return None
+                if attempt < max_retries - 1:
+                    logger.warning(f"3D task queue is full (attempt {attempt + 1}/{max_retries}), waiting {retry_delay} seconds before retry...")
+                    for _ in range(retry_delay):
+                        if cancel_check_func and cancel_check_func():
+                            logger.info("3D任务在等待重试期间被取消")
+                            return None
+                        await asyncio.sleep(1)
+                    continue
+                processor.task_times.append(elapsed_time)
+                processor.task_count += 1
+                logger.warning(f"Max retries reached, 3D task queue still full (总耗时: {elapsed_time:.2f}秒)")
+                raise ProviderUnavailable(result.get("msg"))
+
+            processor.task_times.append(elapsed_time)
+            processor.task_count += 1
+            logger.error(f"3D task failed: {result} (耗时: {elapsed_time:.2f}秒)")
+            if is_invalid_asset_error(result.get("msg")):
+                raise InvalidAssetError(result.get("msg"))
+            return None
+
+        return None
+
+    async def poll(self, task_id):
+        try:
+            result = await self._post("/task/openapi/status", {"apiKey": self.processor.api_key, "taskId": task_id})
+        except Exception as e:
+            logger.warning(f"Error checking status for task {task_id}: {e}",
+                           extra={'task_id': task_id, 'rate_key': 'status_check_failed'})
+            return TaskPoll(None)
+        if result.get("code") != 0:
+            logger.warning(f"Status check failed for task {task_id}: code={result.get('code')}, msg={result.get('msg', 'unknown')}",
+                           extra={'task_id': task_id, 'rate_key': 'status_check_failed'})
+            return TaskPoll(None, result)
+        return TaskPoll(result["data"], result, _find_eta(result))
+
+    async def get_results(self, task_id):
+        try:
+            result = await self._post("/task/openapi/outputs", {"apiKey": self.processor.api_key, "taskId": task_id})
+        except Exception as e:
+            logger.error(f"Error getting results: {e}")
+            return None
+        if result.get("code") == 0:
+            return result["data"]
+        logger.error(f"Get results failed: {result}")
+        return None
+
+    async def cancel(self, task_id):
+        try:
+            result = await self._post("/task/openapi/cancel", {"apiKey": self.processor.api_key, "taskId": task_id})
+        except Exception as e:
+            logger.error(f"Error cancelling task: {e}")
+            return False
+        if result.get("code") == 0:
+            logger.info(f"Task cancelled successfully: {task_id}", extra={'task_id': task_id})
+            return True
+        logger.error(f"Cancel task failed: {result}")
+        return False
+
+
+class VolcengineVideoProvider(VideoProvider):
+    name = 'volcengine'
+    supports_callback = True
+    default_expected_seconds = 90
+
+    def _headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.processor.volcengine_ark_api_key}"
+        }
+
+    async def submit(self, image_input, cancel_check_func=None, callback_url=None):
+        processor = self.processor
+        if not processor.volcengine_ark_api_key:
+            raise ValueError("ARK API key is required. Set ARK_API_KEY or VOLCENGINE_ARK_API_KEY.")
+        if not image_input:
+            raise ValueError("image_url is required for Volcengine 3D generation.")
+
+        if cancel_check_func and cancel_check_func():
+            logger.info("3D任务在火山引擎提交前被取消")
+            return None
+
+        payload = {
+            "model": processor.volcengine_3d_model,
+            "content": [
+                {"type": "text", "text": processor.volcengine_3d_prompt},
+                {"type": "image_url", "image_url": {"url": image_input}}
+            ],
+            "ratio": processor.volcengine_3d_ratio,
+            "duration": processor.volcengine_3d_duration,
+            "resolution": processor.volcengine_3d_resolution
+        }
+        if callback_url:
+            payload["callback_url"] = callback_url
+
+        try:
+            response = await self.http.post(processor.volcengine_3d_base_url, json=payload, headers=self._headers())
+            response.raise_for_status()
+            result = response.json()
+            task_id = result.get("id")
+            if not task_id and isinstance(result.get("data"), dict):
+                task_id = result["data"].get("id")
+
+            if task_id:
+                logger.info(f"Volcengine 3D task started successfully: {task_id}", extra={'task_id': task_id})
+                return task_id
+
+            logger.error(f"Volcengine 3D task start response missing id: {result}")
+            return None
+        except Exception as e:
+            logger.error(f"Error running Volcengine 3D task: {e}")
+            if is_provider_fault(e):
+                raise ProviderUnavailable(str(e)) from e
+            return None
+
+    async def _get_task(self, task_id):
+        response = await self.http.get(f"{self.processor.volcengine_3d_base_url}/{task_id}", headers=self._headers())
+        response.raise_for_status()
+        return response.json()
+
+    async def poll(self, task_id):
+        try:
+            result = await self._get_task(task_id)
+        except Exception as e:
+            logger.warning(f"Error checking Volcengine 3D task status for {task_id}: {e}",
+                           extra={'task_id': task_id, 'rate_key': 'status_check_failed'})
+            return TaskPoll(None)
+        status = self.processor._normalize_volcengine_task_status(
+            self.processor._extract_volcengine_task_status(result)
+        )
+        if status == "SUCCESS":
+            self.remember_response(task_id, result)
+        return TaskPoll(status, result, _find_eta(result))
+
+    async def get_results(self, task_id):
+        result = self.recall_response(task_id)
+        if result is None:
+            try:
+                result = await self._get_task(task_id)
+            except Exception as e:
+                logger.error(f"Error getting Volcengine 3D task results for {task_id}: {e}", extra={'task_id': task_id})
+                return None
+        outputs = self.processor._extract_volcengine_video_results(result)
+        if not outputs:
+            logger.info(f"Volcengine 3D task has no video outputs yet: {result}")
+        return outputs
+
+
+class PaiVideoProvider(VideoProvider):
+    name = 'pai'
+    default_expected_seconds = 60
+
+    def _url(self, path):
+        return f"{self.processor.pai_video_base_url}{path}"
+
+    async def upload_image(self, image_path):
+        """Upload a local image to Pai AI and return its img_id."""
+        processor = self.processor
+        upload_path = await asyncio.to_thread(processor.upload_transformer.prepare, image_path)
+        file_type = mimetypes.guess_type(upload_path)[0] or "image/jpeg"
+
+        def _read():
+            with open(upload_path, "rb") as image_file:
+                return image_file.read()
+
+        try:
+            with metrics.time_stage('upload', self.name, '3d'):
+                image_bytes = await asyncio.to_thread(_read)
+                response = await self.http.post(
+                    self._url("/openapi/v2/image/upload"),
+                    headers=processor._pai_headers(),
+                    files={"image": (os.path.basename(upload_path), image_bytes, file_type)},
+                    timeout=processor.pai_video_upload_timeout
+                )
+                response.raise_for_status()
+                result = response.json()
+            resp = processor._extract_pai_response(result, "image upload")
+            if not resp:
+                return None
+
+            img_id = resp.get("img_id")
+            if img_id is None:
+                logger.error(f"Pai AI image upload response missing img_id: {result}")
+                return None
+
+            logger.info(f"Pai AI image upload successful for {image_path}: img_id={img_id}")
+            return img_id
+        except Exception as e:
+            logger.error(f"Error uploading image to Pai AI: {e}")
+            if is_provider_fault(e):
+                raise ProviderUnavailable(str(e)) from e
+            return None
+
+    async def submit(self, image_input, cancel_check_func=None, callback_url=None):
+        processor = self.processor
+        if not processor.pai_video_api_key:
+            raise ValueError("Pai AI API key is required. Set PAI_VIDEO_API_KEY.")
+        if not image_input:
+            raise ValueError("image_path is required for Pai AI image-to-video generation.")
+
+        if cancel_check_func and cancel_check_func():
+            logger.info("3D任务在拍我AI图片上传前被取消")
+            return None
+
+        registry = processor.asset_registry
+        img_id = await asyncio.to_thread(registry.get, self.name, image_input)
+        reused = img_id is not None
+        if reused:
+            logger.debug(f"复用已上传图片 (pai): {os.path.basename(image_input)} -> {img_id}")
+        else:
+            img_id = await self._upload_and_register(image_input)
+            if img_id is None:
+                return None
+
+        if cancel_check_func and cancel_check_func():
+            logger.info("3D任务在拍我AI生成提交前被取消")
+            return None
+
+        try:
+            return await self._generate(img_id)
+        except InvalidAssetError as e:
+            if not reused:
+                logger.error(f"拍我AI拒绝了刚上传的图片: {e}")
+                return None
+            logger.warning(f"拍我AI拒绝了复用的img_id（{e}），重新上传后重试一次")
+
+        await asyncio.to_thread(registry.forget, self.name, image_input)
+        img_id = await self._upload_and_register(image_input)
+        if img_id is None:
+            return None
+        try:
+            return await self._generate(img_id)
+        except InvalidAssetError as e:
+            logger.error(f"拍我AI仍拒绝重新上传的图片: {e}")
+            return None
+
+    async def _upload_and_register(self, image_path):
+        img_id = await self.upload_image(image_path)
+        if img_id is not None:
+            await asyncio.to_thread(self.processor.asset_registry.put, self.name, image_path, img_id)
+        return img_id
+
+    async def _generate(self, img_id):
+        """提交图生视频任务，返回video_id；img_id被拒绝时抛出InvalidAssetError"""
+        processor = self.processor
+        payload = {
+            "duration": processor.pai_video_duration,
+            "img_id": img_id,
+            "model": processor.pai_video_model,
+            "template_id": processor.pai_video_template_id,
+            "motion_mode": processor.pai_video_motion_mode,
+            "negative_prompt": processor.pai_video_negative_prompt,
+            "prompt": processor.pai_video_prompt,
+            "quality": processor.pai_video_quality,
+            "seed": processor.pai_video_seed,
+            "generate_audio_switch": processor.pai_video_generate_audio,
+            "generate_multi_clip_switch": processor.pai_video_generate_multi_clip,
+        }
+        if processor.pai_video_style:
+            payload["style"] = processor.pai_video_style
+        if processor.pai_video_camera_movement:
+            payload["camera_movement"] = processor.pai_video_camera_movement
+
+        try:
+            response = await self.http.post(
+                self._url("/openapi/v2/video/img/generate"),
+                json=payload,
+                headers=processor._pai_headers(include_json_content_type=True)
+            )
+            response.raise_for_status()
+            result = response.json()
+            resp = processor._extract_pai_response(result, "image-to-video generation")
+            if not resp:
+                if isinstance(result, dict) and is_invalid_asset_error(result.get("ErrMsg")):
+                    raise InvalidAssetError(result.get("ErrMsg"))
+                if isinstance(result, dict) and str(result.get("ErrCode")).startswith("5"):
+                    # 5xxxxx 为服务端错误（如并发生成数已满）
+                    raise ProviderUnavailable(result.get("ErrMsg"))
+                return None
+
+            video_id = resp.get("video_id")
+            if video_id is None:
+                logger.error(f"Pai AI video generation response missing video_id: {result}")
+                return None
+
+            logger.info(f"Pai AI 3D task started successfully: {video_id}")
+            return str(video_id)
+        except (InvalidAssetError, ProviderUnavailable):
+            raise
+        except Exception as e:
+            logger.error(f"Error running Pai AI 3D task: {e}")
+            if is_provider_fault(e):
+                raise ProviderUnavailable(str(e)) from e
+            return None
+
+    async def _get_result(self, task_id, operation_name):
+        response = await self.http.get(
+            self._url(f"/openapi/v2/video/result/{task_id}"),
+            headers=self.processor._pai_headers()
+        )
+        response.raise_for_status()
+        result = response.json()
+        return result, self.processor._extract_pai_response(result, operation_name)
+
+    async def poll(self, task_id):
+        try:
+            result, resp = await self._get_result(task_id, "video status")
+        except Exception as e:
+            logger.warning(f"Error checking Pai AI 3D task status for {task_id}: {e}",
+                           extra={'task_id': task_id, 'rate_key': 'status_check_failed'})
+            return TaskPoll(None)
+        if resp is None:
+            return TaskPoll(None, result)
+        status = self.processor._normalize_pai_task_status(resp.get("status"))
+        if status == "SUCCESS":
+            self.remember_response(task_id, (result, resp))
+        return TaskPoll(status, result, _find_eta(result))
+
+    async def get_results(self, task_id):
+        cached = self.recall_response(task_id)
+        if cached is not None:
+            result, resp = cached
+        else:
+            try:
+                result, resp = await self._get_result(task_id, "video result")
+            except Exception as e:
+                logger.error(f"Error getting Pai AI 3D task results for {task_id}: {e}", extra={'task_id': task_id})
+                return None
+            if resp is None:
+                return None
+
+        video_url = resp.get("url")
+        if not video_url:
+            logger.info(f"Pai AI 3D task has no video URL yet: {result}")
+            return []
+        return [{"fileUrl": video_url, "fileType": "video"}]
+
+
+class ProviderHealth:
+    """服务商健康状态：滚动错误率、提交（排队）耗时和熔断器
+
+    连续失败或窗口内错误率过高时熔断，冷却时间后放行一个试探任务（半开），
+    试探成功恢复，失败则重新熔断。只有服务商侧故障（网络错误、超时、5xx、队列已满）记为失败，
+    输入被拒绝、任务本身失败等不影响熔断。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, window=20, error_threshold=0.5, min_samples=4,
+                 max_consecutive_failures=3, open_seconds=120, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.error_threshold = error_threshold
+        self.min_samples = min_samples
+        self.max_consecutive_failures = max_consecutive_failures
+        self.open_seconds = open_seconds
+
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._trial_in_flight = False
+        self.queue_seconds = None  # 提交耗时（指数滑动平均）
+
+    def _refresh(self):
+        if self.state == self.OPEN and self.clock() - self.opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+
+    def available(self):
+        """是否可以接收新任务（不占用半开状态的试探名额）"""
+        with self._lock:
+            self._refresh()
+            if self.state == self.HALF_OPEN:
+                return not self._trial_in_flight
+            return self.state == self.CLOSED
+
+    def acquire(self):
+        """提交任务前调用，半开状态下只放行一个试探任务"""
+        with self._lock:
+            self._refresh()
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+                return True
+            return self.state == self.CLOSED
+
+    def release(self):
+        """任务没有得出服务商健康与否的结论时（被取消、被拒绝、任务失败、等待被会话截止时间截断）归还试探名额"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_submit(self, seconds):
+        with self._lock:
+            if self.queue_seconds is None:
+                self.queue_seconds = seconds
+            else:
+                self.queue_seconds = 0.7 * self.queue_seconds + 0.3 * seconds
+
+    def record_success(self):
+        with self._lock:
+            self._outcomes.append(True)
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+            if self.state != self.CLOSED:
+                logger.warning(f"3D服务商 {self.name} 已恢复，关闭熔断")
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            should_open = (
+                self.state == self.HALF_OPEN
+                or self.consecutive_failures >= self.max_consecutive_failures
+                or (len(self._outcomes) >= self.min_samples and self._error_rate() >= self.error_threshold)
+            )
+            if should_open and self.state != self.OPEN:
+                logger.error(f"3D服务商 {self.name} 熔断 {self.open_seconds:.0f}秒 "
+                      f"(连续失败{self.consecutive_failures}次，错误率{self._error_rate():.0%})")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def _error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def snapshot(self):
+        with self._lock:
+            self._refresh()
+            return {
+                'state': self.state,
+                'error_rate': round(self._error_rate(), 3),
+                'samples': len(self._outcomes),
+                'consecutive_failures': self.consecutive_failures,
+                'queue_seconds': round(self.queue_seconds, 2) if self.queue_seconds is not None else None,
+            }
+
+
+PROVIDER_CLASSES = {
+    'runninghub': RunningHubVideoProvider,
+    'volcengine': VolcengineVideoProvider,
+    'pai': PaiVideoProvider,
+}
+
+
+class VideoTaskEngine:
+    """3D任务的提交与轮询引擎，所有网络请求都在共享事件循环上执行"""
+
+    def __init__(self, processor, min_interval=3.0, max_interval=30.0, callback_max_interval=60.0,
+                 backoff=1.5, max_none_retries=5, routing=None, breaker_open_seconds=120, clock=time.monotonic):
+        self.processor = processor
+        self.clock = clock
+        self.routing = routing
+        self.breaker_open_seconds = breaker_open_seconds
+        self.runtime = get_async_runtime()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.callback_max_interval = callback_max_interval
+        self.backoff = backoff
+        self.max_none_retries = max_none_retries
+
+        self._http = None
+        self._providers = {}
+        self._health = {}
+        self._wakeups = {}         # task_id -> asyncio.Event（仅在事件循环线程中访问）
+        self._early_notified = {}  # 等待开始前收到的回调: task_id -> 时间
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.poll_count = 0
+        self.callback_count = 0
+
+    @classmethod
+    def from_env(cls, processor):
+        return cls(
+            processor,
+            min_interval=float(os.environ.get('VIDEO_3D_POLL_MIN_INTERVAL', '3')),
+            max_interval=float(os.environ.get('VIDEO_3D_POLL_MAX_INTERVAL', '30')),
+            callback_max_interval=float(os.environ.get('VIDEO_3D_CALLBACK_POLL_INTERVAL', '60')),
+            routing=os.environ.get('VIDEO_3D_ROUTING'),
+            breaker_open_seconds=float(os.environ.get('VIDEO_3D_BREAKER_OPEN_SECONDS', '120')),
+        )
+
+    def _get_http(self):
+        """共享的httpx客户端（在事件循环线程中创建）"""
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=int(os.environ.get('VIDEO_3D_MAX_CONNECTIONS', '50')),
+                    max_keepalive_connections=int(os.environ.get('VIDEO_3D_MAX_KEEPALIVE', '10')),
+                ),
+                timeout=httpx.Timeout(float(os.environ.get('VIDEO_3D_HTTP_TIMEOUT', '120')), connect=10.0),
+            )
+        return self._http
+
+    def provider(self, name):
+        """按名称返回服务商实例（同名共享，保留历史耗时统计）"""
+        with self._lock:
+            provider = self._providers.get(name)
+            if provider is None:
+                provider_class = PROVIDER_CLASSES.get(name)
+                if provider_class is None:
+                    raise ValueError(f"Unknown 3D provider: {name}")
+                provider = provider_class(self.processor, _LazyClient(self._get_http))
+                self._providers[name] = provider
+            return provider
+
+    def health(self, name):
+        """服务商的健康状态（熔断器）"""
+        with self._lock:
+            health = self._health.get(name)
+            if health is None:
+                health = self._health[name] = ProviderHealth(name, open_seconds=self.breaker_open_seconds,
+                                                             clock=self.clock)
+            return health
+
+    def rank_providers(self, candidates, preferred=None):
+        """返回可接收新任务的服务商，按路由策略排序（熔断中的服务商排除在外）
+
+        latency: 按预计完成耗时 + 提交耗时从快到慢；static: 配置的服务商优先，其余作为故障转移。
+        未设置VIDEO_3D_ROUTING时，VIDEO_3D_PROVIDER为auto用latency，否则用static。
+        """
+        routing = self.routing or ('latency' if preferred is None else 'static')
+
+        def expected_latency(name):
+            queue_seconds = self.health(name).queue_seconds or 0
+            return self.provider(name).expected_seconds + queue_seconds
+
+        available = [name for name in candidates if self.health(name).available()]
+        if routing == 'static':
+            return sorted(available, key=lambda name: (name != preferred, expected_latency(name)))
+        return sorted(available, key=expected_latency)
+
+    def health_snapshot(self):
+        with self._lock:
+            names = list(self._health)
+        return {
+            name: dict(self.health(name).snapshot(), expected_seconds=round(self.provider(name).expected_seconds, 1))
+            for name in names
+        }
+
+    async def submit(self, provider_name, image_input, cancel_check_func=None, callback_url=None, **kwargs):
+        """提交任务并记录服务商的提交耗时和成功/失败"""
+        provider = self.provider(provider_name)
+        health = self.health(provider_name)
+        if not health.acquire():
+            logger.warning(f"3D服务商 {provider_name} 熔断中，拒绝提交")
+            return None
+
+        start_time = time.monotonic()
+        try:
+            with tracing.span('submit', provider=provider_name, job_type='3d') as submit_span:
+                task_id = await provider.submit(image_input, cancel_check_func, callback_url, **kwargs)
+                submit_span.set('task_id', task_id or '')
+        except ProviderUnavailable as e:
+            logger.warning(f"3D服务商 {provider_name} 提交失败（服务商故障）: {e}")
+            health.record_failure()
+            return None
+        except Exception:
+            # 配置错误、引用的上传资源失效等不是服务商故障
+            health.release()
+            raise
+        if task_id:
+            health.record_submit(time.monotonic() - start_time)
+            metrics.observe_stage('submit', provider_name, time.monotonic() - start_time, '3d')
+        else:
+            # 被取消或请求被拒绝（输入无效等），不计入熔断
+            health.release()
+        return task_id
+
+    def run(self, coro, timeout=None):
+        """在共享事件循环上执行协程并等待结果（带上调用方的追踪上下文）"""
+        return self.runtime.run(tracing.bind(coro), timeout=timeout)
+
+    def next_delay(self, provider, elapsed, poll, overdue_polls, has_callback):
+        """根据ETA提示或预计耗时计算下一次轮询前的等待时间"""
+        max_interval = self.callback_max_interval if has_callback else self.max_interval
+        if poll is not None and poll.eta is not None:
+            delay = poll.eta
+        else:
+            remaining = provider.expected_seconds - elapsed
+            if remaining > 0:
+                # 预计完成前逐步逼近，避免固定频率空轮询
+                delay = remaining * 0.5
+            else:
+                delay = self.min_interval * (self.backoff ** overdue_polls)
+        return max(self.min_interval, min(delay, max_interval))
+
+    def notify(self, task_id):
+        """服务商回调时调用（任意线程），立即唤醒该任务的轮询"""
+        self.callback_count += 1
+
+        def _wake():
+            event = self._wakeups.get(task_id)
+            if event is not None:
+                event.set()
+                return
+            # 任务完成后才到达的回调不会被消费，只保留最近10分钟的记录
+            now = time.time()
+            for stale_id in [key for key, at in self._early_notified.items() if now - at > 600]:
+                del self._early_notified[stale_id]
+            self._early_notified[task_id] = now
+
+        self.runtime.loop.call_soon_threadsafe(_wake)
+
+    async def _sleep(self, task_id, delay, cancel_check_func, cancel_check_interval=1.0):
+        """等待delay秒，被回调唤醒或检测到取消时提前返回"""
+        event = self._wakeups[task_id]
+        deadline = time.monotonic() + delay
+        while True:
+            if cancel_check_func and cancel_check_func():
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(remaining, cancel_check_interval))
+                event.clear()
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    async def wait(self, provider_name, task_id, timeout=600, cancel_check_func=None,
+                   has_callback=False, on_status=None, deadline_bound=False):
+        """轮询任务直到结束，返回最终状态（SUCCESS/FAILED/CANCELLED/TIMEOUT/CANCEL_REQUESTED）
+
+        deadline_bound 表示 timeout 是被会话截止时间截短的：此时超时不代表服务商慢，
+        不计入预计耗时也不计入熔断。
+        """
+        health = self.health(provider_name)
+        try:
+            status = await self._wait(provider_name, task_id, timeout, cancel_check_func, has_callback, on_status)
+        except Exception:
+            health.record_failure()
+            raise
+        if status == "SUCCESS":
+            health.record_success()
+        elif status == STATUS_TIMEOUT and not deadline_bound:
+            # 超时的任务至少按超时时间计入预计耗时，慢的服务商在路由中排到后面
+            provider = self.provider(provider_name)
+            provider.observe_duration(max(timeout, provider.expected_seconds))
+            health.record_failure()
+        else:
+            # 任务失败（如输入图片被拒绝）、被取消或等待被会话截止时间截断，不代表服务商不可用
+            health.release()
+        return status
+
+    async def _wait(self, provider_name, task_id, timeout, cancel_check_func, has_callback, on_status):
+        provider = self.provider(provider_name)
+        self._wakeups[task_id] = asyncio.Event()
+        if self._early_notified.pop(task_id, None):
+            self._wakeups[task_id].set()
+
+        start_time = time.monotonic()
+        timer = metrics.TaskTimer(provider_name, '3d')
+        none_count = 0
+        overdue_polls = 0
+        poll = None
+        try:
+            # 第一次查询前先等待一段预计耗时
+            await self._sleep(task_id, self.next_delay(provider, 0, None, 0, has_callback), cancel_check_func)
+            while True:
+                if cancel_check_func and cancel_check_func():
+                    return STATUS_CANCEL_REQUESTED
+
+                elapsed = time.monotonic() - start_time
+                if elapsed >= timeout:
+                    return STATUS_TIMEOUT
+
+                with tracing.span('poll', provider=provider_name) as poll_span:
+                    poll = await provider.poll(task_id)
+                    poll_span.set('status', str(poll.status))
+                self.poll_count += 1
+                status = poll.status
+                timer.status(status)
+                if on_status:
+                    on_status(status)
+
+                if status == "SUCCESS":
+                    timer.finish(status)
+                    provider.observe_duration(time.monotonic() - start_time)
+                    return status
+                if status in ("FAILED", "CANCELLED"):
+                    return status
+                if status is None:
+                    none_count += 1
+                    if none_count >= self.max_none_retries:
+                        raise Exception(f"状态检查连续失败{self.max_none_retries}次")
+                else:
+                    none_count = 0
+
+                if elapsed > provider.expected_seconds:
+                    overdue_polls += 1
+                delay = self.next_delay(provider, elapsed, poll, overdue_polls, has_callback)
+                await self._sleep(task_id, min(delay, max(0.0, timeout - elapsed)), cancel_check_func)
+        finally:
+            self._wakeups.pop(task_id, None)
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class _LazyClient:
+    """延迟到首次请求时（事件循环线程内）才创建共享httpx客户端"""
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)